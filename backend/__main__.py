@@ -1,5 +1,16 @@
 import uvicorn
-from base import app
+from settings import get_settings
 
 if __name__ == "__main__":
-    uvicorn.run("base:app", reload=True)
+    # The app is imported by the server processes only, this one just supervises them
+    settings = get_settings()
+    if settings.SERVER_MODE == "production":
+        uvicorn.run(
+            "base:app",
+            host=settings.HOST,
+            port=settings.PORT,
+            workers=settings.WEB_WORKERS or settings.AVAILABLE_CORES,
+            timeout_graceful_shutdown=settings.SHUTDOWN_TIMEOUT,
+        )
+    else:
+        uvicorn.run("base:app", host=settings.HOST, port=settings.PORT, reload=True)
@@ -1,11 +1,93 @@
-from fastapi import FastAPI
+import time
+
+# Before the other imports, the startup time covers them
+STARTED = time.perf_counter()
+
+import logging
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+from custom_logger import log, request_id
+from database import engine_args, read_engine, warm_up
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_sqlalchemy import DBSessionMiddleware
+from fastapi.responses import JSONResponse
+from fastapi_sqlalchemy import DBSessionMiddleware, db
+from jobs import drain_jobs
+from metrics import registry
 from routes import root
 from settings import get_settings
 
-app = FastAPI()
 settings = get_settings()
+logger = logging.getLogger("backend")
+
+
+def warm_up_pools():
+    with db():
+        engine = db.session.get_bind()
+    warm_up(engine, settings.DB_POOL_SIZE)
+    if read_engine() is not None:
+        warm_up(read_engine(), settings.DB_READ_POOL_SIZE or settings.DB_POOL_SIZE)
+
+
+class LimitRequestSize:
+    """Reject bodies over limit before the multipart parser spools them.
+
+    A Content-Length over limit is refused upfront, chunked bodies are counted as they
+    stream in. The 413 raised from receive passes through FastAPI's body parsing.
+    """
+
+    def __init__(self, app, limit):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.limit:
+            response = JSONResponse(status_code=413, content={"detail": f"Upload exceeds {self.limit} bytes"})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def counted():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.limit:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {self.limit} bytes")
+            return message
+
+        await self.app(scope, counted, send)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up logging and the connection pools of this server process, drain its jobs on shutdown.
+
+    Logging is configured here rather than on import, so importing the app opens no log files.
+    """
+    log(
+        name="backend",
+        level=settings.LOG_LEVEL,
+        log_folder_path="logs",
+        log_format=settings.LOG_FORMAT,
+        queued=settings.LOG_QUEUE,
+    )
+    await run_in_threadpool(warm_up_pools)
+    seconds = time.perf_counter() - STARTED
+    registry.set("startup_seconds", seconds)
+    logger.info(f"Started in {seconds:.2f} s")
+    yield
+    logger.info("Shutting down, waiting for running jobs")
+    await run_in_threadpool(drain_jobs)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Added first so it is the innermost middleware, the body parser then calls its receive directly
+app.add_middleware(LimitRequestSize, limit=settings.MAX_REQUEST_BYTES)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,7 +100,20 @@ app.add_middleware(
 app.add_middleware(
     DBSessionMiddleware,
     db_url=str(settings.DB_DSN),
-    engine_args={"pool_pre_ping": True, "isolation_level": "AUTOCOMMIT"},
+    engine_args=engine_args(settings.DB_DSN, settings.DB_POOL_SIZE),
 )
 
+
+@app.middleware("http")
+async def tag_request(request: Request, call_next):
+    """Log records of the request carry its X-Request-ID, generated when the client sent none."""
+    token = request_id.set(request.headers.get("x-request-id") or uuid4().hex)
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id.get()
+        return response
+    finally:
+        request_id.reset(token)
+
+
 app.include_router(root, prefix="", tags=["Root"])
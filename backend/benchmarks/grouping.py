@@ -0,0 +1,161 @@
+"""End-to-end benchmark of /generate and /groups on synthetic client data.
+
+Every dataset size is generated with a known entity per client, uploaded through
+the API and grouped with each blocking strategy. The report holds throughput,
+pair counts, peak RSS and pairwise precision/recall of the groups as JSON.
+
+Run from backend/ against a scratch database, the fuzzy table is replaced:
+DB_DSN=postgresql+psycopg2://... python -m benchmarks.grouping --rows 10000 100000
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+from collections import Counter
+
+from base import app
+from benchmarks.synthetic import write_clients
+from blocking import DEFAULT_WINDOW, BlockingStrategy, MatchingEngine
+from fastapi.testclient import TestClient
+from settings import get_settings
+from sqlalchemy import create_engine, text
+
+POLL_INTERVAL = 0.2
+DEFAULT_COLUMNS = ["client_fio_full", "client_bday"]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if platform.system() == "Darwin" else 1 << 10), 1)
+
+
+def wait_for_job(client, response):
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            break
+        time.sleep(POLL_INTERVAL)
+    if job["status"] == "failed":
+        raise RuntimeError(f"Job {job_id} failed: {job['error']}")
+    return job
+
+
+def pairwise_quality(assignments, entities):
+    """Precision and recall over record pairs, ungrouped records form singletons."""
+
+    def pairs(counts):
+        return sum(count * (count - 1) // 2 for count in counts.values())
+
+    groups, cells = Counter(), Counter()
+    for client_id, group_id in assignments:
+        group = group_id if group_id is not None else ("client", client_id)
+        groups[group] += 1
+        cells[group, entities[client_id - 1]] += 1
+    true_positive, predicted, actual = pairs(cells), pairs(groups), pairs(Counter(entities))
+    return {
+        "precision": round(true_positive / predicted, 4) if predicted else 1.0,
+        "recall": round(true_positive / actual, 4) if actual else 1.0,
+    }
+
+
+def run_size(client, database, rows, args):
+    rng = random.Random(args.seed)
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8", delete=False) as file:
+        entities = write_clients(file, rows, rng, args.duplicate_rate, args.typo_rate)
+    try:
+        started = time.perf_counter()
+        with open(file.name, "rb") as upload:
+            response = client.post("/generate", files=[("files", ("clients.csv", upload, "text/csv"))])
+        job = wait_for_job(client, response)
+        seconds = time.perf_counter() - started
+    finally:
+        os.remove(file.name)
+
+    report = {
+        "rows": rows,
+        "entities": len(set(entities)),
+        "generate": {
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(job["result"]["rows"] / seconds),
+            "peak_rss_mb": peak_rss_mb(),
+        },
+        "groups": {},
+    }
+    for blocking in args.blocking:
+        started = time.perf_counter()
+        response = client.post(
+            "/groups",
+            params={"blocking": blocking, "window": args.window, "engine": args.engine},
+            json=args.columns,
+        )
+        result = wait_for_job(client, response)["result"]
+        seconds = time.perf_counter() - started
+        with database.connect() as connection:
+            assignments = connection.execute(
+                text("SELECT f.client_id, a.group_id FROM fuzzy f LEFT JOIN fuzzy_assignments a ON a.client_id = f.client_id;")
+            ).all()
+        report["groups"][blocking] = {
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(rows / seconds),
+            "pairs_scored": result["candidate_pairs"],
+            "pairs_matched": result["pairs"],
+            "groups": result["groups"],
+            "peak_rss_mb": peak_rss_mb(),
+            **pairwise_quality(assignments, entities),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument(
+        "--blocking",
+        nargs="+",
+        default=[strategy.value for strategy in BlockingStrategy],
+        choices=[strategy.value for strategy in BlockingStrategy],
+    )
+    parser.add_argument("--engine", default=MatchingEngine.SQL.value, choices=[engine.value for engine in MatchingEngine])
+    parser.add_argument("--columns", nargs="+", default=DEFAULT_COLUMNS)
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3)
+    parser.add_argument("--typo-rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    database = create_engine(get_settings().DB_DSN)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "database": database.dialect.name,
+        "engine": args.engine,
+        "columns": args.columns,
+        "window": args.window,
+        "duplicate_rate": args.duplicate_rate,
+        "typo_rate": args.typo_rate,
+        "seed": args.seed,
+        "sizes": [],
+    }
+    with TestClient(app) as client:
+        for rows in args.rows:
+            report["sizes"].append(run_size(client, database, rows, args))
+    database.dispose()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Microbenchmark of the levenshtein <= 2 check on FIO pairs.
+
+Compares the banded kernel with the full-matrix one it replaced, in process and,
+given a Postgres DSN, levenshtein_less_equal with the old levenshtein predicate.
+
+Run from backend/: python -m benchmarks.levenshtein [--pairs N] [--dsn DSN]
+"""
+
+import argparse
+import json
+import random
+import time
+
+import numpy
+from benchmarks.synthetic import fio, with_typos
+from blocking import LEVENSHTEIN_MAX_DISTANCE, levenshtein_within_sql
+from engines import PAD_FIRST, PAD_SECOND, ColumnData, PaddedBatch, levenshtein_within, normalize
+
+
+def full_levenshtein_within(first, second, limit=LEVENSHTEIN_MAX_DISTANCE):
+    """The unbanded Wagner-Fischer kernel, every cell of every row."""
+    batch, first_width = first.matrix.shape
+    second_width = second.matrix.shape[1]
+    columns = numpy.arange(second_width + 1)
+    previous = numpy.broadcast_to(columns, (batch, second_width + 1)).copy()
+    distances = second.lengths.copy()
+    for row in range(1, first_width + 1):
+        cost = first.matrix[:, row - 1][:, None] != second.matrix
+        current = numpy.empty_like(previous)
+        current[:, 0] = row
+        current[:, 1:] = numpy.minimum(previous[:, :-1] + cost, previous[:, 1:] + 1)
+        current = numpy.minimum.accumulate(current - columns, axis=1) + columns
+        ended = first.lengths == row
+        distances[ended] = current[ended, second.lengths[ended]]
+        previous = current
+    return distances <= limit
+
+
+def candidate_pairs(count, duplicate_rate, seed):
+    """Candidate-like pairs: near duplicates with up to 3 typos, the rest unrelated names."""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        value = fio(rng)
+        other = with_typos(value, rng, rng.randint(0, 3)) if rng.random() < duplicate_rate else fio(rng)
+        pairs.append((normalize(value), normalize(other)))
+    return pairs
+
+
+def best_of(repeats, function):
+    timings, result = [], None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def in_process(pairs, repeats):
+    column = ColumnData([value for pair in pairs for value in pair])
+    first = numpy.arange(0, 2 * len(pairs), 2)
+    second = first + 1
+    # Both kernels expect the length filter to be applied by the caller
+    close = numpy.abs(column.lengths[first] - column.lengths[second]) <= LEVENSHTEIN_MAX_DISTANCE
+    first_batch = PaddedBatch(column, first[close], PAD_FIRST)
+    second_batch = PaddedBatch(column, second[close], PAD_SECOND)
+
+    results = {}
+    expected = None
+    for name, kernel in (("full", full_levenshtein_within), ("banded", levenshtein_within)):
+        seconds, matched = best_of(repeats, lambda: kernel(first_batch, second_batch))
+        if expected is None:
+            expected = matched
+        results[name] = {
+            "seconds": round(seconds, 4),
+            "pairs_per_second": round(len(pairs) / seconds),
+            "matched": int(matched.sum()),
+            "agrees": bool((matched == expected).all()),
+        }
+    return results
+
+
+def in_postgres(pairs, repeats, dsn):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(dsn, isolation_level="AUTOCOMMIT")
+    predicates = {
+        "levenshtein": "(LENGTH(a) - LENGTH(b) <= 2 AND levenshtein(a, b) <= 2)",
+        "levenshtein_less_equal": levenshtein_within_sql("a", "b"),
+    }
+    results = {}
+    with engine.connect() as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS fuzzystrmatch;"))
+        connection.execute(text("CREATE TEMP TABLE bench_pairs (a TEXT, b TEXT);"))
+        connection.execute(text("INSERT INTO bench_pairs VALUES (:a, :b)"), [{"a": a, "b": b} for a, b in pairs])
+        connection.execute(text("ANALYZE bench_pairs;"))
+        for name, predicate in predicates.items():
+            query = text(f"SELECT COUNT(*) FROM bench_pairs WHERE {predicate};")
+            seconds, matched = best_of(repeats, lambda: connection.execute(query).scalar())
+            results[name] = {
+                "seconds": round(seconds, 4),
+                "pairs_per_second": round(len(pairs) / seconds),
+                "matched": matched,
+            }
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=200_000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dsn", help="Postgres DSN with fuzzystrmatch, SQL predicates are skipped without it")
+    args = parser.parse_args()
+
+    pairs = candidate_pairs(args.pairs, args.duplicate_rate, args.seed)
+    report = {"pairs": len(pairs), "in_process": in_process(pairs, args.repeats)}
+    if args.dsn:
+        report["postgres"] = in_postgres(pairs, args.repeats, args.dsn)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
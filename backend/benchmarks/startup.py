@@ -0,0 +1,59 @@
+"""Startup time of one server process: importing the app, then running its lifespan startup.
+
+Every repeat runs in a fresh interpreter, as a server process starts, and reports
+the median seconds along with the optional heavy modules the startup imported.
+
+Run from backend/ against a scratch database, the lifespan connects to it:
+DB_DSN=postgresql+psycopg2://... python -m benchmarks.startup --repeats 5
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("numpy", "pyarrow", "pandas")
+
+PROCESS = f"""
+import json, sys, time
+started = time.perf_counter()
+import base
+imported = time.perf_counter() - started
+from fastapi.testclient import TestClient
+from metrics import registry
+with TestClient(base.app):
+    total = time.perf_counter() - started
+    startup = registry.get("startup_seconds")
+print(json.dumps({{
+    "import_seconds": imported,
+    "lifespan_seconds": total - imported,
+    "startup_seconds": startup,
+    "heavy_modules": [name for name in {HEAVY_MODULES!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure():
+    output = subprocess.run(
+        [sys.executable, "-c", PROCESS], capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.repeats)]
+    report = {
+        name: round(statistics.median(run[name] for run in runs), 4)
+        for name in ("import_seconds", "lifespan_seconds", "startup_seconds")
+    }
+    report["heavy_modules"] = sorted({name for run in runs for name in run["heavy_modules"]})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Synthetic Russian client records: FIO, birthdays and IDs with controlled typos."""
+
+import csv
+
+MALE_SURNAMES = [
+    "Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов",
+    "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров",
+    "Павлов", "Козлов", "Степанов", "Николаев", "Орлов", "Андреев", "Макаров", "Никитин",
+    "Захаров", "Зайцев", "Соловьёв", "Борисов", "Яковлев", "Григорьев", "Романов", "Воробьёв",
+    "Сергеев", "Кузьмин", "Фролов", "Александров", "Дмитриев", "Королёв", "Гусев", "Киселёв",
+    "Ильин", "Максимов", "Поляков", "Сорокин", "Виноградов", "Ковалёв", "Белов", "Медведев",
+    "Антонов", "Тарасов", "Жуков", "Баранов", "Филиппов", "Комаров", "Давыдов", "Беляев",
+    "Герасимов", "Богданов", "Осипов", "Сидоров", "Матвеев", "Титов", "Марков", "Миронов",
+]
+MALE_NAMES = [
+    "Александр", "Алексей", "Андрей", "Антон", "Артём", "Борис", "Вадим", "Валерий",
+    "Василий", "Виктор", "Владимир", "Владислав", "Геннадий", "Георгий", "Денис", "Дмитрий",
+    "Евгений", "Егор", "Иван", "Игорь", "Илья", "Кирилл", "Константин", "Максим",
+    "Михаил", "Никита", "Николай", "Олег", "Павел", "Роман", "Сергей", "Юрий",
+]
+FEMALE_NAMES = [
+    "Александра", "Алина", "Анастасия", "Анна", "Валентина", "Валерия", "Вера", "Виктория",
+    "Галина", "Дарья", "Екатерина", "Елена", "Елизавета", "Ирина", "Кристина", "Ксения",
+    "Людмила", "Марина", "Мария", "Наталья", "Нина", "Ольга", "Полина", "Светлана",
+    "Софья", "Татьяна", "Юлия",
+]
+PATRONYMICS = [
+    "Александрович", "Алексеевич", "Андреевич", "Борисович", "Васильевич", "Викторович",
+    "Владимирович", "Геннадьевич", "Дмитриевич", "Евгеньевич", "Иванович", "Игоревич",
+    "Константинович", "Михайлович", "Николаевич", "Олегович", "Павлович", "Петрович",
+    "Романович", "Сергеевич", "Юрьевич",
+]
+ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+
+
+def fio(rng):
+    female = rng.random() < 0.5
+    surname = rng.choice(MALE_SURNAMES)
+    if female:
+        surname += "а"
+    name = rng.choice(FEMALE_NAMES if female else MALE_NAMES)
+    patronymic = rng.choice(PATRONYMICS)
+    if female:
+        patronymic = patronymic[:-2] + "на"
+    return f"{surname} {name} {patronymic}"
+
+
+def birthday(rng):
+    return f"{rng.randint(1940, 2005)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def inn(rng):
+    return str(rng.randint(10**11, 10**12 - 1))
+
+
+def typo(value, rng):
+    """One random deletion, insertion, substitution or transposition."""
+    if not value:
+        return value
+    position = rng.randrange(len(value))
+    kind = rng.randrange(4 if len(value) > 1 else 3)
+    if kind == 0:
+        return value[:position] + value[position + 1 :]
+    if kind == 1:
+        return value[:position] + rng.choice(ALPHABET) + value[position:]
+    if kind == 2:
+        return value[:position] + rng.choice(ALPHABET) + value[position + 1 :]
+    if position == len(value) - 1:
+        position -= 1
+    return value[:position] + value[position + 1 : position + 2] + value[position] + value[position + 2 :]
+
+
+def with_typos(value, rng, count):
+    for _ in range(count):
+        value = typo(value, rng)
+    return value
+
+
+def birthday_typo(value, rng):
+    """Swap day and month or mistype a digit, the usual data entry errors."""
+    year, month, day = value.split("-")
+    if rng.random() < 0.5 and int(day) <= 12:
+        return f"{year}-{day}-{month}"
+    position = rng.choice([i for i, char in enumerate(value) if char.isdigit()])
+    return value[:position] + str(rng.randrange(10)) + value[position + 1 :]
+
+
+def write_clients(file, rows, rng, duplicate_rate=0.3, typo_rate=0.5, max_duplicates=3):
+    """Write rows client records as CSV, returns the true entity of client_id i at index i - 1.
+
+    duplicate_rate is the share of people with more than one record, every field of
+    a duplicate record gets a typo with probability typo_rate.
+    """
+    writer = csv.writer(file)
+    writer.writerow(["client_id", "client_fio_full", "client_bday", "client_inn"])
+    entities, entity = [], 0
+    while len(entities) < rows:
+        entity += 1
+        person = (fio(rng), birthday(rng), inn(rng))
+        copies = 1 + (rng.randint(1, max_duplicates) if rng.random() < duplicate_rate else 0)
+        for copy in range(min(copies, rows - len(entities))):
+            name, bday, tax_id = person
+            if copy:
+                if rng.random() < typo_rate:
+                    name = with_typos(name, rng, rng.randint(1, 2))
+                if rng.random() < typo_rate:
+                    bday = birthday_typo(bday, rng)
+                if rng.random() < typo_rate:
+                    tax_id = ""
+            entities.append(entity)
+            writer.writerow([len(entities), name, bday, tax_id])
+    return entities
@@ -0,0 +1,190 @@
+from enum import Enum
+
+from database import quote
+
+# Cyrillic -> Latin, one character each, so dmetaphone has something to encode
+TRANSLIT_FROM = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+TRANSLIT_TO = "abvgdeezziiklmnoprstufhccss_y_eua"
+
+DEFAULT_WINDOW = 5
+QGRAM_LENGTH = 3
+LEVENSHTEIN_MAX_DISTANCE = 2
+
+
+class MatchingEngine(str, Enum):
+    SQL = "sql"
+    MEMORY = "memory"
+
+
+class BlockingStrategy(str, Enum):
+    DMETAPHONE = "dmetaphone"
+    SORTED_NEIGHBOURHOOD = "sorted_neighbourhood"
+    QGRAM = "qgram"
+    TRIGRAM = "trigram"
+
+
+def normalize_sql(expression):
+    return f"LOWER(REPLACE(REPLACE(COALESCE({expression}::text, ''), ' ', ''), '-', ''))"
+
+
+def levenshtein_within_sql(first, second, limit=LEVENSHTEIN_MAX_DISTANCE):
+    # levenshtein_less_equal stops once the distance is known to exceed limit
+    return (
+        f"(ABS(LENGTH({first}) - LENGTH({second})) <= {limit} "
+        f"AND levenshtein_less_equal({first}, {second}, {limit}) <= {limit})"
+    )
+
+
+def normalized_sql(col, alias=None):
+    """The quoted normalized_<col> column, of alias when given. Column names come from CSV headers."""
+    name = quote(f"normalized_{col}")
+    return f"{alias}.{name}" if alias else name
+
+
+def block_key_sql(expression, strategy):
+    if strategy == BlockingStrategy.DMETAPHONE:
+        translit = f"REPLACE(TRANSLATE({expression}, '{TRANSLIT_FROM}', '{TRANSLIT_TO}'), '_', '')"
+        return f"dmetaphone({translit})"
+    if strategy == BlockingStrategy.QGRAM:
+        return f"LEFT({expression}, {QGRAM_LENGTH})"
+    raise ValueError(f"Strategy {strategy} has no block key")
+
+
+def candidate_pairs_sql(
+    columns,
+    strategy,
+    window=DEFAULT_WINDOW,
+    source="temp_normalized_records",
+    incremental=False,
+):
+    """Build the statements that fill temp_candidate_pairs(client_id_1, client_id_2).
+
+    source holds client_id, is_new and normalized_<col> for every column, plus
+    dmetaphone_<col> block keys for dmetaphone blocking.
+
+    With incremental=True only rows flagged is_new in source are probed, so every
+    pair has at least one new row and the work scales with the delta.
+    """
+    if strategy == BlockingStrategy.TRIGRAM:
+        # GiST serves the <-> ordering as a KNN scan, GIN only the % filter.
+        # Indexes are on the persisted normalized columns, see derived.py.
+        # The % threshold is pg_trgm.similarity_threshold, set by utils.grouping_session
+        neighbours = [
+            f"""
+                SELECT
+                    LEAST(n1.client_id, m.client_id) AS client_id_1,
+                    GREATEST(n1.client_id, m.client_id) AS client_id_2
+                FROM
+                    {source} n1
+                CROSS JOIN LATERAL (
+                    SELECT
+                        f.client_id
+                    FROM
+                        {source} f
+                    WHERE
+                        {normalized_sql(col, "f")} % {normalized_sql(col, "n1")}
+                        AND f.client_id <> n1.client_id
+                    ORDER BY
+                        {normalized_sql(col, "f")} <-> {normalized_sql(col, "n1")}
+                    LIMIT {window}
+                ) m
+                WHERE
+                    {normalized_sql(col, "n1")} <> ''
+                    {'AND n1.is_new' if incremental else ''}
+            """
+            for col in columns
+        ]
+        return f"""
+            DROP TABLE IF EXISTS temp_candidate_pairs;
+            CREATE TEMP TABLE temp_candidate_pairs AS
+            {' UNION '.join(neighbours)};
+            """
+
+    if strategy == BlockingStrategy.SORTED_NEIGHBOURHOOD:
+        if incremental:
+            neighbourhood = (
+                f"s2.position BETWEEN s1.position - {window - 1} AND s1.position + {window - 1} "
+                "AND s2.position <> s1.position"
+            )
+        else:
+            neighbourhood = f"s2.position BETWEEN s1.position + 1 AND s1.position + {window - 1}"
+        neighbourhoods = [
+            f"""
+                SELECT
+                    LEAST(s1.client_id, s2.client_id) AS client_id_1,
+                    GREATEST(s1.client_id, s2.client_id) AS client_id_2
+                FROM
+                    temp_sorted_{index} s1
+                JOIN
+                    temp_sorted_{index} s2
+                ON
+                    {neighbourhood}
+                {'WHERE s1.is_new' if incremental else ''}
+            """
+            for index in range(len(columns))
+        ]
+        sorted_tables = [
+            f"""
+            DROP TABLE IF EXISTS temp_sorted_{index};
+            CREATE TEMP TABLE temp_sorted_{index} AS
+            SELECT
+                client_id,
+                is_new,
+                ROW_NUMBER() OVER (ORDER BY {normalized_sql(col)}, client_id) AS position
+            FROM
+                {source} src
+            WHERE
+                {normalized_sql(col)} <> '';
+
+            CREATE INDEX ON temp_sorted_{index}(position);
+            ANALYZE temp_sorted_{index};
+            """
+            for index, col in enumerate(columns)
+        ]
+        return f"""
+            {''.join(sorted_tables)}
+
+            DROP TABLE IF EXISTS temp_candidate_pairs;
+            CREATE TEMP TABLE temp_candidate_pairs AS
+            {' UNION '.join(neighbourhoods)};
+            """
+
+    if strategy == BlockingStrategy.DMETAPHONE:
+        keys = {col: quote(f"dmetaphone_{col}") for col in columns}
+    else:
+        keys = {col: block_key_sql(normalized_sql(col), strategy) for col in columns}
+    # Keys are prefixed with the position of their column, names may hold any character
+    block_keys = [
+        f"""
+            SELECT
+                client_id,
+                is_new,
+                '{index}:' || {keys[col]} AS block_key
+            FROM
+                {source} src
+            WHERE
+                {normalized_sql(col)} <> ''
+        """
+        for index, col in enumerate(columns)
+    ]
+    return f"""
+            DROP TABLE IF EXISTS temp_blocks;
+            CREATE TEMP TABLE temp_blocks AS
+            SELECT * FROM ({' UNION ALL '.join(block_keys)}) keys
+            WHERE block_key IS NOT NULL AND block_key NOT LIKE '%:';
+            ANALYZE temp_blocks;
+
+            DROP TABLE IF EXISTS temp_candidate_pairs;
+            CREATE TEMP TABLE temp_candidate_pairs AS
+            SELECT DISTINCT
+                LEAST(b1.client_id, b2.client_id) AS client_id_1,
+                GREATEST(b1.client_id, b2.client_id) AS client_id_2
+            FROM
+                temp_blocks b1
+            JOIN
+                temp_blocks b2
+            ON
+                b1.block_key = b2.block_key
+                AND {'b1.client_id <> b2.client_id' if incremental else 'b1.client_id < b2.client_id'}
+            {'WHERE b1.is_new' if incremental else ''};
+            """
@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire ttl seconds after they were stored.
+
+    Values are shared between callers, they must not be modified in place.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, matches=None):
+        """Drop the entries whose key matches, all of them by default."""
+        with self._lock:
+            for key in [key for key in self._entries if matches is None or matches(key)]:
+                del self._entries[key]
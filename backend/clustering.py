@@ -0,0 +1,299 @@
+from array import array
+from itertools import islice
+
+from database import copy_rows, is_postgres
+from fastapi_sqlalchemy import db
+from sqlalchemy import text
+
+WRITE_CHUNK_ROWS = 100_000
+
+
+class UnionFind:
+    """Array-backed disjoint set over arbitrary hashable ids."""
+
+    def __init__(self):
+        self.index = {}
+        self.items = []
+        self.parent = array("q")
+        self.rank = bytearray()
+        self.components = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        position = self.index.get(item)
+        if position is None:
+            position = len(self.items)
+            self.index[item] = position
+            self.items.append(item)
+            self.parent.append(position)
+            self.rank.append(0)
+            self.components += 1
+        return position
+
+    def find(self, position):
+        parent = self.parent
+        root = position
+        while parent[root] != root:
+            root = parent[root]
+        while parent[position] != root:
+            parent[position], position = root, parent[position]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(self.add(first)), self.find(self.add(second))
+        if first == second:
+            return
+        if self.rank[first] < self.rank[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.components -= 1
+        if self.rank[first] == self.rank[second]:
+            self.rank[first] += 1
+
+    def groups(self):
+        """Yield (item, group_id) in item order, numbering components by their smallest member.
+
+        The numbering only depends on the components, so reruns over the same pairs
+        give the same rows in the same order whatever order the pairs came in.
+        """
+        group_ids = {}
+        for position in sorted(range(len(self.items)), key=self.items.__getitem__):
+            item = self.items[position]
+            root = self.find(position)
+            group_id = group_ids.setdefault(root, len(group_ids) + 1)
+            yield item, group_id
+
+    def merge(self, other):
+        """Union every component of another UnionFind into this one."""
+        for position, item in enumerate(other.items):
+            self.union(item, other.items[other.find(position)])
+
+    def clusters(self):
+        """Yield the members of every component as a list."""
+        members = {}
+        for position, item in enumerate(self.items):
+            members.setdefault(self.find(position), []).append(item)
+        yield from members.values()
+
+
+def groups_table(table):
+    return f"{table}_groups"
+
+
+def runs_table(table):
+    return f"{table}_group_runs"
+
+
+def assignments_view(table):
+    """(client_id, group_id) of the published run, clients missing there are ungrouped."""
+    return f"{table}_assignments"
+
+
+def create_group_tables(table):
+    """Assignments of every run kept apart from table, so writing them never rewrites its rows.
+
+    A run is written under status 'writing' and made visible through the view by
+    publish_run, a single UPDATE, so readers switch from one run to the next atomically.
+    """
+    db.session.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {runs_table(table)} (
+                run_id INTEGER PRIMARY KEY,
+                key TEXT,
+                version INTEGER,
+                status TEXT NOT NULL,
+                written BIGINT NOT NULL DEFAULT 0,
+                started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                published_at TIMESTAMP
+            );
+            """
+        )
+    )
+    db.session.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {groups_table(table)} AS
+            SELECT client_id, CAST(NULL AS INTEGER) AS group_id, CAST(NULL AS INTEGER) AS run_id FROM {table} LIMIT 0;
+            """
+        )
+    )
+    db.session.execute(
+        text(
+            f"CREATE INDEX IF NOT EXISTS idx_{groups_table(table)}_group_id "
+            f"ON {groups_table(table)}(run_id, group_id, client_id);"
+        )
+    )
+    db.session.execute(
+        text(
+            f"CREATE INDEX IF NOT EXISTS idx_{groups_table(table)}_client_id "
+            f"ON {groups_table(table)}(run_id, client_id, group_id);"
+        )
+    )
+    create_view = "CREATE OR REPLACE VIEW" if is_postgres() else "CREATE VIEW IF NOT EXISTS"
+    db.session.execute(
+        text(
+            f"""
+            {create_view} {assignments_view(table)} AS
+            SELECT
+                client_id,
+                group_id
+            FROM
+                {groups_table(table)}
+            WHERE
+                run_id = (SELECT run_id FROM {runs_table(table)} WHERE status = 'published');
+            """
+        )
+    )
+
+
+def drop_group_tables(table):
+    db.session.execute(text(f"DROP VIEW IF EXISTS {assignments_view(table)};"))
+    db.session.execute(text(f"DROP TABLE IF EXISTS {groups_table(table)};"))
+    db.session.execute(text(f"DROP TABLE IF EXISTS {runs_table(table)};"))
+
+
+def published_run(table):
+    return db.session.execute(text(f"SELECT run_id FROM {runs_table(table)} WHERE status = 'published';")).scalar()
+
+
+def start_run(table, key, version, resume=True):
+    """(run_id, rows already written) of a new run, or of the unfinished one with the same key and version.
+
+    Other unfinished runs, all of them without resume, are abandoned and their rows deleted.
+    """
+    runs = runs_table(table)
+    unfinished = db.session.execute(
+        text(f"SELECT run_id, key, version FROM {runs} WHERE status = 'writing';")
+    ).all()
+    for run_id, run_key, run_version in unfinished:
+        if resume and (run_key, run_version) == (key, version):
+            # COPY commits whole chunks, the rows of the run are its checkpoint
+            written = db.session.execute(
+                text(f"SELECT COUNT(*) FROM {groups_table(table)} WHERE run_id = :run_id;"), {"run_id": run_id}
+            ).scalar()
+            return run_id, written
+        db.session.execute(text(f"DELETE FROM {groups_table(table)} WHERE run_id = :run_id;"), {"run_id": run_id})
+        db.session.execute(text(f"UPDATE {runs} SET status = 'abandoned' WHERE run_id = :run_id;"), {"run_id": run_id})
+    run_id = db.session.execute(text(f"SELECT COALESCE(MAX(run_id), 0) + 1 FROM {runs};")).scalar()
+    db.session.execute(
+        text(f"INSERT INTO {runs} (run_id, key, version, status) VALUES (:run_id, :key, :version, 'writing');"),
+        {"run_id": run_id, "key": key, "version": version},
+    )
+    return run_id, 0
+
+
+def write_run(table, run_id, assignments, written=0):
+    """COPY (client_id, group_id) assignments in WRITE_CHUNK_ROWS chunks, skipping the first written ones."""
+    assignments = islice(assignments, written, None)
+    while chunk := [(client_id, group_id, run_id) for client_id, group_id in islice(assignments, WRITE_CHUNK_ROWS)]:
+        written += copy_rows(groups_table(table), ("client_id", "group_id", "run_id"), chunk)
+        db.session.execute(
+            text(f"UPDATE {runs_table(table)} SET written = :written WHERE run_id = :run_id;"),
+            {"written": written, "run_id": run_id},
+        )
+    return written
+
+
+def copy_run(table, run_id, source):
+    """Add the (client_id, group_id) rows of source, a snapshot or new assignments, to run_id."""
+    rows = db.session.execute(
+        text(
+            f"""
+            INSERT INTO {groups_table(table)} (client_id, group_id, run_id)
+            SELECT client_id, group_id, {run_id} FROM {source};
+            """
+        )
+    ).rowcount
+    db.session.execute(
+        text(f"UPDATE {runs_table(table)} SET written = written + :rows WHERE run_id = :run_id;"),
+        {"rows": rows, "run_id": run_id},
+    )
+    return rows
+
+
+def publish_run(table, run_id):
+    """Make run_id the published run in one statement, then delete the rows of the run it replaces."""
+    runs = runs_table(table)
+    db.session.execute(
+        text(
+            f"""
+            UPDATE {runs}
+            SET
+                status = CASE WHEN run_id = :run_id THEN 'published' ELSE 'superseded' END,
+                published_at = CASE WHEN run_id = :run_id THEN CURRENT_TIMESTAMP ELSE published_at END
+            WHERE
+                run_id = :run_id OR status = 'published';
+            """
+        ),
+        {"run_id": run_id},
+    )
+    db.session.execute(
+        text(
+            f"DELETE FROM {groups_table(table)} WHERE run_id IN (SELECT run_id FROM {runs} WHERE status = 'superseded');"
+        )
+    )
+    db.session.execute(text(f"UPDATE {runs} SET status = 'replaced' WHERE status = 'superseded';"))
+
+
+def create_assignments_table(table):
+    db.session.execute(text("DROP TABLE IF EXISTS temp_group_assignments;"))
+    db.session.execute(
+        text(
+            "CREATE TEMP TABLE temp_group_assignments AS "
+            f"SELECT client_id, CAST(NULL AS INTEGER) AS group_id FROM {table} LIMIT 0;"
+        )
+    )
+
+
+def merge_group_ids(table, components):
+    """Fold components over ("group", group_id) and ("client", client_id) nodes into the published run.
+
+    Every component keeps its smallest existing group id, or gets a fresh one when it
+    only holds ungrouped clients. Other groups of the component are renumbered into it.
+    Only the rows of merged groups and of newly grouped clients are written.
+    """
+    run_id = published_run(table)
+    groups = groups_table(table)
+    next_group_id = db.session.execute(
+        text(f"SELECT COALESCE(MAX(group_id), 0) + 1 FROM {groups} WHERE run_id = :run_id;"), {"run_id": run_id}
+    ).scalar()
+    assignments, merges = [], []
+    for members in components.clusters():
+        group_ids = [item for kind, item in members if kind == "group"]
+        if group_ids:
+            target = min(group_ids)
+        else:
+            target, next_group_id = next_group_id, next_group_id + 1
+        for kind, item in members:
+            if kind == "client":
+                assignments.append((item, target))
+            elif item != target:
+                merges.append((item, target))
+
+    create_assignments_table(table)
+    db.session.execute(text("DROP TABLE IF EXISTS temp_group_merges;"))
+    db.session.execute(text("CREATE TEMP TABLE temp_group_merges (group_id INTEGER PRIMARY KEY, new_group_id INTEGER);"))
+    copy_rows("temp_group_assignments", ("client_id", "group_id"), assignments)
+    copy_rows("temp_group_merges", ("group_id", "new_group_id"), merges)
+    db.session.execute(
+        text(
+            f"""
+            UPDATE
+                {groups} AS g
+            SET
+                group_id = m.new_group_id
+            FROM
+                temp_group_merges AS m
+            WHERE
+                g.run_id = :run_id
+                AND g.group_id = m.group_id;
+            """
+        ),
+        {"run_id": run_id},
+    )
+    # Clients of incremental components were ungrouped, so they have no row in the run yet
+    copy_run(table, run_id, "temp_group_assignments")
+    return {"assigned": len(assignments), "merged": len(merges)}
@@ -1,7 +1,16 @@
+import atexit
 import datetime
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+from contextvars import ContextVar
+
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+job_id: ContextVar[str | None] = ContextVar("job_id", default=None)
+_listener = None
 
 
 class StreamFormatter(logging.Formatter):
@@ -53,10 +62,13 @@ class StreamFormatter(logging.Formatter):
         + reset,
     }
 
+    def __init__(self):
+        super().__init__()
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        formatter = self._formatters.get(record.levelno)
+        return formatter.format(record) if formatter else super().format(record)
 
 
 class FileFormatter(logging.Formatter):
@@ -86,32 +98,88 @@ class FileFormatter(logging.Formatter):
         ),
     }
 
+    def __init__(self):
+        super().__init__()
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        formatter = self._formatters.get(record.levelno)
+        return formatter.format(record) if formatter else super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the request and job the record was logged from."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "job_id": getattr(record, "job_id", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Copy request and job ids on the record, on the logging thread before it is queued."""
 
+    def filter(self, record):
+        record.request_id = request_id.get()
+        record.job_id = job_id.get()
+        return True
 
-def log(name, level, log_folder_path: str):
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log(name, level, log_folder_path: str, log_format="text", queued=False):
+    """Configure the root handlers and return the name logger.
+
+    queued=True leaves a QueueHandler on the calling threads, formatting and
+    writes happen on a QueueListener thread. log_format="json" writes JSON lines.
+    """
+    global _listener
     now = datetime.datetime.now().strftime("%Y_%m_%d")
     if not os.path.isdir(log_folder_path):
         os.makedirs(log_folder_path)
 
     logger = logging.getLogger(name)
+    json_format = log_format == "json"
 
     file_handler = logging.FileHandler(f"{log_folder_path}/{now}.log", encoding="utf-8")
-    file_handler.setFormatter(FileFormatter())
+    file_handler.setFormatter(JsonFormatter() if json_format else FileFormatter())
 
     stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(StreamFormatter())
+    stream_handler.setFormatter(JsonFormatter() if json_format else StreamFormatter())
 
     crit_handler = logging.FileHandler(
         f"{log_folder_path}/errors.log", encoding="utf-8"
     )
     crit_handler.setLevel(logging.ERROR)
-    crit_handler.setFormatter(FileFormatter())
+    crit_handler.setFormatter(JsonFormatter() if json_format else FileFormatter())
 
-    logging.basicConfig(
-        level=level, handlers=[crit_handler, file_handler, stream_handler], force=True
-    )
+    handlers = [crit_handler, file_handler, stream_handler]
+    _stop_listener()
+    if queued:
+        queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        # The queued record keeps the bare message, the listener's handlers format it
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        handlers = [queue_handler]
+    for handler in handlers:
+        handler.addFilter(ContextFilter())
+
+    logging.basicConfig(level=level, handlers=handlers, force=True)
     return logger
+
+
+atexit.register(_stop_listener)
@@ -0,0 +1,347 @@
+import csv
+import io
+import re
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from uuid import uuid4
+
+from fastapi_sqlalchemy import db
+from settings import get_settings
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError
+
+STREAM_BATCH_SIZE = 10_000
+COPY_CHUNK_SIZE = 1 << 20
+EXTENSIONS = ("fuzzystrmatch", "pg_trgm")
+# Quoted names and literals are single tokens, semicolons and dashes inside them are no syntax
+SQL_TOKENS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|;|[^'";-]+|.""", re.S)
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def engine_args(dsn, pool_size):
+    """create_engine arguments for a pool of pool_size connections on dsn."""
+    settings = get_settings()
+    args = {
+        "pool_pre_ping": True,
+        "isolation_level": "AUTOCOMMIT",
+        "pool_size": pool_size,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+    if dsn.startswith("postgresql") and settings.DB_STATEMENT_TIMEOUT_MS:
+        args["connect_args"] = {"options": f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}"}
+    return args
+
+
+@lru_cache
+def read_engine():
+    """Engine of the read pool, None when reads share the session pool."""
+    settings = get_settings()
+    if not settings.DB_READ_DSN and not settings.DB_READ_POOL_SIZE:
+        return None
+    dsn = settings.DB_READ_DSN or settings.DB_DSN
+    return create_engine(dsn, **engine_args(dsn, settings.DB_READ_POOL_SIZE or settings.DB_POOL_SIZE))
+
+
+def read_bind():
+    return read_engine() or db.session.get_bind()
+
+
+@contextmanager
+def read_connection():
+    """Connection for metadata reads and result pages, so they never queue behind grouping runs."""
+    engine = read_engine()
+    if engine is None:
+        yield db.session.connection()
+        return
+    with engine.connect() as connection:
+        yield connection
+
+
+@contextmanager
+def session_settings(**values):
+    """SET run-time parameters on the session for the block, RESET them so pooled connections come back clean."""
+    values = {name: value for name, value in values.items() if value not in (None, "")}
+    if not values or not is_postgres():
+        yield
+        return
+    for name, value in values.items():
+        db.session.execute(text(f"SET {name} = '{value}';"))
+    try:
+        yield
+    finally:
+        for name in values:
+            db.session.execute(text(f"RESET {name};"))
+
+
+def create_extensions(connection):
+    """CREATE EXTENSION the grouping needs, under an advisory lock since concurrent creations can collide."""
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("SELECT pg_advisory_lock(hashtext('create_extensions'));"))
+    try:
+        for extension in EXTENSIONS:
+            connection.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension} SCHEMA public;"))
+    finally:
+        connection.execute(text("SELECT pg_advisory_unlock(hashtext('create_extensions'));"))
+
+
+def warm_up(engine, connections):
+    """Open connections of the engine's pool ahead of the first requests and create the extensions."""
+    opened = [engine.connect() for _ in range(max(connections, 1))]
+    try:
+        create_extensions(opened[0])
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == "postgresql"
+
+
+def existing_columns(table):
+    """Column name -> (data type, enum labels or None) of a Postgres table."""
+    rows = db.session.execute(
+        text(
+            """
+            SELECT
+                a.attname,
+                format_type(a.atttypid, a.atttypmod),
+                (SELECT array_agg(e.enumlabel ORDER BY e.enumsortorder) FROM pg_enum e WHERE e.enumtypid = a.atttypid)
+            FROM
+                pg_attribute a
+            WHERE
+                a.attrelid = to_regclass(:table)
+                AND a.attnum > 0
+                AND NOT a.attisdropped;
+            """
+        ),
+        {"table": table},
+    ).all()
+    return {column: (data_type, set(labels) if labels is not None else None) for column, data_type, labels in rows}
+
+
+def table_exists(table):
+    return inspect(db.session.connection()).has_table(table)
+
+
+def row_estimate(table):
+    """Planner row count of table on Postgres, counted elsewhere or before the first ANALYZE."""
+    if is_postgres():
+        rows = db.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table);"), {"table": table}
+        ).scalar()
+        if rows is not None and rows >= 0:
+            return int(rows)
+    return db.session.execute(text(f"SELECT COUNT(*) FROM {table};")).scalar()
+
+
+def sample_sql(percent, seed=None):
+    """Clause after a table name that keeps about percent of its rows.
+
+    SQLite has no TABLESAMPLE, rows are kept by a random filter and seed is ignored.
+    """
+    if is_postgres():
+        repeatable = f" REPEATABLE ({seed})" if seed is not None else ""
+        return f"TABLESAMPLE BERNOULLI ({percent}){repeatable}"
+    return f"WHERE ABS(RANDOM()) % 1000000 < {round(percent * 10_000)}"
+
+
+def split_statements(sql):
+    """Statements of a generated SQL script, comments dropped.
+
+    Quoted names may hold semicolons, they come from CSV headers.
+    """
+    statements, current = [], []
+    for token in SQL_TOKENS.findall(sql):
+        if token == ";":
+            statements.append("".join(current))
+            current = []
+        elif not token.startswith("--"):
+            current.append(token)
+    statements.append("".join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def execute_sql(sql, connection=None):
+    """Run generated SQL as it is, on the session unless connection is given.
+
+    Unlike text() it leaves colons and percent signs alone, quoted names from CSV
+    headers may hold either. Scripts of several statements run in one go on Postgres.
+    """
+    connection = connection or db.session.connection()
+    return connection.exec_driver_sql(sql, execution_options={"no_parameters": True})
+
+
+@contextmanager
+def raw_cursor(statement, connection=None, **cursor_args):
+    """DBAPI cursor on the session connection, driver errors wrapped like SQLAlchemy's."""
+    connection = connection or db.session.connection()
+    dbapi_error = connection.dialect.loaded_dbapi.Error
+    cursor = connection.connection.cursor(**cursor_args)
+    try:
+        yield cursor
+    except dbapi_error as e:
+        raise DBAPIError.instance(statement, None, e, dbapi_error, dialect=connection.dialect) from e
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def stream_transaction(connection):
+    """Explicit transaction for a named cursor on connection, which otherwise runs in AUTOCOMMIT.
+
+    Statements run on connection while it is open belong to it. Commits when the block
+    completes and rolls back when it fails or a stream is abandoned.
+    """
+    dbapi_connection = connection.connection.dbapi_connection
+    if not dbapi_connection.autocommit:
+        # Already inside a transaction, an outer stream or the caller ends it
+        yield
+        return
+    dbapi_connection.autocommit = False
+    try:
+        yield
+        dbapi_connection.commit()
+    except BaseException:
+        dbapi_connection.rollback()
+        raise
+    finally:
+        dbapi_connection.autocommit = True
+
+
+def fetch_rows(cursor, query, batch_size):
+    cursor.arraysize = batch_size
+    cursor.execute(query)
+    while rows := cursor.fetchmany(batch_size):
+        yield from rows
+
+
+def stream_rows(query, batch_size=STREAM_BATCH_SIZE, connection=None):
+    """Iterate over query rows through a server-side cursor, on the session unless connection is given."""
+    connection = connection or db.session.connection()
+    if connection.dialect.name != "postgresql":
+        with raw_cursor(query, connection) as cursor:
+            yield from fetch_rows(cursor, query, batch_size)
+        return
+    # A named cursor without WITH HOLD is closed by its transaction, rows are never materialized
+    with stream_transaction(connection), raw_cursor(query, connection, name=f"stream_{uuid4().hex}") as cursor:
+        yield from fetch_rows(cursor, query, batch_size)
+
+
+class ChunksReader(io.RawIOBase):
+    """File-like object over an iterable of byte chunks, for COPY ... FROM STDIN."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._pending += chunk
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def csv_chunks(rows):
+    """Render rows as CSV in chunks of about STREAM_BATCH_SIZE bytes."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= STREAM_BATCH_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+class RowsReader(ChunksReader):
+    """File-like object that renders rows as CSV lazily for COPY ... FROM STDIN."""
+
+    def __init__(self, rows):
+        super().__init__(csv_chunks(rows))
+
+
+class ChunkSink(io.RawIOBase):
+    """Writable file-like object collecting bytes until drained, for streaming writers."""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._written += len(data)
+        return self._buffer.write(data)
+
+    def tell(self):
+        return self._written
+
+    def drain(self):
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+def insert_rows(table, columns, rows, batch_size=STREAM_BATCH_SIZE):
+    """Batched executemany INSERT, the COPY fallback for databases other than Postgres."""
+    statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    count = 0
+    with raw_cursor(statement) as cursor:
+        while batch := list(islice(rows, batch_size)):
+            # The session autocommits, without a transaction every row is a commit of its own
+            cursor.execute("BEGIN")
+            try:
+                cursor.executemany(statement, batch)
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            count += len(batch)
+    return count
+
+
+def copy_file(table, columns, file, header=True, force_null=()):
+    """Stream a CSV file object into table through COPY, returns the number of rows.
+
+    Quoted empty values of the force_null columns load as NULL too, like unquoted ones.
+    """
+    if not is_postgres():
+        rows = csv.reader(io.TextIOWrapper(file, encoding="utf-8", newline=""))
+        if header:
+            next(rows, None)
+        return insert_rows(table, columns, ([value or None for value in row] for row in rows))
+
+    force_null = f", FORCE_NULL ({', '.join(force_null)})" if force_null else ""
+    statement = (
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN "
+        f"WITH (FORMAT csv, HEADER {str(header).lower()}, ENCODING 'UTF8'{force_null})"
+    )
+    with raw_cursor(statement) as cursor:
+        cursor.copy_expert(statement, file, size=COPY_CHUNK_SIZE)
+        return cursor.rowcount
+
+
+def copy_rows(table, columns, rows):
+    """Bulk load an iterable of tuples into table through COPY."""
+    if not is_postgres():
+        return insert_rows(table, columns, iter(rows))
+    return copy_file(table, columns, RowsReader(rows), header=False)
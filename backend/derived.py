@@ -0,0 +1,233 @@
+from blocking import BlockingStrategy, block_key_sql, normalize_sql, normalized_sql
+from database import execute_sql, existing_columns, quote
+from fastapi_sqlalchemy import db
+from settings import get_settings
+from sqlalchemy import text
+
+# Generated columns need an immutable expression, the text casts of these types are
+IMMUTABLE_TEXT_TYPES = {
+    "text",
+    "character varying",
+    "character",
+    "smallint",
+    "integer",
+    "bigint",
+    "real",
+    "double precision",
+    "numeric",
+    "boolean",
+}
+# ...and dates are spelled out by hand, their text cast depends on DateStyle
+DATE_PART_SQL = "LPAD(EXTRACT({part} FROM {col})::int::text, {width}, '0')"
+
+
+def registry_table(table):
+    return f"{table}_derived"
+
+
+def text_sql(col, data_type=None):
+    """Immutable text of col, the ISO spelling of a date like its text cast under the default DateStyle."""
+    if data_type != "date":
+        return col
+    parts = [DATE_PART_SQL.format(part=part, col=col, width=width) for part, width in (("YEAR", 4), ("MONTH", 2), ("DAY", 2))]
+    return "(" + " || '-' || ".join(parts) + ")"
+
+
+def derived_columns(columns, blocking, types=None):
+    """Generated column name -> (source column, expression) needed for a grouping run."""
+    types = types or {}
+    derived = {f"normalized_{col}": (col, normalize_sql(text_sql(quote(col), types.get(col)))) for col in columns}
+    if blocking == BlockingStrategy.DMETAPHONE:
+        for col in columns:
+            derived[f"dmetaphone_{col}"] = (
+                col,
+                block_key_sql(normalize_sql(text_sql(quote(col), types.get(col))), blocking),
+            )
+    return derived
+
+
+def drop_column_derived(table, column):
+    """Drop the generated columns computed from column, ahead of a change of its type."""
+    registry = registry_table(table)
+    names = [f"normalized_{column}", f"dmetaphone_{column}"]
+    for name in names:
+        execute_sql(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {quote(name)};")
+    exists = db.session.execute(text("SELECT to_regclass(:registry);"), {"registry": registry}).scalar()
+    if exists is not None:
+        # Indexes over the columns went with them
+        db.session.execute(
+            text(
+                f"""
+                DELETE FROM {registry}
+                WHERE name = ANY(:names)
+                    OR (kind = 'index' AND name NOT IN (SELECT indexname FROM pg_indexes WHERE tablename = :table));
+                """
+            ),
+            {"names": names, "table": table},
+        )
+
+
+def derived_indexes(table, columns, blocking):
+    """Index name -> CREATE INDEX statement over the generated columns."""
+    if blocking == BlockingStrategy.TRIGRAM:
+        method = get_settings().TRIGRAM_INDEX_METHOD
+        return {
+            f"idx_{table}_trgm_{method}_{col}": f"CREATE INDEX {quote(f'idx_{table}_trgm_{method}_{col}')} "
+            f"ON {table} USING {method} ({normalized_sql(col)} {method}_trgm_ops);"
+            for col in columns
+        }
+    if blocking == BlockingStrategy.SORTED_NEIGHBOURHOOD:
+        return {
+            f"idx_{table}_normalized_{col}": f"CREATE INDEX {quote(f'idx_{table}_normalized_{col}')} "
+            f"ON {table} ({normalized_sql(col)}, client_id);"
+            for col in columns
+        }
+    return {}
+
+
+def persist_derived(table, columns, blocking):
+    """Add missing generated columns and indexes for a run, returns the names of those in use.
+
+    Postgres keeps generated columns up to date on every COPY, so repeated runs and
+    appended batches never recompute them. Columns whose type has no immutable text
+    cast are left out and normalized inline by the caller.
+    """
+    registry = registry_table(table)
+    db.session.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {registry} (
+                name TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                definition TEXT NOT NULL,
+                last_used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+    )
+    registered = dict(db.session.execute(text(f"SELECT name, definition FROM {registry};")).all())
+    # Base type names, without the length of character varying(n) and the like
+    types = {column: data_type.split("(")[0] for column, (data_type, _) in existing_columns(table).items()}
+
+    wanted = {}
+    for name, (col, expression) in derived_columns(columns, blocking, types).items():
+        if types.get(col) in IMMUTABLE_TEXT_TYPES or types.get(col) == "date":
+            wanted[name] = ("column", f"TEXT GENERATED ALWAYS AS ({expression}) STORED")
+    # Every persisted column gets its index, the others are normalized inline where no index applies
+    for col in columns:
+        if f"normalized_{col}" in wanted:
+            for name, statement in derived_indexes(table, [col], blocking).items():
+                wanted[name] = ("index", statement)
+
+    changed = False
+    for name, (kind, definition) in wanted.items():
+        if registered.get(name) == definition:
+            continue
+        changed = True
+        # Unregistered leftovers and outdated definitions are rebuilt from scratch
+        if kind == "column":
+            execute_sql(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {quote(name)};")
+            execute_sql(f"ALTER TABLE {table} ADD COLUMN {quote(name)} {definition};")
+        else:
+            execute_sql(f"DROP INDEX IF EXISTS {quote(name)};")
+            execute_sql(definition)
+        db.session.execute(
+            text(
+                f"""
+                INSERT INTO {registry} (name, kind, definition) VALUES (:name, :kind, :definition)
+                ON CONFLICT (name) DO UPDATE SET kind = EXCLUDED.kind, definition = EXCLUDED.definition;
+                """
+            ),
+            {"name": name, "kind": kind, "definition": definition},
+        )
+    if changed:
+        # Statistics of the new columns keep the scoring join off nested loops
+        db.session.execute(text(f"ANALYZE {table};"))
+    if wanted:
+        db.session.execute(
+            text(f"UPDATE {registry} SET last_used_at = CURRENT_TIMESTAMP WHERE name = ANY(:names);"),
+            {"names": list(wanted)},
+        )
+    return set(wanted)
+
+
+def drop_stale_derived(table, in_use=()):
+    """Drop generated columns and indexes unused for DERIVED_TTL_DAYS, and unregistered indexes.
+
+    Unregistered idx_<table>_* indexes are left over from runs before the registry,
+    the per-column-set btree indexes among them were never used by the scoring.
+    """
+    registry = registry_table(table)
+    stale = db.session.execute(
+        text(
+            f"""
+            SELECT name, kind FROM {registry}
+            WHERE last_used_at < CURRENT_TIMESTAMP - make_interval(days => :days)
+                AND name <> ALL(:in_use);
+            """
+        ),
+        {"days": get_settings().DERIVED_TTL_DAYS, "in_use": list(in_use)},
+    ).all()
+    leftovers = db.session.execute(
+        text(
+            f"""
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = :table
+                AND starts_with(indexname, :prefix)
+                AND indexname <> :client_id_index
+                AND indexname NOT IN (SELECT name FROM {registry});
+            """
+        ),
+        {
+            "table": table,
+            "prefix": f"idx_{table}_",
+            "client_id_index": f"idx_{table}_client_id",
+        },
+    ).scalars().all()
+
+    # Indexes go first, dropping a column would take its indexes along silently
+    for name, kind in sorted(stale, key=lambda item: item[1] != "index"):
+        if kind == "index":
+            execute_sql(f"DROP INDEX IF EXISTS {quote(name)};")
+        else:
+            execute_sql(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {quote(name)};")
+    for name in leftovers:
+        execute_sql(f"DROP INDEX IF EXISTS {quote(name)};")
+    if stale:
+        db.session.execute(
+            text(f"DELETE FROM {registry} WHERE name = ANY(:names);"), {"names": [name for name, _ in stale]}
+        )
+    return [name for name, _ in stale] + leftovers
+
+
+def grouped_source_sql(table, sample="", groups=None):
+    """(group_id expression, FROM clause) of table, group ids joined from the groups (client_id, group_id) relation.
+
+    sample is a clause like database.sample_sql put after the table name, the
+    filtering SQLite one only works without groups.
+    """
+    if groups is None:
+        return "CAST(NULL AS INTEGER)", f"{table} {sample}"
+    return "g.group_id", f"{table} {sample} LEFT JOIN {groups} g ON g.client_id = {table}.client_id"
+
+
+def records_sql(table, columns, blocking, grouped_batch, persisted=(), sample="", groups=None):
+    """Subquery with client_id, group_id, is_new and the normalized_/dmetaphone_ values of table.
+
+    Persisted columns are read as they are, the others are computed inline.
+    Without groups, for full runs and samples, group_id is NULL, see grouped_source_sql.
+    """
+    selected = [
+        quote(name) if name in persisted else f"{expression} AS {quote(name)}"
+        for name, (_, expression) in derived_columns(columns, blocking).items()
+    ]
+    group_id, source = grouped_source_sql(table, sample, groups)
+    return f"""(
+                SELECT
+                    {table}.client_id,
+                    {group_id} AS group_id,
+                    COALESCE({table}.batch_id, 0) > {grouped_batch} AS is_new,
+                    {', '.join(selected)}
+                FROM
+                    {source}
+            )"""
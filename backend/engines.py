@@ -0,0 +1,484 @@
+import re
+from collections import Counter
+from functools import partial
+
+import numpy
+from blocking import (
+    DEFAULT_WINDOW,
+    LEVENSHTEIN_MAX_DISTANCE,
+    QGRAM_LENGTH,
+    TRANSLIT_FROM,
+    TRANSLIT_TO,
+    BlockingStrategy,
+)
+from jobs import report_progress
+from scoring import SCORE_EPSILON, Comparator, day_number
+from settings import get_settings
+
+SCORE_BATCH_SIZE = 50_000
+# Blocks up to this many rows yield all their pairs at once, larger ones a row at a time
+TRIANGLE_BLOCK_ROWS = 256
+# Trigrams shared by more rows than this carry no signal, the neighbour search skips them
+MAX_TRIGRAM_POSTINGS = 1_000
+PHONETIC_KEY_LENGTH = 4
+
+TRANSLIT = str.maketrans(TRANSLIT_FROM, TRANSLIT_TO)
+NOT_LETTERS = re.compile("[^a-z]")
+VOWELS = re.compile("[aeiouy]")
+REPEATS = re.compile(r"(.)\1+")
+# Padding codes differ between the two sides so they never count as equal characters
+PAD_FIRST = numpy.uint32(0xFFFFFFFF)
+PAD_SECOND = numpy.uint32(0xFFFFFFFE)
+
+
+def normalize(value):
+    """Same as normalize_sql: no spaces or dashes, lower case, NULL as empty string."""
+    if value is None:
+        return ""
+    return str(value).replace(" ", "").replace("-", "").lower()
+
+
+def phonetic_key(value):
+    """Consonant skeleton of the transliterated value, stands in for dmetaphone."""
+    latin = NOT_LETTERS.sub("", value.translate(TRANSLIT))
+    skeleton = REPEATS.sub(r"\1", latin[:1] + VOWELS.sub("", latin[1:]))
+    return skeleton[:PHONETIC_KEY_LENGTH].upper()
+
+
+def trigrams(value):
+    """pg_trgm style trigrams of a single word, padded with two spaces in front and one after."""
+    padded = f"  {value} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def batched(pairs, size):
+    """Regroup (first, second) array pairs into batches of size pairs, the last one smaller."""
+    pending, count = [], 0
+    for first, second in pairs:
+        pending.append((first, second))
+        count += len(first)
+        if count < size:
+            continue
+        first, second = (numpy.concatenate(arrays) for arrays in zip(*pending))
+        full = count - count % size
+        for start in range(0, full, size):
+            yield first[start : start + size], second[start : start + size]
+        pending, count = [(first[full:], second[full:])], count - full
+    if count:
+        yield tuple(numpy.concatenate(arrays) for arrays in zip(*pending))
+
+
+class ColumnData:
+    """Normalized values of one column as a flat uint32 code array with offsets."""
+
+    def __init__(self, values):
+        self.values = values
+        self.lengths = numpy.fromiter(map(len, values), dtype=numpy.int64, count=len(values))
+        self.offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.lengths, out=self.offsets[1:])
+        self.codes = numpy.frombuffer("".join(values).encode("utf-32-le"), dtype=numpy.uint32)
+        self._trigrams = {}
+        self._value_ids = None
+        self._day_numbers = None
+
+    def padded(self, rows, width, pad):
+        """(len(rows), width) matrix of character codes, short values filled with pad."""
+        positions = numpy.arange(width)
+        inside = positions < self.lengths[rows][:, None]
+        if not len(self.codes):
+            return numpy.full(inside.shape, pad, dtype=numpy.uint32)
+        indices = numpy.minimum(self.offsets[rows][:, None] + positions, len(self.codes) - 1)
+        return numpy.where(inside, self.codes[indices], pad)
+
+    def trigrams(self, row):
+        cached = self._trigrams.get(row)
+        if cached is None:
+            cached = self._trigrams[row] = trigrams(self.values[row])
+        return cached
+
+    def similarity(self, first, second):
+        first_trigrams, second_trigrams = self.trigrams(first), self.trigrams(second)
+        common = len(first_trigrams & second_trigrams)
+        return common / (len(first_trigrams) + len(second_trigrams) - common)
+
+    @property
+    def value_ids(self):
+        """Equal values share an id, for vectorized exact comparison."""
+        if self._value_ids is None:
+            ids = {}
+            self._value_ids = numpy.fromiter(
+                (ids.setdefault(value, len(ids)) for value in self.values), dtype=numpy.int64, count=len(self.values)
+            )
+        return self._value_ids
+
+    @property
+    def day_numbers(self):
+        """day_number of every value, NaN where it holds no date."""
+        if self._day_numbers is None:
+            days = (day_number(value) for value in self.values)
+            self._day_numbers = numpy.fromiter(
+                (numpy.nan if day is None else day for day in days), dtype=numpy.float64, count=len(self.values)
+            )
+        return self._day_numbers
+
+
+def levenshtein_within(first, second, limit=LEVENSHTEIN_MAX_DISTANCE):
+    """Vectorized levenshtein(first[i], second[i]) <= limit over two padded batches.
+
+    Only the 2 * limit + 1 diagonals around the main one are computed, cells saturate
+    at limit + 1 and a pair leaves the batch as soon as its whole band exceeds limit.
+    Pairs must already pass the length filter, so their end cell lies inside the band.
+    """
+    over = limit + 1
+    diagonals = numpy.arange(-limit, limit + 1)
+    first_lengths, second_lengths = first.lengths, second.lengths
+    ends = second_lengths - first_lengths + limit
+    matched = (first_lengths == 0) & (second_lengths <= limit)
+    active = numpy.flatnonzero(first_lengths > 0)
+    band = numpy.broadcast_to(
+        numpy.where(diagonals >= 0, numpy.minimum(diagonals, over), over).astype(numpy.int8),
+        (len(active), len(diagonals)),
+    ).copy()
+    second_width = second.matrix.shape[1]
+    for row in range(1, first.matrix.shape[1] + 1):
+        if not len(active):
+            break
+        chars = first.matrix[active, row - 1]
+        current = numpy.full_like(band, over)
+        for position, diagonal in enumerate(diagonals):
+            column = row + diagonal
+            if column < 0 or column > second_width:
+                continue
+            if column == 0:
+                current[:, position] = min(row, over)
+                continue
+            # Diagonal neighbour keeps its band position, the upper one shifts right
+            best = band[:, position] + (chars != second.matrix[active, column - 1])
+            if position + 1 < len(diagonals):
+                numpy.minimum(best, band[:, position + 1] + 1, out=best)
+            if position > 0:
+                numpy.minimum(best, current[:, position - 1] + 1, out=best)
+            numpy.minimum(best, over, out=current[:, position])
+        ended = first_lengths[active] == row
+        matched[active[ended]] = current[ended, ends[active[ended]]] <= limit
+        alive = ~ended & (current.min(axis=1) <= limit)
+        active, band = active[alive], current[alive]
+    return matched
+
+
+class PaddedBatch:
+    def __init__(self, column, rows, pad):
+        self.lengths = column.lengths[rows]
+        self.matrix = column.padded(rows, int(self.lengths.max(initial=0)), pad)
+
+
+class InMemoryMatcher:
+    """In-process counterpart of the SQL scoring, for SQLite and datasets that fit in memory.
+
+    Rows are loaded once from (client_id, group_id, is_new, *columns) tuples, candidate
+    pairs come from the same blocking strategies and are scored with the same rules:
+    levenshtein <= 2 or substring containment (trigram similarity in trigram mode),
+    or the weighted comparators of rules when given.
+    """
+
+    def __init__(self, columns, blocking=BlockingStrategy.DMETAPHONE, window=DEFAULT_WINDOW, rules=None):
+        self.columns = columns
+        self.blocking = blocking
+        self.window = window
+        self.rules = rules
+        self.threshold = get_settings().TRIGRAM_SIMILARITY_THRESHOLD
+        self.candidates = 0
+
+    def load(self, rows):
+        client_ids, group_ids, is_new, values = [], [], [], [[] for _ in self.columns]
+        for client_id, group_id, new, *row in rows:
+            client_ids.append(client_id)
+            group_ids.append(group_id)
+            is_new.append(bool(new))
+            for column_values, value in zip(values, row):
+                column_values.append(normalize(value))
+        self.client_ids = client_ids
+        self.group_ids = group_ids
+        self.is_new = numpy.array(is_new, dtype=bool)
+        self.data = [ColumnData(column_values) for column_values in values]
+        return len(client_ids)
+
+    def _block_ids(self, column):
+        """Block of every row under qgram or dmetaphone blocking, -1 for rows without a key."""
+        ids = {}
+        keys = dict(self._block_keys(column))
+        return numpy.fromiter(
+            (ids.setdefault(keys[row], len(ids)) if row in keys else -1 for row in range(len(column.values))),
+            dtype=numpy.int64,
+            count=len(column.values),
+        )
+
+    def _block_pairs(self, block_ids, probes=None):
+        """Yield pairs of rows sharing a block, a block at a time and large ones a row at a time.
+
+        With probes only blocks holding a probe row are visited and large ones only from those rows.
+        """
+        keyed = block_ids >= 0
+        if probes is not None:
+            keyed &= numpy.isin(block_ids, block_ids[probes & keyed])
+        keyed = numpy.flatnonzero(keyed)
+        order = keyed[numpy.argsort(block_ids[keyed], kind="stable")]
+        bounds = numpy.flatnonzero(numpy.diff(block_ids[order])) + 1
+        for rows in numpy.split(order, bounds):
+            if len(rows) < 2:
+                continue
+            if len(rows) <= TRIANGLE_BLOCK_ROWS:
+                i, j = numpy.triu_indices(len(rows), k=1)
+                yield rows[i], rows[j]
+                continue
+            # A triangle of a large block would take memory quadratic in its rows
+            if probes is None:
+                for position in range(len(rows) - 1):
+                    yield numpy.full(len(rows) - position - 1, rows[position]), rows[position + 1 :]
+                continue
+            probed = probes[rows]
+            for position in numpy.flatnonzero(probed):
+                # Earlier probe rows already paired up with this one
+                others = numpy.concatenate([rows[:position][~probed[:position]], rows[position + 1 :]])
+                yield numpy.full(len(others), rows[position]), others
+
+    def _sorted_positions(self, column):
+        """Position of every row in the value order of column, -1 for empty values."""
+        values = column.values
+        order = numpy.array(
+            sorted((row for row, value in enumerate(values) if value), key=values.__getitem__), dtype=numpy.int64
+        )
+        positions = numpy.full(len(values), -1, dtype=numpy.int64)
+        positions[order] = numpy.arange(len(order))
+        return order, positions
+
+    def _neighbourhood_pairs(self, order, probes=None):
+        """Yield pairs of rows less than window apart in order, SCORE_BATCH_SIZE at a time.
+
+        With probes only the neighbourhoods of probe rows are visited.
+        """
+        if probes is None:
+            for distance in range(1, self.window):
+                for start in range(0, len(order) - distance, SCORE_BATCH_SIZE):
+                    end = min(start + SCORE_BATCH_SIZE, len(order) - distance)
+                    yield order[start:end], order[start + distance : end + distance]
+            return
+        probed = numpy.flatnonzero(probes[order])
+        for distance in range(1, self.window):
+            for start in range(0, len(probed), SCORE_BATCH_SIZE):
+                positions = probed[start : start + SCORE_BATCH_SIZE]
+                ahead = positions[positions + distance < len(order)]
+                yield order[ahead], order[ahead + distance]
+                # A probe row behind pairs with this one when probing ahead
+                behind = positions[positions >= distance]
+                behind = behind[~probes[order[behind - distance]]]
+                yield order[behind - distance], order[behind]
+
+    def _block_keys(self, column):
+        """(row, key) of every non-empty value under qgram or dmetaphone blocking."""
+        if self.blocking == BlockingStrategy.QGRAM:
+            return ((row, value[:QGRAM_LENGTH]) for row, value in enumerate(column.values) if value)
+        return ((row, key) for row, value in enumerate(column.values) if value and (key := phonetic_key(value)))
+
+    def block_sizes(self):
+        """Column name -> rows per block key, empty for the window based strategies."""
+        if self.blocking in (BlockingStrategy.SORTED_NEIGHBOURHOOD, BlockingStrategy.TRIGRAM):
+            return {}
+        return {
+            name: list(Counter(key for _, key in self._block_keys(column)).values())
+            for name, column in zip(self.columns, self.data)
+        }
+
+    def _trigram_neighbours(self, column, probes=None):
+        """(rows, window) matrix of the most similar rows above the similarity threshold, -1 padded.
+
+        Same neighbours as the KNN lateral join, at most window of them per row and only
+        for probe rows when given.
+        """
+        postings = {}
+        for row, value in enumerate(column.values):
+            if value:
+                for trigram in column.trigrams(row):
+                    postings.setdefault(trigram, []).append(row)
+        postings = {
+            trigram: numpy.array(rows, dtype=numpy.int64)
+            for trigram, rows in postings.items()
+            if len(rows) <= MAX_TRIGRAM_POSTINGS
+        }
+        sizes = numpy.fromiter(
+            (len(column.trigrams(row)) if value else 0 for row, value in enumerate(column.values)),
+            dtype=numpy.int64,
+            count=len(column.values),
+        )
+        neighbours = numpy.full((len(column.values), self.window), -1, dtype=numpy.int64)
+        rows = range(len(column.values)) if probes is None else numpy.flatnonzero(probes).tolist()
+        for row in rows:
+            value = column.values[row]
+            shared = [postings[trigram] for trigram in column.trigrams(row) if trigram in postings] if value else []
+            if not shared:
+                continue
+            others, common = numpy.unique(numpy.concatenate(shared), return_counts=True)
+            similarity = common / (sizes[row] + sizes[others] - common)
+            keep = (others != row) & (similarity >= self.threshold)
+            others, similarity = others[keep], similarity[keep]
+            nearest = others[numpy.argsort(-similarity, kind="stable")[: self.window]]
+            neighbours[row, : len(nearest)] = nearest
+        return neighbours
+
+    def _neighbour_pairs(self, neighbours, probes=None):
+        """Yield (row, neighbour) pairs of a neighbour matrix, mutual neighbours once."""
+        probed = numpy.arange(len(neighbours)) if probes is None else numpy.flatnonzero(probes)
+        step = max(SCORE_BATCH_SIZE // self.window, 1)
+        for start in range(0, len(probed), step):
+            rows = probed[start : start + step]
+            first = numpy.repeat(rows, self.window)
+            second = neighbours[rows].ravel()
+            found = second >= 0
+            first, second = first[found], second[found]
+            # The smaller row of a mutual pair yields it
+            mutual = (neighbours[second] == first[:, None]).any(axis=1) & (second < first)
+            yield first[~mutual], second[~mutual]
+
+    def _column_blocking(self, column, probes=None):
+        """(pairs of column, covers) where covers tells which row pairs column blocks together.
+
+        With probes, a mask of rows, only pairs with a probe row are generated, like the SQL
+        incremental mode. Trigram neighbours are then those of the probe rows only.
+        """
+        if self.blocking == BlockingStrategy.SORTED_NEIGHBOURHOOD:
+            order, positions = self._sorted_positions(column)
+
+            def covers(first, second):
+                a, b = positions[first], positions[second]
+                return (a >= 0) & (b >= 0) & (numpy.abs(a - b) < self.window)
+
+            return self._neighbourhood_pairs(order, probes), covers
+        if self.blocking == BlockingStrategy.TRIGRAM:
+            neighbours = self._trigram_neighbours(column, probes)
+
+            def covers(first, second):
+                return (neighbours[first] == second[:, None]).any(axis=1) | (
+                    neighbours[second] == first[:, None]
+                ).any(axis=1)
+
+            return self._neighbour_pairs(neighbours, probes), covers
+        block_ids = self._block_ids(column)
+
+        def covers(first, second):
+            return (block_ids[first] >= 0) & (block_ids[first] == block_ids[second])
+
+        return self._block_pairs(block_ids, probes), covers
+
+    def candidate_pairs(self, incremental=False):
+        """Yield batches of unique (first, second) row index arrays with first < second.
+
+        Pairs are generated block by block and a pair that several columns block together
+        comes from the first of them only, so no more than a batch of pairs is held at once.
+        With incremental=True only new rows are probed, so the work scales with the delta.
+        """
+        probes = self.is_new if incremental else None
+        earlier = []
+        for column in self.data:
+            pairs, covers = self._column_blocking(column, probes)
+            for first, second in batched(pairs, SCORE_BATCH_SIZE):
+                first, second = numpy.minimum(first, second), numpy.maximum(first, second)
+                keep = numpy.ones(len(first), dtype=bool)
+                for covered in earlier:
+                    keep &= ~covered(first, second)
+                if incremental:
+                    # Small blocks of a new row are expanded whole
+                    keep &= self.is_new[first] | self.is_new[second]
+                if keep.any():
+                    yield first[keep], second[keep]
+            earlier.append(covers)
+
+    def _similar(self, column, first, second):
+        a, b = column.values[first], column.values[second]
+        # Empty values never match, '' is contained in everything
+        if not a or not b:
+            return False
+        if self.blocking == BlockingStrategy.TRIGRAM:
+            return column.similarity(first, second) >= self.threshold
+        return a in b or b in a
+
+    def _agrees(self, rule, column, first, second):
+        """Whether rule's comparator holds for every (first, second) row pair, same as agrees_sql."""
+        present = (column.lengths[first] > 0) & (column.lengths[second] > 0)
+        if rule.comparator == Comparator.EXACT:
+            return present & (column.value_ids[first] == column.value_ids[second])
+        if rule.comparator == Comparator.DATE:
+            with numpy.errstate(invalid="ignore"):
+                return present & (numpy.abs(column.day_numbers[first] - column.day_numbers[second]) <= rule.tolerance_days)
+        agrees = numpy.zeros(len(first), dtype=bool)
+        if rule.comparator == Comparator.LEVENSHTEIN:
+            close = numpy.flatnonzero(
+                present & (numpy.abs(column.lengths[first] - column.lengths[second]) <= rule.max_distance)
+            )
+            if len(close):
+                agrees[close] = levenshtein_within(
+                    PaddedBatch(column, first[close], PAD_FIRST),
+                    PaddedBatch(column, second[close], PAD_SECOND),
+                    rule.max_distance,
+                )
+            return agrees
+        threshold = self.rules.similarity(rule)
+        for position in numpy.flatnonzero(present).tolist():
+            agrees[position] = column.similarity(int(first[position]), int(second[position])) >= threshold
+        return agrees
+
+    def _scores(self, first, second):
+        """Weighted rule matching, a pair leaves once it can no longer reach or already reached the threshold."""
+        threshold = self.rules.threshold - SCORE_EPSILON
+        ordered = self.rules.ordered()
+        remaining = sum(rule.weight for rule in ordered)
+        scores = numpy.zeros(len(first))
+        pending = numpy.arange(len(first))
+        for rule in ordered:
+            remaining -= rule.weight
+            column = self.data[self.columns.index(rule.column)]
+            agrees = self._agrees(rule, column, first[pending], second[pending])
+            scores[pending] += rule.weight * agrees
+            left = scores[pending]
+            pending = pending[(left < threshold) & (left + remaining >= threshold)]
+            if not len(pending):
+                break
+        return scores >= threshold
+
+    def _matches(self, first, second):
+        if self.rules is not None:
+            return self._scores(first, second)
+        matched = numpy.zeros(len(first), dtype=bool)
+        for column in self.data:
+            pending = numpy.flatnonzero(~matched)
+            if not len(pending):
+                break
+            i, j = first[pending], second[pending]
+            close = (
+                (column.lengths[i] > 0)
+                & (column.lengths[j] > 0)
+                & (numpy.abs(column.lengths[i] - column.lengths[j]) <= LEVENSHTEIN_MAX_DISTANCE)
+            )
+            if close.any():
+                matched[pending[close]] = levenshtein_within(
+                    PaddedBatch(column, i[close], PAD_FIRST),
+                    PaddedBatch(column, j[close], PAD_SECOND),
+                )
+        for column in self.data:
+            pending = numpy.flatnonzero(~matched)
+            if not len(pending):
+                break
+            matched[pending] = list(
+                map(partial(self._similar, column), first[pending].tolist(), second[pending].tolist())
+            )
+        return matched
+
+    def matched_pairs(self, incremental=False):
+        """Yield (client_id_1, group_id_1, client_id_2, group_id_2) for every matching candidate."""
+        self.candidates = 0
+        client_ids, group_ids = self.client_ids, self.group_ids
+        for i, j in batched(self.candidate_pairs(incremental), SCORE_BATCH_SIZE):
+            self.candidates += len(i)
+            report_progress(candidate_pairs=self.candidates)
+            matched = self._matches(i, j)
+            for a, b in zip(i[matched].tolist(), j[matched].tolist()):
+                yield client_ids[a], group_ids[a], client_ids[b], group_ids[b]
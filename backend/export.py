@@ -0,0 +1,74 @@
+from enum import Enum
+
+from database import ChunkSink, quote, stream_rows
+
+EXPORT_BATCH_ROWS = 64_000
+
+
+class ExportSource(str, Enum):
+    FUZZY = "fuzzy"
+    GOLDEN = "golden"
+
+
+def arrow_type(data_type):
+    """Arrow type for a column type name as reported by information_schema or the inspector."""
+    import pyarrow
+
+    data_type = data_type.lower()
+    if data_type == "boolean":
+        return pyarrow.bool_()
+    if data_type == "smallint":
+        return pyarrow.int16()
+    if data_type in ("integer", "bigint"):
+        # SQLite integers are 64 bit whatever the declared type
+        return pyarrow.int64()
+    if data_type == "real":
+        return pyarrow.float32()
+    if data_type in ("double precision", "float"):
+        return pyarrow.float64()
+    if data_type == "date":
+        return pyarrow.date32()
+    if data_type.startswith("timestamp"):
+        return pyarrow.timestamp("us", tz="UTC" if "with time zone" in data_type else None)
+    # numeric included, its precision is per value and survives as text
+    return pyarrow.string()
+
+
+def record_batch(schema, rows):
+    import pyarrow
+
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        try:
+            array = pyarrow.array(values, type=field.type)
+        except (pyarrow.ArrowTypeError, pyarrow.ArrowInvalid):
+            # Drivers without type conversion (sqlite3 for dates) hand out text, Arrow parses it
+            text = pyarrow.array([value if value is None else str(value) for value in values], type=pyarrow.string())
+            array = text if field.type == pyarrow.string() else text.cast(field.type)
+        arrays.append(array)
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def parquet_chunks(engine, table, headers, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield table, or a subquery with an alias, as a Parquet file in pieces, one row group per batch_rows rows.
+
+    Rows come through a server-side cursor on a connection of its own, the writer
+    flushes every row group into a sink that is drained after each batch.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([(header["column_name"], arrow_type(header["data_type"])) for header in headers])
+    query = f"SELECT {', '.join(quote(field.name) for field in schema)} FROM {table}"
+    sink = ChunkSink()
+    with engine.connect() as connection, pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        rows = []
+        for row in stream_rows(query, batch_size=batch_rows, connection=connection):
+            rows.append(row)
+            if len(rows) == batch_rows:
+                writer.write_batch(record_batch(schema, rows))
+                rows = []
+                yield sink.drain()
+        if rows:
+            writer.write_batch(record_batch(schema, rows))
+    yield sink.drain()
@@ -0,0 +1,270 @@
+import csv
+import hashlib
+import os
+import tempfile
+from contextlib import suppress
+from enum import Enum
+
+from clustering import create_group_tables, drop_group_tables
+from database import COPY_CHUNK_SIZE, ChunksReader, copy_file, execute_sql, insert_rows, is_postgres, quote
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi_sqlalchemy import db
+from settings import get_settings
+from sqlalchemy import inspect, text
+
+ARROW_BATCH_ROWS = 64_000
+
+
+def enum_type(table, column):
+    """Name of the enum type of a categorical column, hashed since column names can be long."""
+    return f"{table}_enum_{hashlib.md5(column.encode()).hexdigest()[:8]}"
+
+
+class FileFormat(str, Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+    ARROW = "arrow"
+    ARROW_STREAM = "arrow_stream"
+
+
+def detect_format(file):
+    """Guess the upload format from its magic bytes, anything unrecognized is CSV."""
+    position = file.tell()
+    head = file.read(8)
+    file.seek(position)
+    if head.startswith(b"PAR1"):
+        return FileFormat.PARQUET
+    if head.startswith(b"ARROW1"):
+        return FileFormat.ARROW
+    # IPC streams open with a schema message behind the 0xFFFFFFFF continuation marker
+    if head.startswith(b"\xff\xff\xff\xff"):
+        return FileFormat.ARROW_STREAM
+    return FileFormat.CSV
+
+
+def unreadable_file_errors():
+    """Exceptions raised for malformed uploads, pyarrow is only imported once one occurs."""
+    import pyarrow
+
+    return (csv.Error, UnicodeDecodeError, pyarrow.ArrowException)
+
+
+def budget_rows(bytes_per_row):
+    """Rows per record batch that keep a batch and its CSV rendering within MEMORY_BUDGET_BYTES."""
+    budget = get_settings().MEMORY_BUDGET_BYTES
+    return int(max(1, min(ARROW_BATCH_ROWS, budget // max(1, 2 * bytes_per_row))))
+
+
+def open_arrow(path):
+    """Memory-mapped Parquet or Arrow IPC file, pages are read on demand instead of copied."""
+    import pyarrow
+
+    return pyarrow.memory_map(path, "r")
+
+
+def arrow_reader(file, file_format):
+    """(schema, record batch iterator) of a Parquet or Arrow IPC file object."""
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    if file_format == FileFormat.PARQUET:
+        parquet = pyarrow.parquet.ParquetFile(file)
+        metadata = parquet.metadata
+        row_bytes = sum(metadata.row_group(index).total_byte_size for index in range(metadata.num_row_groups))
+        batch_size = budget_rows(row_bytes / max(1, metadata.num_rows))
+        return parquet.schema_arrow, parquet.iter_batches(batch_size=batch_size)
+    if file_format == FileFormat.ARROW:
+        reader = pyarrow.ipc.open_file(file)
+        return reader.schema, (reader.get_batch(index) for index in range(reader.num_record_batches))
+    reader = pyarrow.ipc.open_stream(file)
+    return reader.schema, iter(reader)
+
+
+def arrow_column_types(schema):
+    """Postgres column types for an Arrow schema, unsupported types are loaded as TEXT."""
+    import pyarrow.types as types
+
+    def postgres_type(arrow_type):
+        if types.is_boolean(arrow_type):
+            return "BOOLEAN"
+        if types.is_integer(arrow_type):
+            return "BIGINT"
+        if types.is_floating(arrow_type):
+            return "DOUBLE PRECISION"
+        if types.is_decimal(arrow_type):
+            return "NUMERIC"
+        if types.is_date(arrow_type):
+            return "DATE"
+        if types.is_timestamp(arrow_type):
+            return "TIMESTAMPTZ" if arrow_type.tz else "TIMESTAMP"
+        return "TEXT"
+
+    return {field.name: postgres_type(field.type) for field in schema}
+
+
+def bounded_batches(batches):
+    """Slice record batches to budget_rows, IPC files keep whatever batch size the writer chose."""
+    for batch in batches:
+        rows = budget_rows(batch.nbytes / max(1, batch.num_rows))
+        for offset in range(0, batch.num_rows, rows):
+            yield batch.slice(offset, rows)
+
+
+def arrow_csv_chunks(batches):
+    """Record batches rendered as header-less CSV by Arrow's own writer."""
+    import pyarrow
+    import pyarrow.csv
+
+    options = pyarrow.csv.WriteOptions(include_header=False)
+    for batch in batches:
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.csv.write_csv(batch, sink, options)
+        yield sink.getvalue().to_pybytes()
+
+
+def copy_batches(table, columns, batches):
+    """Load Arrow record batches into table, through COPY on Postgres."""
+    batches = bounded_batches(batches)
+    if not is_postgres():
+        return insert_rows(
+            table, columns, (tuple(row.values()) for batch in batches for row in batch.to_pylist())
+        )
+    return copy_file(table, columns, ChunksReader(arrow_csv_chunks(batches)), header=False)
+
+
+class IngestMode(str, Enum):
+    REPLACE = "replace"
+    APPEND = "append"
+
+
+def create_table(table, column_types, enums=None):
+    """Create table from scratch, enums maps columns to the labels of their enum type, see enum_type."""
+    columns = ", ".join(f"{quote(column)} {type_}" for column, type_ in column_types.items())
+    db.session.execute(text(f"DROP TABLE IF EXISTS {table};"))
+    db.session.execute(text(f"DROP TABLE IF EXISTS {table}_batches;"))
+    db.session.execute(text(f"DROP TABLE IF EXISTS {table}_derived;"))
+    drop_group_tables(table)
+    if is_postgres():
+        stale = db.session.execute(
+            text("SELECT typname FROM pg_type WHERE typtype = 'e' AND starts_with(typname, :prefix);"),
+            {"prefix": f"{table}_enum_"},
+        ).scalars().all()
+        for name in stale:
+            db.session.execute(text(f"DROP TYPE IF EXISTS {quote(name)};"))
+    for column, labels in (enums or {}).items():
+        values = ", ".join(f":label_{index}" for index in range(len(labels)))
+        db.session.execute(
+            text(f"CREATE TYPE {quote(enum_type(table, column))} AS ENUM ({values});"),
+            {f"label_{index}": label for index, label in enumerate(labels)},
+        )
+    execute_sql(f"CREATE TABLE {table} ({columns});")
+
+
+def prepare_table(table):
+    """Add the batch column, the batches table and the group tables, also to tables ingested earlier."""
+    existing = {column["name"] for column in inspect(db.session.connection()).get_columns(table)}
+    if "batch_id" not in existing:
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN batch_id INTEGER;"))
+    db.session.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table}_batches (
+                batch_id INTEGER PRIMARY KEY,
+                rows BIGINT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                grouped_at TIMESTAMP
+            );
+            """
+        )
+    )
+    create_group_tables(table)
+
+
+def start_batch(table):
+    """Register a new ingest batch, rows copied afterwards are tagged with its id."""
+    batch_id = db.session.execute(
+        text(f"SELECT COALESCE(MAX(batch_id), 0) + 1 FROM {table}_batches;")
+    ).scalar()
+    db.session.execute(text(f"INSERT INTO {table}_batches (batch_id) VALUES ({batch_id});"))
+    if is_postgres():
+        db.session.execute(text(f"ALTER TABLE {table} ALTER COLUMN batch_id SET DEFAULT {batch_id};"))
+    return batch_id
+
+
+def finish_batch(table, batch_id, rows):
+    db.session.execute(
+        text(f"UPDATE {table}_batches SET rows = {rows} WHERE batch_id = {batch_id};")
+    )
+    if is_postgres():
+        db.session.execute(text(f"ALTER TABLE {table} ALTER COLUMN batch_id DROP DEFAULT;"))
+        # Fresh statistics for the planner and for the column statistics of /headers
+        db.session.execute(text(f"ANALYZE {table};"))
+    else:
+        # SQLite cannot alter column defaults, tag the new rows afterwards
+        db.session.execute(text(f"UPDATE {table} SET batch_id = {batch_id} WHERE batch_id IS NULL;"))
+    db.session.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table}_client_id ON {table}(client_id);"))
+
+
+def too_large(limit):
+    return HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+
+
+def copy_bounded(source, target, limit, setting):
+    """shutil.copyfileobj that gives up once more than limit bytes were copied, setting is the limit reported."""
+    copied = 0
+    while chunk := source.read(COPY_CHUNK_SIZE):
+        copied += len(chunk)
+        if copied > limit:
+            raise too_large(setting)
+        target.write(chunk)
+    return copied
+
+
+async def spool_upload(upload: UploadFile, limit, setting):
+    """Copy an upload to a temp file owned by us, (path, size), the request closes its own on return."""
+    spooled = tempfile.NamedTemporaryFile(prefix="upload_", delete=False)
+    try:
+        with spooled:
+            size = await run_in_threadpool(copy_bounded, upload.file, spooled, limit, setting)
+    except BaseException:
+        remove_files([spooled.name])
+        raise
+    return spooled.name, size
+
+
+async def spool_uploads(uploads: list[UploadFile]):
+    """Spool uploads one at a time within MAX_UPLOAD_BYTES each and MAX_REQUEST_BYTES in total.
+
+    The parser already keeps parts over 1 MB on disk, each part is released once
+    copied so at most one extra copy of the largest file exists at a time.
+    """
+    settings = get_settings()
+    declared = sum(upload.size or 0 for upload in uploads)
+    if declared > settings.MAX_REQUEST_BYTES:
+        raise too_large(settings.MAX_REQUEST_BYTES)
+    if any((upload.size or 0) > settings.MAX_UPLOAD_BYTES for upload in uploads):
+        raise too_large(settings.MAX_UPLOAD_BYTES)
+
+    paths, remaining = [], settings.MAX_REQUEST_BYTES
+    try:
+        for upload in uploads:
+            # The 413 names the setting that bounds this file, its own size or what is left of the request
+            if settings.MAX_UPLOAD_BYTES <= remaining:
+                limit, setting = settings.MAX_UPLOAD_BYTES, settings.MAX_UPLOAD_BYTES
+            else:
+                limit, setting = remaining, settings.MAX_REQUEST_BYTES
+            path, size = await spool_upload(upload, limit, setting)
+            paths.append(path)
+            remaining -= size
+            await upload.close()
+    except BaseException:
+        remove_files(paths)
+        raise
+    return paths
+
+
+def remove_files(paths):
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(path)
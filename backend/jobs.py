@@ -0,0 +1,212 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+from typing import Any
+from uuid import uuid4
+
+from custom_logger import job_id, request_id
+from fastapi import HTTPException
+from fastapi_sqlalchemy import db
+from settings import get_settings
+from sqlalchemy import bindparam, text
+
+logger = logging.getLogger("backend")
+settings = get_settings()
+
+JOBS_TABLE = "jobs"
+# Seconds between saves of the progress counters of a running job
+PROGRESS_SAVE_INTERVAL = 1.0
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: JobStatus = JobStatus.PENDING
+    progress: dict[str, Any] = field(default_factory=dict)
+    result: Any = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def as_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{**values, "status": JobStatus(values["status"])})
+
+
+executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job")
+current_job: ContextVar[Job | None] = ContextVar("current_job", default=None)
+
+_jobs: OrderedDict[str, Job] = OrderedDict()
+_futures: dict[str, Future] = {}
+_saved_at: dict[str, float] = {}
+_jobs_lock = threading.Lock()
+_resource_locks: dict[str, threading.Lock] = {}
+_table_ready = False
+
+
+def ensure_jobs_table():
+    global _table_ready
+    if not _table_ready:
+        db.session.execute(text(f"CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (id TEXT PRIMARY KEY, state TEXT NOT NULL);"))
+        _table_ready = True
+
+
+def save_job(job):
+    """Write job to the jobs table, where every server process finds it."""
+    state = json.dumps(job.as_dict(), default=str)
+    with db():
+        ensure_jobs_table()
+        db.session.execute(
+            text(
+                f"""
+                INSERT INTO {JOBS_TABLE} (id, state) VALUES (:id, :state)
+                ON CONFLICT (id) DO UPDATE SET state = EXCLUDED.state;
+                """
+            ),
+            {"id": job.id, "state": state},
+        )
+    _saved_at[job.id] = time.monotonic()
+
+
+@contextmanager
+def resource_lock(name):
+    """Run the block alone among the jobs of every server process that lock name.
+
+    Postgres holds the lock for the other processes, an advisory lock on a
+    connection of its own, since the session may switch connections meanwhile.
+    """
+    with _jobs_lock:
+        lock = _resource_locks.setdefault(name, threading.Lock())
+    with lock:
+        bind = db.session.get_bind()
+        if bind.dialect.name != "postgresql":
+            yield
+            return
+        with bind.connect() as connection:
+            # Waiting for a long job of another process must not hit DB_STATEMENT_TIMEOUT_MS
+            connection.execute(text("SET statement_timeout = 0;"))
+            connection.execute(text("SELECT pg_advisory_lock(hashtext(:name));"), {"name": name})
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(hashtext(:name));"), {"name": name})
+                connection.execute(text("RESET statement_timeout;"))
+
+
+def report_progress(**counters):
+    """Update progress counters of the job running in the current thread, if any."""
+    job = current_job.get()
+    if job is not None:
+        job.progress.update(counters)
+        if time.monotonic() - _saved_at.get(job.id, 0) >= PROGRESS_SAVE_INTERVAL:
+            save_job(job)
+
+
+def get_job(job_id):
+    """Job by id, from the jobs table when another server process runs it."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job
+    with db():
+        ensure_jobs_table()
+        state = db.session.execute(
+            text(f"SELECT state FROM {JOBS_TABLE} WHERE id = :id;"), {"id": job_id}
+        ).scalar()
+    return Job.from_dict(json.loads(state)) if state is not None else None
+
+
+def _forget_finished_jobs():
+    finished = [
+        key for key, job in _jobs.items() if job.status in (JobStatus.DONE, JobStatus.FAILED)
+    ]
+    forgotten = finished[: max(len(_jobs) - settings.JOB_HISTORY_SIZE, 0)]
+    for key in forgotten:
+        del _jobs[key]
+    return forgotten
+
+
+def _run(job, function, args, kwargs, lock, cleanup, request):
+    current_job.set(job)
+    job_id.set(job.id)
+    request_id.set(request)
+    try:
+        with db(), resource_lock(lock) if lock else nullcontext():
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            save_job(job)
+            job.result = function(*args, **kwargs)
+        job.status = JobStatus.DONE
+    except HTTPException as e:
+        # Handlers raise a bare 422 while handling the database error, which tells what went wrong
+        cause = e.__cause__ or e.__context__
+        job.error = str(e.detail) if cause is None else f"{e.detail}: {str(getattr(cause, 'orig', cause)).strip()}"
+        job.status = JobStatus.FAILED
+    except Exception as e:
+        logger.exception(e)
+        job.error = repr(e)
+        job.status = JobStatus.FAILED
+    finally:
+        job.finished_at = time.time()
+        if cleanup is not None:
+            cleanup()
+        save_job(job)
+        _saved_at.pop(job.id, None)
+
+
+def submit_job(kind, function, *args, lock=None, cleanup=None, **kwargs):
+    """Run function in the worker pool; jobs sharing a lock name run one at a time, across server processes too."""
+    job = Job(id=uuid4().hex, kind=kind)
+    save_job(job)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        forgotten = _forget_finished_jobs()
+    if forgotten:
+        with db():
+            db.session.execute(
+                text(f"DELETE FROM {JOBS_TABLE} WHERE id IN :ids;").bindparams(bindparam("ids", expanding=True)),
+                {"ids": forgotten},
+            )
+    future = executor.submit(_run, job, function, args, kwargs, lock, cleanup, request_id.get())
+    _futures[job.id] = future
+
+    def forget(future):
+        _futures.pop(job.id, None)
+        # _run never started, so its cleanup did not run either
+        if future.cancelled() and cleanup is not None:
+            cleanup()
+
+    # Runs right away when the job already finished
+    future.add_done_callback(forget)
+    return job
+
+
+def drain_jobs():
+    """Wait for the running jobs before shutdown, the queued ones fail as nothing is left to run them."""
+    for key, future in list(_futures.items()):
+        if future.cancel():
+            job = get_job(key)
+            job.error = "Server shut down before the job started"
+            job.status = JobStatus.FAILED
+            job.finished_at = time.time()
+            save_job(job)
+    executor.shutdown(wait=True)
@@ -0,0 +1,108 @@
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from database import execute_sql, split_statements
+
+logger = logging.getLogger("backend")
+
+EXPLAIN = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+# EXPLAIN ANALYZE runs these for real, so they can stand in for the statement itself
+EXPLAINABLE = re.compile(r"(SELECT|WITH|INSERT|UPDATE|DELETE|CREATE\s+(TEMP\s+|UNLOGGED\s+)?TABLE\s+\w+\s+AS)\b", re.I)
+
+METRICS = {
+    "stage_seconds_total": ("counter", "Seconds spent in a stage of a run"),
+    "stage_runs_total": ("counter", "Times a stage of a run completed"),
+    "stage_rows_total": ("counter", "Rows produced by a stage of a run"),
+    "stage_last_seconds": ("gauge", "Duration of the latest completion of a stage"),
+    "pairs_considered_total": ("counter", "Candidate pairs scored by grouping runs"),
+    "pairs_matched_total": ("counter", "Candidate pairs matched by grouping runs"),
+    "startup_seconds": ("gauge", "Seconds from the first import of the app to the end of its startup"),
+}
+
+
+class Registry:
+    """Process-wide counters and gauges, rendered in the Prometheus text format.
+
+    Every server process keeps its own, /metrics reports those of the process serving it.
+    """
+
+    def __init__(self, prefix="backend"):
+        self.prefix = prefix
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, name, value, **labels):
+        with self._lock:
+            self._values[name, tuple(sorted(labels.items()))] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name, tuple(sorted(labels.items()))] = value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines += [f"# HELP {self.prefix}_{name} {description}", f"# TYPE {self.prefix}_{name} {kind}"]
+            for (metric, labels), value in values:
+                if metric == name:
+                    selector = ",".join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f"{self.prefix}_{name}{{{selector}}} {value:g}" if selector else f"{self.prefix}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class StageMetrics:
+    """Timings, row counts and optional query plans of the stages of one run."""
+
+    def __init__(self, run, explain=False):
+        self.run = run
+        self.explain = explain
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block as stage name, rows and plans are set on the yielded dict."""
+        record = self.stages.setdefault(name, {"seconds": 0.0, "rows": None})
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - started
+            record["seconds"] = round(record["seconds"] + seconds, 4)
+            registry.add("stage_seconds_total", seconds, run=self.run, stage=name)
+            registry.add("stage_runs_total", 1, run=self.run, stage=name)
+            registry.set("stage_last_seconds", seconds, run=self.run, stage=name)
+            if record["rows"] is not None:
+                registry.add("stage_rows_total", record["rows"], run=self.run, stage=name)
+            logger.info(f"{self.run}: {name} took {seconds:.3f}s, rows: {record['rows']}")
+
+    def execute(self, sql, record):
+        """Execute a generated script, statement by statement under EXPLAIN ANALYZE when plans were asked for."""
+        if not self.explain:
+            execute_sql(sql)
+            return
+        for statement in split_statements(sql):
+            if EXPLAINABLE.match(statement):
+                record.setdefault("plans", []).append(self.plan(statement))
+            else:
+                execute_sql(statement)
+
+    def plan(self, statement):
+        plan = execute_sql(EXPLAIN + statement).scalar()
+        return plan[0] if isinstance(plan, list) else plan
+
+    def count_pairs(self, considered, matched):
+        registry.add("pairs_considered_total", considered, run=self.run)
+        registry.add("pairs_matched_total", matched, run=self.run)
@@ -1,24 +1,165 @@
 from typing import Annotated
 
-from fastapi import APIRouter, File
-from fastapi_pagination import add_pagination
-from utils import create_virtual_table, fuzzy_group, get_table_headers
+from blocking import DEFAULT_WINDOW, BlockingStrategy, MatchingEngine
+from database import read_bind, read_connection
+from export import ExportSource, parquet_chunks
+from fastapi import APIRouter, HTTPException, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from ingest import IngestMode, remove_files, spool_uploads
+from jobs import get_job, submit_job
+from metrics import registry
+from scoring import ScoringRules
+from utils import (
+    GOLDEN_TABLE,
+    GROUP_PAGE_SIZE,
+    TABLE_NAME,
+    build_golden_records,
+    create_virtual_table,
+    estimate_groups,
+    fuzzy_group,
+    get_group_page,
+    get_table_headers,
+    grouped_records_sql,
+    record_columns,
+    stream_groups,
+)
 
 root = APIRouter()
-add_pagination(root)
 
 
 @root.post("/generate")
-async def generate(files: Annotated[list[bytes], File()]):
-    create_virtual_table(files)
-    return {"message": "Database has been successfully generated"}
+async def generate(files: list[UploadFile], mode: IngestMode = IngestMode.REPLACE):
+    paths = await spool_uploads(files)
+    try:
+        # Submitting writes the job to the database, off the event loop like the sync handlers
+        job = await run_in_threadpool(
+            submit_job,
+            "generate",
+            create_virtual_table,
+            paths,
+            mode=mode,
+            lock=TABLE_NAME,
+            cleanup=lambda: remove_files(paths),
+        )
+    except BaseException:
+        remove_files(paths)
+        raise
+    return {"job_id": job.id}
 
 
 @root.get("/headers")
-async def headers():
-    return {"headers": get_table_headers()}
+def headers():
+    with read_connection() as connection:
+        return {"headers": get_table_headers(connection=connection)}
 
 
 @root.post("/groups")
-async def groups(reference_columns: list[str]):
-    return fuzzy_group(reference_columns)
+def groups(
+    reference_columns: list[str] | ScoringRules,
+    blocking: BlockingStrategy = BlockingStrategy.DMETAPHONE,
+    window: Annotated[int, Query(ge=2)] = DEFAULT_WINDOW,
+    incremental: bool = False,
+    parallel: bool = False,
+    engine: MatchingEngine = MatchingEngine.SQL,
+    explain: bool = False,
+):
+    rules = reference_columns if isinstance(reference_columns, ScoringRules) else None
+    job = submit_job(
+        "groups",
+        fuzzy_group,
+        rules.column_names() if rules else reference_columns,
+        blocking=blocking,
+        window=window,
+        incremental=incremental,
+        parallel=parallel,
+        engine=engine,
+        explain=explain,
+        rules=rules,
+        lock=TABLE_NAME,
+    )
+    return {"job_id": job.id}
+
+
+@root.post("/groups/estimate")
+def groups_estimate(
+    reference_columns: list[str] | ScoringRules,
+    blocking: BlockingStrategy = BlockingStrategy.DMETAPHONE,
+    window: Annotated[int, Query(ge=2)] = DEFAULT_WINDOW,
+    engine: MatchingEngine = MatchingEngine.SQL,
+    sample_rows: Annotated[int | None, Query(ge=1)] = None,
+    seed: int | None = None,
+):
+    rules = reference_columns if isinstance(reference_columns, ScoringRules) else None
+    # Nothing is written, so it does not wait for a running /groups job
+    job = submit_job(
+        "estimate",
+        estimate_groups,
+        rules.column_names() if rules else reference_columns,
+        blocking=blocking,
+        window=window,
+        engine=engine,
+        rules=rules,
+        sample_rows=sample_rows,
+        seed=seed,
+    )
+    return {"job_id": job.id}
+
+
+@root.get("/groups")
+def groups_page(
+    after: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=1000)] = GROUP_PAGE_SIZE,
+    min_size: Annotated[int, Query(ge=1)] = 2,
+):
+    with read_connection() as connection:
+        return get_group_page(after=after, limit=limit, min_size=min_size, connection=connection)
+
+
+@root.get("/groups/stream")
+def groups_stream(min_size: Annotated[int, Query(ge=1)] = 2):
+    with read_connection() as connection:
+        columns = record_columns(connection)
+    lines = stream_groups(read_bind(), columns, min_size=min_size)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@root.post("/golden")
+def golden(columns: list[str] | None = None):
+    job = submit_job("golden", build_golden_records, columns, lock=TABLE_NAME)
+    return {"job_id": job.id}
+
+
+@root.get("/export")
+def export(source: ExportSource = ExportSource.FUZZY):
+    table = GOLDEN_TABLE if source == ExportSource.GOLDEN else TABLE_NAME
+    with read_connection() as connection:
+        headers = get_table_headers(table, connection)
+    headers = [header for header in headers if header["column_name"] != "batch_id"]
+    if not headers:
+        raise HTTPException(status_code=404)
+    relation = table
+    if source == ExportSource.FUZZY:
+        # Group ids live in the published run, see clustering.create_group_tables
+        headers = [header for header in headers if header["column_name"] != "group_id"]
+        relation = grouped_records_sql([header["column_name"] for header in headers])
+        headers = [*headers, {"column_name": "group_id", "data_type": "integer"}]
+    return StreamingResponse(
+        parquet_chunks(read_bind(), relation, headers),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": f'attachment; filename="{table}.parquet"'},
+    )
+
+
+@root.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404)
+    return job.as_dict()
+
+
+@root.get("/metrics")
+async def metrics():
+    # Counters of the worker process serving the scrape, they are not summed across WEB_WORKERS
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
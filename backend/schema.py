@@ -0,0 +1,337 @@
+import codecs
+import csv
+import io
+import logging
+import re
+from datetime import date, datetime
+from functools import partial
+
+from clustering import assignments_view, create_group_tables, groups_table
+from database import copy_file, execute_sql, existing_columns, is_postgres, quote
+from derived import drop_column_derived
+from fastapi_sqlalchemy import db
+from ingest import enum_type
+from sqlalchemy import text
+from sqlalchemy.exc import DataError
+
+logger = logging.getLogger("backend")
+
+# Rows read for the schema, shared by all files of an upload
+SAMPLE_ROWS = 10_000
+# The sample comes from this many evenly spaced stretches of every file, not just its head
+SAMPLE_SEGMENTS = 10
+# Text columns with at most this many values become enums, once enough rows were seen
+ENUM_MAX_VALUES = 64
+ENUM_MIN_ROWS = 1_000
+
+COPY_ERROR_CONTEXT = re.compile(r'^COPY [^,]+, line [0-9]+, column (.+?): "(.*)"$', re.S)
+
+INT32_MAX = 2**31 - 1
+INT64_MAX = 2**63 - 1
+
+INTEGER = re.compile(r"[+-]?(0|[1-9][0-9]*)")
+FLOAT = re.compile(r"[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?")
+LEADING_ZERO = re.compile(r"[+-]?0[0-9]")
+TIMESTAMP = re.compile(r"([0-9]{4}-[0-9]{2}-[0-9]{2})[ T]([0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]{1,6})?)?)")
+TIME_ZONE = re.compile(r"(Z|[+-][0-9]{2}(:?[0-9]{2})?)$")
+
+# Kinds a column can hold, mixing two of them gives the wider one, anything else is text
+WIDER_KIND = {
+    frozenset({"integer", "float"}): "float",
+    frozenset({"integer", "numeric"}): "numeric",
+    frozenset({"float", "numeric"}): "numeric",
+    frozenset({"date", "timestamp"}): "timestamp",
+    frozenset({"date", "timestamptz"}): "timestamptz",
+    frozenset({"timestamp", "timestamptz"}): "timestamptz",
+}
+KIND_TYPES = {
+    "boolean": "BOOLEAN",
+    "float": "DOUBLE PRECISION",
+    "numeric": "NUMERIC",
+    "date": "DATE",
+    "timestamp": "TIMESTAMP",
+    "timestamptz": "TIMESTAMPTZ",
+    "text": "TEXT",
+}
+TYPE_KINDS = {
+    "boolean": ("boolean", None),
+    "smallint": ("integer", INT32_MAX),
+    "integer": ("integer", INT32_MAX),
+    "bigint": ("integer", INT64_MAX),
+    "numeric": ("numeric", None),
+    "real": ("float", None),
+    "double precision": ("float", None),
+    "date": ("date", None),
+    "timestamp": ("timestamp", None),
+    "timestamp without time zone": ("timestamp", None),
+    "timestamptz": ("timestamptz", None),
+    "timestamp with time zone": ("timestamptz", None),
+}
+
+
+def value_kind(value):
+    """Narrowest kind Postgres parses a non-empty CSV value as.
+
+    Numbers with leading zeros stay text, they are codes whose zeros matter.
+    """
+    if value.lower() in ("true", "false"):
+        return "boolean"
+    if LEADING_ZERO.match(value):
+        return "text"
+    if INTEGER.fullmatch(value):
+        return "integer"
+    if FLOAT.fullmatch(value):
+        return "float"
+    try:
+        if len(value) == 10:
+            date.fromisoformat(value)
+            return "date"
+        match = TIMESTAMP.match(value)
+        if match:
+            rest = value[match.end():]
+            datetime.fromisoformat(f"{match[1]} {match[2]}")
+            if not rest:
+                return "timestamp"
+            if TIME_ZONE.fullmatch(rest):
+                return "timestamptz"
+    except ValueError:
+        pass
+    return "text"
+
+
+class ColumnProfile:
+    """Kind, integer range and distinct values of the values seen in a column."""
+
+    def __init__(self, kind=None, bound=0):
+        self.kind = kind
+        self.bound = bound
+        self.filled = 0
+        self.values = set()
+
+    @classmethod
+    def of_type(cls, data_type):
+        """Profile of a column that already has data_type, enums and unknown types as text."""
+        kind, bound = TYPE_KINDS.get(data_type.lower().split("(")[0], ("text", 0))
+        return cls(kind, bound or 0)
+
+    def observe(self, value):
+        # Empty values are NULL for COPY, they fit every type
+        if value == "":
+            return
+        kind = value_kind(value)
+        self.kind = self.wider(kind)
+        if kind == "integer":
+            self.bound = max(self.bound, abs(int(value)))
+        self.filled += 1
+        if len(self.values) <= ENUM_MAX_VALUES:
+            self.values.add(value)
+
+    def merge(self, other):
+        if other.kind is not None:
+            self.kind = self.wider(other.kind)
+        self.bound = max(self.bound, other.bound)
+        self.filled += other.filled
+        self.values |= other.values
+        return self
+
+    def wider(self, kind):
+        if self.kind is None or self.kind == kind:
+            return kind
+        return WIDER_KIND.get(frozenset({self.kind, kind}), "text")
+
+    def categorical(self):
+        return self.kind == "text" and self.filled >= ENUM_MIN_ROWS and len(self.values) <= ENUM_MAX_VALUES
+
+    def data_type(self):
+        if self.kind is None:
+            return "TEXT"
+        if self.kind == "integer":
+            if self.bound <= INT32_MAX:
+                return "INTEGER"
+            return "BIGINT" if self.bound <= INT64_MAX else "NUMERIC"
+        return KIND_TYPES[self.kind]
+
+
+def csv_rows(file, start, end, rows):
+    """Up to rows rows of a binary CSV file object that start between the offsets start and end.
+
+    Reading begins at the first line start from start on.
+    """
+    file.seek(start - 1)
+    # Only consumes the newline when a line starts right at start
+    file.readline()
+    reader = csv.reader(line.decode("utf-8") for line in iter(file.readline, b""))
+    count = 0
+    while (rows is None or count < rows) and file.tell() < end:
+        row = next(reader, None)
+        if row is None:
+            return
+        yield row
+        count += 1
+
+
+def csv_profiles(file, rows=SAMPLE_ROWS):
+    """Column name -> profile of rows sampled across a CSV file object, its position is kept.
+
+    The rows come from SAMPLE_SEGMENTS evenly spaced stretches, every row with rows=None.
+    Stretches start on a line start, which is only a row start when values hold no line
+    breaks, so a file with such values in its first rows is sampled from its head alone.
+    """
+    position = file.tell()
+    try:
+        if file.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            file.seek(position)
+        header = next(csv.reader(line.decode("utf-8") for line in iter(file.readline, b"")), [])
+        profiles = {column: ColumnProfile() for column in header}
+        start, end = file.tell(), file.seek(0, io.SEEK_END)
+        stretches = [csv_rows(file, start, end, rows)]
+        if rows:
+            bounds = [start + (end - start) * segment // SAMPLE_SEGMENTS for segment in range(SAMPLE_SEGMENTS + 1)]
+            limits = [rows // SAMPLE_SEGMENTS + (segment < rows % SAMPLE_SEGMENTS) for segment in range(SAMPLE_SEGMENTS)]
+            head = list(csv_rows(file, start, bounds[1], limits[0]))
+            if not any("\n" in value or "\r" in value for row in head for value in row):
+                # Generators, each stretch is only read once the previous one is done
+                stretches = [head, *map(partial(csv_rows, file), bounds[1:-1], bounds[2:], limits[1:])]
+        for index, stretch in enumerate(stretches):
+            try:
+                for row in stretch:
+                    if index and len(row) != len(header):
+                        continue
+                    for profile, value in zip(profiles.values(), row):
+                        profile.observe(value)
+            except csv.Error:
+                # A later stretch that starts inside a quoted value may not parse
+                if not index:
+                    raise
+    finally:
+        file.seek(position)
+    return profiles
+
+
+def csv_header(file):
+    """Column names of a CSV file object, its position is kept."""
+    return list(csv_profiles(file, rows=0))
+
+
+def merge_profiles(profiles, other):
+    """Fold the profiles of another file into profiles, new columns go last."""
+    for column, profile in other.items():
+        if column in profiles:
+            profiles[column].merge(profile)
+        else:
+            profiles[column] = profile
+    return profiles
+
+
+def column_types(table, profiles):
+    """(column types, enum labels) of a new table for profiles, enums only exist on Postgres."""
+    types, enums = {}, {}
+    for column, profile in profiles.items():
+        if profile.categorical() and is_postgres():
+            enums[column] = sorted(profile.values)
+            types[column] = quote(enum_type(table, column))
+        else:
+            types[column] = profile.data_type()
+    return types, enums
+
+
+def widen_column(table, column, data_type):
+    """ALTER column to data_type, dropping what depends on its type first."""
+    logger.info(f"Widening {table}.{column} to {data_type}")
+    # Generated columns and the view block type changes, they are rebuilt on demand
+    drop_column_derived(table, column)
+    if column == "client_id":
+        db.session.execute(text(f"DROP VIEW IF EXISTS {assignments_view(table)};"))
+        db.session.execute(
+            text(f"ALTER TABLE {groups_table(table)} ALTER COLUMN client_id TYPE {data_type} USING client_id::{data_type};")
+        )
+    execute_sql(f"ALTER TABLE {table} ALTER COLUMN {quote(column)} TYPE {data_type} USING {quote(column)}::{data_type};")
+    db.session.execute(text(f"DROP TYPE IF EXISTS {quote(enum_type(table, column))};"))
+    if column == "client_id":
+        create_group_tables(table)
+
+
+def fit_column(table, column, current, profile):
+    """Widen column, or add enum labels, so that values like those of profile load. True when it changed."""
+    data_type, labels = current
+    if labels is not None:
+        missing = {value for value in profile.values if value not in labels}
+        if not missing:
+            return False
+        if len(labels) + len(missing) > ENUM_MAX_VALUES:
+            widen_column(table, column, "TEXT")
+            return True
+        for label in sorted(missing):
+            db.session.execute(
+                text(f"ALTER TYPE {quote(enum_type(table, column))} ADD VALUE IF NOT EXISTS :label;"), {"label": label}
+            )
+        return True
+    base = ColumnProfile.of_type(data_type)
+    wanted = ColumnProfile.of_type(data_type).merge(profile)
+    if (wanted.kind, wanted.bound) == (base.kind, base.bound):
+        return False
+    widen_column(table, column, wanted.data_type())
+    return True
+
+
+def fit_table(table, profiles):
+    """Widen the columns of an existing table the profiled values would not load into. True when one changed."""
+    if not is_postgres():
+        # SQLite stores any value in any column
+        return False
+    current = existing_columns(table)
+    changed = False
+    for column, profile in profiles.items():
+        if column in current:
+            changed |= fit_column(table, column, current[column], profile)
+    return changed
+
+
+def failing_value(error):
+    """(column, value) a COPY data error reports, None for errors about the row layout."""
+    context = getattr(getattr(error.orig, "diag", None), "context", None) or ""
+    match = COPY_ERROR_CONTEXT.search(context)
+    return (match[1], match[2]) if match else None
+
+
+def blank_as_null(current, columns):
+    """Columns among the quoted columns whose type cannot hold an empty string, enums included."""
+    return [
+        quote(column)
+        for column, (data_type, labels) in current.items()
+        if quote(column) in columns and (labels is not None or ColumnProfile.of_type(data_type).kind != "text")
+    ]
+
+
+def copy_csv(table, columns, file):
+    """COPY a CSV file object into table, widening the columns its values do not fit and starting over.
+
+    A failed COPY loads nothing, so the file is simply read again. The first
+    failure profiles every row of the file and fits all columns at once, so values
+    the sample missed cost a single reload. Should Postgres still reject a value,
+    every further retry widens its column, enums straight to text.
+    """
+    position = file.tell()
+    profiled = False
+    while True:
+        current = existing_columns(table) if is_postgres() else {}
+        try:
+            return copy_file(table, columns, file, force_null=blank_as_null(current, columns))
+        except DataError as e:
+            failed = failing_value(e) if is_postgres() else None
+            if failed is None or failed[0] not in current:
+                raise
+            column, value = failed
+            if not profiled:
+                profiled = True
+                file.seek(position)
+                if fit_table(table, csv_profiles(file, rows=None)):
+                    continue
+            if current[column][1] is not None:
+                widen_column(table, column, "TEXT")
+            else:
+                profile = ColumnProfile()
+                profile.observe(value)
+                if not fit_column(table, column, current[column], profile):
+                    raise
+            file.seek(position)
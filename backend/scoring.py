@@ -0,0 +1,135 @@
+import re
+from enum import Enum
+
+from blocking import LEVENSHTEIN_MAX_DISTANCE, levenshtein_within_sql, normalized_sql
+from pydantic import BaseModel, Field, model_validator
+from settings import get_settings
+
+# Absorbs float rounding of the weight sums in process, SQL sums exact numerics
+SCORE_EPSILON = 1e-9
+# Date layouts left by normalization, dashes and spaces are already gone. The month
+# has to be valid, which also tells 19800102 from 02011980
+YEAR_FIRST_DATE = "([0-9]{4})[./]?(0[1-9]|1[0-2])[./]?([0-9]{2})"
+DAY_FIRST_DATE = "([0-9]{2})[./]?(0[1-9]|1[0-2])[./]?([0-9]{4})"
+YEAR_FIRST = re.compile(YEAR_FIRST_DATE)
+DAY_FIRST = re.compile(DAY_FIRST_DATE)
+
+
+class Comparator(str, Enum):
+    EXACT = "exact"
+    LEVENSHTEIN = "levenshtein"
+    TRIGRAM = "trigram"
+    DATE = "date"
+
+
+# Cheapest first, pairs that can no longer reach the threshold skip the rest
+COMPARATOR_COST = {
+    Comparator.EXACT: 0,
+    Comparator.DATE: 0,
+    Comparator.LEVENSHTEIN: 1,
+    Comparator.TRIGRAM: 2,
+}
+
+
+class ColumnRule(BaseModel):
+    column: str
+    comparator: Comparator = Comparator.LEVENSHTEIN
+    weight: float = Field(default=1.0, gt=0)
+    max_distance: int = Field(default=LEVENSHTEIN_MAX_DISTANCE, ge=0, le=10)
+    min_similarity: float | None = Field(default=None, gt=0, le=1)
+    tolerance_days: int = Field(default=0, ge=0)
+
+
+class ScoringRules(BaseModel):
+    """A pair matches when the weights of its agreeing columns add up to threshold.
+
+    Empty and NULL values never agree. Dates are read from the start of the normalized
+    value as YYYYMMDD or DDMMYYYY, the parts optionally split by dots or slashes,
+    anything else counts as empty.
+    """
+
+    columns: list[ColumnRule] = Field(min_length=1)
+    threshold: float = Field(gt=0)
+
+    @model_validator(mode="after")
+    def reachable_threshold(self):
+        if sum(rule.weight for rule in self.columns) < self.threshold - SCORE_EPSILON:
+            raise ValueError("The weights of all columns add up to less than threshold, no pair could match")
+        return self
+
+    def column_names(self):
+        return list(dict.fromkeys(rule.column for rule in self.columns))
+
+    def ordered(self):
+        return sorted(self.columns, key=lambda rule: COMPARATOR_COST[rule.comparator])
+
+    def similarity(self, rule):
+        return rule.min_similarity or get_settings().TRIGRAM_SIMILARITY_THRESHOLD
+
+
+def date_parts(value):
+    """(year, month, day) at the start of a normalized value, None when it holds no date."""
+    if match := YEAR_FIRST.match(value):
+        return int(match[1]), int(match[2]), int(match[3])
+    if match := DAY_FIRST.match(value):
+        return int(match[3]), int(match[2]), int(match[1])
+    return None
+
+
+def day_number(value):
+    """Days since a fixed epoch of the date value starts with, same arithmetic as day_number_sql.
+
+    Plain arithmetic instead of a date parse, so typos like 30 February give a
+    nearby number instead of an error.
+    """
+    parts = date_parts(value)
+    if parts is None:
+        return None
+    year, month, day = parts
+    if month <= 2:
+        year, month = year - 1, month + 9
+    else:
+        month -= 3
+    return 365 * year + year // 4 - year // 100 + year // 400 + (153 * month + 2) // 5 + day - 1
+
+
+def day_number_sql(value):
+    # Both layouts are rewritten to YYYYMMDD once, the arithmetic then reads it by position
+    digits = (
+        f"CASE WHEN {value} ~ '^{YEAR_FIRST_DATE}' THEN REGEXP_REPLACE({value}, '^{YEAR_FIRST_DATE}.*$', '\\1\\2\\3') "
+        f"WHEN {value} ~ '^{DAY_FIRST_DATE}' THEN REGEXP_REPLACE({value}, '^{DAY_FIRST_DATE}.*$', '\\3\\2\\1') END"
+    )
+    year = "(SUBSTR(digits, 1, 4)::int - CASE WHEN SUBSTR(digits, 5, 2)::int <= 2 THEN 1 ELSE 0 END)"
+    month = "(SUBSTR(digits, 5, 2)::int + CASE WHEN SUBSTR(digits, 5, 2)::int <= 2 THEN 9 ELSE -3 END)"
+    return (
+        f"(SELECT 365 * {year} + {year} / 4 - {year} / 100 + {year} / 400 + (153 * {month} + 2) / 5 "
+        f"+ SUBSTR(digits, 7, 2)::int - 1 FROM (SELECT {digits} AS digits) date_digits)"
+    )
+
+
+def agrees_sql(rules, rule, first, second):
+    a, b = normalized_sql(rule.column, first), normalized_sql(rule.column, second)
+    if rule.comparator == Comparator.EXACT:
+        condition = f"{a} = {b}"
+    elif rule.comparator == Comparator.LEVENSHTEIN:
+        condition = levenshtein_within_sql(a, b, rule.max_distance)
+    elif rule.comparator == Comparator.TRIGRAM:
+        condition = f"similarity({a}, {b}) >= {rules.similarity(rule)}"
+    else:
+        condition = f"ABS(({day_number_sql(a)}) - ({day_number_sql(b)})) <= {rule.tolerance_days}"
+    return f"CASE WHEN {a} <> '' AND {b} <> '' AND {condition} THEN {rule.weight} ELSE 0 END"
+
+
+def score_condition_sql(rules, first="n1", second="n2"):
+    """WHERE condition of a matching pair, expensive comparators only run on pairs the cheap ones keep."""
+    cheap = [rule for rule in rules.ordered() if COMPARATOR_COST[rule.comparator] == 0]
+    expensive = [rule for rule in rules.ordered() if COMPARATOR_COST[rule.comparator] > 0]
+    cheap_score = " + ".join(agrees_sql(rules, rule, first, second) for rule in cheap) or "0"
+    if not expensive:
+        return f"({cheap_score}) >= {rules.threshold}"
+    expensive_score = " + ".join(agrees_sql(rules, rule, first, second) for rule in expensive)
+    # Postgres orders quals by cost, the cheap bound comes first and ANDs short-circuit
+    return (
+        f"({cheap_score}) + {sum(rule.weight for rule in expensive)} >= {rules.threshold} "
+        f"AND ({cheap_score}) + ({expensive_score}) >= {rules.threshold}"
+    )
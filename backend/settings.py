@@ -1,5 +1,6 @@
 import os
 from functools import lru_cache
+from typing import Literal
 
 from dotenv import load_dotenv
 from pydantic import ConfigDict
@@ -13,7 +14,44 @@ class Settings(BaseSettings):
 
     DB_DSN: str = os.getenv("DB_DSN", "sqlite+pysqlite:///database.sqlite")
     ROOT_PATH: str = "/" + os.getenv("APP_NAME", "")
-    AVAILABLE_CORES: int = os.cpu_count()/2
+    AVAILABLE_CORES: int = max(os.cpu_count() // 2, 1)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_TIMEOUT: int = 30
+    # Milliseconds, 0 leaves the server default. Ingest, grouping and golden record jobs use their own timeout
+    DB_STATEMENT_TIMEOUT_MS: int = 0
+    DB_GROUPING_STATEMENT_TIMEOUT_MS: int = 0
+    DB_GROUPING_WORK_MEM: str = ""
+    # Header reads, result pages and exports use a pool of their own when either is set
+    DB_READ_DSN: str = os.getenv("DB_READ_DSN", "")
+    DB_READ_POOL_SIZE: int = 0
+    GROUPING_WORKERS: int = max(os.cpu_count() // 2, 1)
+    TRIGRAM_INDEX_METHOD: Literal["gist", "gin"] = "gist"
+    TRIGRAM_SIMILARITY_THRESHOLD: float = 0.3
+    DERIVED_TTL_DAYS: int = 30
+    JOB_WORKERS: int = 2
+    JOB_HISTORY_SIZE: int = 100
+    HEADERS_CACHE_TTL: float = 30.0
+    # Group assignment snapshots kept for repeated /groups runs, 0 disables the cache
+    GROUP_CACHE_SIZE: int = 5
+    # /groups/estimate samples about this many rows and warns above the limits
+    ESTIMATE_SAMPLE_ROWS: int = 10_000
+    MAX_BLOCK_SIZE: int = 10_000
+    MAX_CLUSTER_SIZE: int = 1_000
+    # python __main__.py serves with the reloader in development, with WEB_WORKERS processes in production
+    SERVER_MODE: Literal["development", "production"] = "development"
+    HOST: str = "127.0.0.1"
+    PORT: int = 8000
+    # 0 runs one process per available core
+    WEB_WORKERS: int = 0
+    SHUTDOWN_TIMEOUT: int = 30
+    LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "DEBUG"
+    LOG_FORMAT: Literal["text", "json"] = "text"
+    LOG_QUEUE: bool = False
+    MAX_UPLOAD_BYTES: int = 2 << 30
+    MAX_REQUEST_BYTES: int = 10 << 30
+    MEMORY_BUDGET_BYTES: int = 256 << 20
 
     CORS_ALLOW_ORIGINS: list[str] = ["*"]
     CORS_ALLOW_CREDENTIALS: bool = True
@@ -0,0 +1,115 @@
+import hashlib
+import json
+
+from fastapi_sqlalchemy import db
+from settings import get_settings
+from sqlalchemy import text
+
+VERSIONS_TABLE = "content_versions"
+
+
+def registry_table(table):
+    return f"{table}_group_snapshots"
+
+
+def snapshot_table(table, key):
+    return f"{table}_snapshot_{key[:16]}"
+
+
+def content_version(table):
+    db.session.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL);")
+    )
+    version = db.session.execute(
+        text(f"SELECT version FROM {VERSIONS_TABLE} WHERE table_name = :table;"), {"table": table}
+    ).scalar()
+    return version or 0
+
+
+def bump_content_version(table):
+    """Start a new content version of table, every group snapshot of older ones is dropped."""
+    version = content_version(table) + 1
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO {VERSIONS_TABLE} (table_name, version) VALUES (:table, :version)
+            ON CONFLICT (table_name) DO UPDATE SET version = EXCLUDED.version;
+            """
+        ),
+        {"table": table, "version": version},
+    )
+    evict_snapshots(table, version)
+    return version
+
+
+def params_key(**params):
+    """Hash of the parameters that decide the groups, in a stable order."""
+    encoded = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def ensure_registry(table):
+    db.session.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {registry_table(table)} (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                last_used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+    )
+
+
+def find_snapshot(table, key, version):
+    """Result of the run stored under key for this content version, None on a miss."""
+    ensure_registry(table)
+    result = db.session.execute(
+        text(f"SELECT result FROM {registry_table(table)} WHERE key = :key AND version = :version;"),
+        {"key": key, "version": version},
+    ).scalar()
+    if result is None:
+        return None
+    db.session.execute(
+        text(f"UPDATE {registry_table(table)} SET last_used_at = CURRENT_TIMESTAMP WHERE key = :key;"), {"key": key}
+    )
+    return json.loads(result)
+
+
+def save_snapshot(table, key, version, result, assignments="temp_group_assignments"):
+    """Keep the (client_id, group_id) assignments of a full run, then evict the least recently used."""
+    ensure_registry(table)
+    snapshot = snapshot_table(table, key)
+    db.session.execute(text(f"DROP TABLE IF EXISTS {snapshot};"))
+    db.session.execute(text(f"CREATE TABLE {snapshot} AS SELECT client_id, group_id FROM {assignments};"))
+    db.session.execute(text(f"CREATE INDEX idx_{snapshot}_client_id ON {snapshot}(client_id);"))
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO {registry_table(table)} (key, version, result) VALUES (:key, :version, :result)
+            ON CONFLICT (key) DO UPDATE SET
+                version = EXCLUDED.version,
+                result = EXCLUDED.result,
+                last_used_at = CURRENT_TIMESTAMP;
+            """
+        ),
+        {"key": key, "version": version, "result": json.dumps(result, default=str)},
+    )
+    evict_snapshots(table, version)
+
+
+def evict_snapshots(table, version):
+    """Drop snapshots of other content versions and all but the GROUP_CACHE_SIZE most recently used."""
+    ensure_registry(table)
+    keys = db.session.execute(
+        text(f"SELECT key, version FROM {registry_table(table)} ORDER BY last_used_at DESC, key;")
+    ).all()
+    current = [key for key, snapshot_version in keys if snapshot_version == version]
+    evicted = [key for key, snapshot_version in keys if snapshot_version != version]
+    evicted += current[get_settings().GROUP_CACHE_SIZE :]
+    for key in evicted:
+        db.session.execute(text(f"DROP TABLE IF EXISTS {snapshot_table(table, key)};"))
+        db.session.execute(text(f"DELETE FROM {registry_table(table)} WHERE key = :key;"), {"key": key})
+    return evicted
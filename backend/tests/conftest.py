@@ -0,0 +1,51 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+# Settings are read on import, so the app under test gets its database before any backend module loads.
+# The API tests run on a throwaway SQLite file, or on TEST_POSTGRES_DSN when it is set
+if os.getenv("TEST_POSTGRES_DSN"):
+    os.environ["DB_DSN"] = os.environ["TEST_POSTGRES_DSN"]
+else:
+    os.environ["DB_DSN"] = f"sqlite+pysqlite:///{tempfile.mkdtemp(prefix='fuzzy_tests_')}/test.sqlite"
+
+JOB_TIMEOUT = 60
+
+
+@pytest.fixture(scope="session")
+def client():
+    from base import app
+    from fastapi.testclient import TestClient
+
+    # Without the lifespan, which would shut the job pool down for good after the first test
+    return TestClient(app)
+
+
+@pytest.fixture
+def run_job(client):
+    """Wait for the job a response started, returns its final state."""
+
+    def wait(response):
+        assert response.status_code == 200, response.text
+        url = f"/jobs/{response.json()['job_id']}"
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while (job := client.get(url).json())["status"] not in ("done", "failed"):
+            assert time.monotonic() < deadline, job
+            time.sleep(0.05)
+        return job
+
+    return wait
+
+
+@pytest.fixture
+def upload(client, run_job):
+    """Upload CSV text as a new table, or append it with mode="append", returns the finished job."""
+
+    def post(csv_text, mode="replace", name="clients.csv"):
+        job = run_job(client.post(f"/generate?mode={mode}", files=[("files", (name, csv_text.encode()))]))
+        assert job["status"] == "done", job
+        return job
+
+    return post
@@ -0,0 +1,77 @@
+import random
+
+from clustering import UnionFind
+
+
+def union_find(pairs):
+    components = UnionFind()
+    for first, second in pairs:
+        components.union(first, second)
+    return components
+
+
+def partition(components):
+    members = {}
+    for item, group_id in components.groups():
+        members.setdefault(group_id, []).append(item)
+    return sorted(sorted(group) for group in members.values())
+
+
+def test_union_find_components():
+    components = union_find([(1, 2), (3, 4), (2, 3), (5, 6), (7, 7)])
+    assert len(components) == 7
+    assert components.components == 3
+    assert partition(components) == [[1, 2, 3, 4], [5, 6], [7]]
+
+
+def test_groups_are_transitively_closed():
+    rng = random.Random(0)
+    pairs = [(rng.randrange(300), rng.randrange(300)) for _ in range(200)]
+    neighbours = {}
+    for first, second in pairs:
+        neighbours.setdefault(first, set()).add(second)
+        neighbours.setdefault(second, set()).add(first)
+    expected, seen = [], set()
+    for item in neighbours:
+        if item in seen:
+            continue
+        component, frontier = set(), [item]
+        while frontier:
+            current = frontier.pop()
+            if current not in component:
+                component.add(current)
+                frontier.extend(neighbours[current])
+        seen |= component
+        expected.append(sorted(component))
+    assert partition(union_find(pairs)) == sorted(expected)
+
+
+def test_clusters_match_groups():
+    components = union_find([(1, 2), (3, 4), (2, 3), (5, 6), (7, 7)])
+    assert sorted(sorted(members) for members in components.clusters()) == partition(components)
+
+
+def test_groups_numbered_by_smallest_member_in_item_order():
+    components = union_find([(9, 4), (8, 1), (4, 2)])
+    assert list(components.groups()) == [(1, 1), (2, 2), (4, 2), (8, 1), (9, 2)]
+
+
+def test_groups_do_not_depend_on_pair_order():
+    rng = random.Random(0)
+    pairs = [(rng.randrange(200), rng.randrange(200)) for _ in range(150)]
+    expected = list(union_find(pairs).groups())
+    for _ in range(5):
+        rng.shuffle(pairs)
+        swapped = [(second, first) if rng.random() < 0.5 else (first, second) for first, second in pairs]
+        assert list(union_find(swapped).groups()) == expected
+
+
+def test_merge_equals_union_of_all_pairs():
+    rng = random.Random(1)
+    pairs = [(rng.randrange(100), rng.randrange(100)) for _ in range(120)]
+    merged = UnionFind()
+    for start in range(0, len(pairs), 30):
+        merged.merge(union_find(pairs[start : start + 30]))
+    whole = union_find(pairs)
+    assert list(merged.groups()) == list(whole.groups())
+    assert merged.components == whole.components
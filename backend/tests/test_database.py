@@ -0,0 +1,13 @@
+from database import split_statements
+
+
+def test_split_statements_keeps_quoted_semicolons():
+    script = """
+        -- comment; with a semicolon
+        CREATE TEMP TABLE t AS SELECT "na;me", 'a;b', '--' AS "x -- y" FROM f;
+        SELECT 'it''s;' FROM t
+    """
+    assert split_statements(script) == [
+        """CREATE TEMP TABLE t AS SELECT "na;me", 'a;b', '--' AS "x -- y" FROM f""",
+        "SELECT 'it''s;' FROM t",
+    ]
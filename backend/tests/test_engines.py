@@ -0,0 +1,120 @@
+import random
+
+import engines
+import numpy
+import pytest
+from blocking import BlockingStrategy
+from engines import (
+    PAD_FIRST,
+    PAD_SECOND,
+    ColumnData,
+    InMemoryMatcher,
+    PaddedBatch,
+    levenshtein_within,
+    phonetic_key,
+    trigrams,
+)
+
+
+def levenshtein(first, second):
+    """Textbook Wagner-Fischer distance, the reference of the banded kernel."""
+    previous = list(range(len(second) + 1))
+    for row, char in enumerate(first, 1):
+        current = [row]
+        for column, other in enumerate(second, 1):
+            current.append(min(previous[column - 1] + (char != other), previous[column] + 1, current[-1] + 1))
+        previous = current
+    return previous[-1]
+
+
+def with_edits(value, rng, count):
+    for _ in range(count):
+        position = rng.randint(0, len(value))
+        edit = rng.choice("ids") if value else "i"
+        char = rng.choice("abcя")
+        if edit == "i":
+            value = value[:position] + char + value[position:]
+        elif position < len(value):
+            value = value[:position] + (char if edit == "s" else "") + value[position + 1 :]
+    return value
+
+
+def candidate_pairs(count, seed):
+    rng = random.Random(seed)
+    pairs = [("", ""), ("", "a"), ("ab", ""), ("abc", "abc"), ("abc", "cba"), ("иванов", "ивнаов")]
+    for _ in range(count):
+        value = "".join(rng.choice("abcя") for _ in range(rng.randint(0, 12)))
+        other = with_edits(value, rng, rng.randint(0, 5)) if rng.random() < 0.7 else "".join(
+            rng.choice("abcя") for _ in range(rng.randint(0, 12))
+        )
+        pairs.append((value, other))
+    return pairs
+
+
+@pytest.mark.parametrize("limit", [0, 1, 2, 3])
+def test_levenshtein_within_matches_reference(limit):
+    pairs = candidate_pairs(2_000, seed=limit)
+    column = ColumnData([value for pair in pairs for value in pair])
+    first = numpy.arange(0, 2 * len(pairs), 2)
+    second = first + 1
+    # The kernel expects the caller's length filter
+    close = numpy.abs(column.lengths[first] - column.lengths[second]) <= limit
+    matched = levenshtein_within(
+        PaddedBatch(column, first[close], PAD_FIRST), PaddedBatch(column, second[close], PAD_SECOND), limit
+    )
+    expected = [levenshtein(*pair) <= limit for pair, kept in zip(pairs, close) if kept]
+    assert matched.tolist() == expected
+
+
+def reference_pairs(matcher, incremental=False):
+    """Every candidate pair built naively from its definition, the reference of the block by block generator."""
+    pairs = set()
+    probes = [row for row, new in enumerate(matcher.is_new) if new or not incremental]
+    for column in matcher.data:
+        values = column.values
+        filled = [row for row, value in enumerate(values) if value]
+        if matcher.blocking == BlockingStrategy.SORTED_NEIGHBOURHOOD:
+            order = sorted(filled, key=values.__getitem__)
+            for position, row in enumerate(order):
+                pairs.update(tuple(sorted((row, other))) for other in order[position + 1 : position + matcher.window])
+        elif matcher.blocking == BlockingStrategy.TRIGRAM:
+            # Like the lateral join, incremental mode only looks for the neighbours of new rows
+            for row in set(filled) & set(probes):
+                similar = []
+                for other in filled:
+                    shared = len(trigrams(values[row]) & trigrams(values[other]))
+                    similarity = shared / len(trigrams(values[row]) | trigrams(values[other]))
+                    if other != row and shared and similarity >= matcher.threshold:
+                        similar.append((-similarity, other))
+                pairs.update(tuple(sorted((row, other))) for _, other in sorted(similar)[: matcher.window])
+        else:
+            key = (lambda value: value[:3]) if matcher.blocking == BlockingStrategy.QGRAM else phonetic_key
+            keys = {row: key(values[row]) for row in filled if key(values[row])}
+            pairs.update((a, b) for a in keys for b in keys if a < b and keys[a] == keys[b])
+    if incremental:
+        pairs = {(a, b) for a, b in pairs if matcher.is_new[a] or matcher.is_new[b]}
+    return pairs
+
+
+def generated_pairs(matcher, incremental=False):
+    batches = list(matcher.candidate_pairs(incremental))
+    first = numpy.concatenate([batch[0] for batch in batches])
+    second = numpy.concatenate([batch[1] for batch in batches])
+    assert (first < second).all()
+    return list(zip(first.tolist(), second.tolist()))
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+@pytest.mark.parametrize("blocking", list(BlockingStrategy))
+def test_candidate_pairs_match_reference(blocking, incremental, monkeypatch):
+    # Small batches and triangles so that batching and row by row blocks are exercised
+    monkeypatch.setattr(engines, "SCORE_BATCH_SIZE", 97)
+    monkeypatch.setattr(engines, "TRIANGLE_BLOCK_ROWS", 8)
+    rng = random.Random(7)
+    names = ["".join(rng.choice("abkm") for _ in range(rng.randint(0, 6))) for _ in range(300)]
+    cities = [rng.choice(["", "moscow", "moskva", "kazan", "kazань"]) for _ in range(300)]
+    matcher = InMemoryMatcher(["name", "city"], blocking=blocking, window=4)
+    matcher.load((row, row, row % 7 == 0, name, city) for row, (name, city) in enumerate(zip(names, cities)))
+    found = generated_pairs(matcher, incremental)
+    assert len(found) == len(set(found))
+    assert set(found) == reference_pairs(matcher, incremental)
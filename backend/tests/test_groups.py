@@ -0,0 +1,97 @@
+import pytest
+
+BASE = """client_id,name,code
+1,ivanov,aaa111
+2,ivanova,bbb222
+3,petrov,ccc333
+4,petrova,ddd444
+5,sidorov,eee555
+6,kuznetsov,fff666
+"""
+# 7 links the ivanov and petrov groups, 8 pairs with the ungrouped 5, 9 matches nobody
+APPENDED = """client_id,name,code
+7,ivanovs,ccc333x
+8,sidorova,ggg777
+9,zzz,hhh888
+"""
+
+
+def group_members(client):
+    """group_id -> sorted client ids of the published groups."""
+    page = client.get("/groups?limit=1000").json()
+    return {group["group_id"]: sorted(record["client_id"] for record in group["records"]) for group in page["groups"]}
+
+
+# SQLite always matches in process, the SQL engine only differs on Postgres
+@pytest.mark.parametrize("engine", ["sql", "memory"])
+def test_incremental_run_merges_new_rows_into_existing_groups(client, upload, run_job, engine):
+    url = f"/groups?blocking=qgram&engine={engine}"
+    upload(BASE)
+    full = run_job(client.post(url, json=["name", "code"]))
+    assert full["result"]["incremental"] is False
+    assert group_members(client) == {1: [1, 2], 2: [3, 4]}
+
+    appended = upload(APPENDED, mode="append")
+    assert appended["result"]["batch_id"] == 2
+    incremental = run_job(client.post(f"{url}&incremental=true", json=["name", "code"]))
+    assert incremental["status"] == "done", incremental
+    assert incremental["result"]["incremental"] is True
+    # The merged groups keep the smallest id, the new group comes after the existing ones
+    assert group_members(client) == {1: [1, 2, 3, 4, 7], 3: [5, 8]}
+
+    # A full run over every row finds the same groups
+    run_job(client.post(url, json=["name", "code"]))
+    assert sorted(group_members(client).values()) == [[1, 2, 3, 4, 7], [5, 8]]
+
+
+def test_repeated_run_restores_its_snapshot(client, upload, run_job):
+    upload(BASE)
+    first = run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))
+    assert first["result"]["cached"] is False
+    groups = group_members(client)
+
+    repeated = run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))
+    assert repeated["result"]["cached"] is True
+    assert "restore" in repeated["result"]["stages"]
+    assert repeated["result"]["groups"] == first["result"]["groups"]
+    assert group_members(client) == groups
+
+    other = run_job(client.post("/groups?blocking=qgram", json=["name"]))
+    assert other["result"]["cached"] is False
+
+    # New content invalidates every snapshot
+    upload(APPENDED, mode="append")
+    assert run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))["result"]["cached"] is False
+
+
+def test_failed_write_resumes_from_its_last_chunk(client, upload, run_job, monkeypatch):
+    import clustering
+    from sqlalchemy.exc import OperationalError
+    from utils import get_settings
+
+    # Snapshots would let the rerun skip writing altogether
+    monkeypatch.setattr(get_settings(), "GROUP_CACHE_SIZE", 0)
+    monkeypatch.setattr(clustering, "WRITE_CHUNK_ROWS", 1)
+    upload(BASE)
+    clean = run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))
+    groups = group_members(client)
+    upload(BASE)
+
+    copy_rows = clustering.copy_rows
+    copies = []
+
+    def failing_copy_rows(*args):
+        if copies:
+            raise OperationalError("COPY", {}, Exception("connection lost"))
+        copies.append(args)
+        return copy_rows(*args)
+
+    monkeypatch.setattr(clustering, "copy_rows", failing_copy_rows)
+    assert run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))["status"] == "failed"
+
+    monkeypatch.setattr(clustering, "copy_rows", copy_rows)
+    resumed = run_job(client.post("/groups?blocking=qgram", json=["name", "code"]))
+    assert resumed["status"] == "done", resumed
+    written = clean["result"]["stages"]["write_groups"]["rows"]
+    assert resumed["result"]["stages"]["write_groups"]["rows"] == written - 1
+    assert group_members(client) == groups
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from sqlalchemy import text
+
+
+def clients_csv(first, count, last=None):
+    """count rows from client_id first on, with last replacing the age and city of the final row."""
+    rows = [
+        f"{number},name{number},{number % 90},{'ab'[number % 2]}" for number in range(first, first + count)
+    ]
+    if last:
+        rows[-1] = f"{first + count - 1},name{first + count - 1},{last}"
+    return "client_id,name,age,city\n" + "\n".join(rows) + "\n"
+
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_DSN"), reason="TEST_POSTGRES_DSN is not set")
+def test_append_widens_columns_for_values_the_sample_missed(client, upload, monkeypatch):
+    import schema
+    import utils
+    from database import existing_columns
+    from fastapi_sqlalchemy import db
+
+    upload(clients_csv(1, 1000))
+    # db() outside a request needs the middleware set up by a first request
+    client.get("/headers")
+    with db():
+        assert existing_columns(utils.TABLE_NAME)["age"][0] == "integer"
+        assert existing_columns(utils.TABLE_NAME)["city"][1] == {"a", "b"}
+
+    # One sampled row per stretch, none of them the last row
+    monkeypatch.setattr(utils, "SAMPLE_ROWS", 10)
+    copy_file = schema.copy_file
+    copies = []
+
+    def counted_copy_file(*args, **kwargs):
+        copies.append(args[0])
+        return copy_file(*args, **kwargs)
+
+    monkeypatch.setattr(schema, "copy_file", counted_copy_file)
+    job = upload(clients_csv(1001, 1000, last="12.5,c"), mode="append")
+    assert job["result"]["rows"] == 1000
+    # The rejected COPY profiles the whole file, so every column is fitted with a single reload
+    assert len(copies) == 2
+    with db():
+        columns = existing_columns(utils.TABLE_NAME)
+        assert columns["age"][0] == "double precision"
+        assert columns["city"][1] == {"a", "b", "c"}
+        assert db.session.execute(text(f"SELECT COUNT(*) FROM {utils.TABLE_NAME};")).scalar() == 2000
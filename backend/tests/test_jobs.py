@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+CLIENTS = "client_id,name\n1,ivanov\n2,ivanova\n3,petrov\n"
+
+
+def test_generate_runs_as_a_job(client, upload):
+    job = upload(CLIENTS)
+    assert job["kind"] == "generate"
+    assert job["result"]["rows"] == 3
+    assert job["progress"]["rows_ingested"] == 3
+    assert job["started_at"] <= job["finished_at"]
+    headers = [header["column_name"] for header in client.get("/headers").json()["headers"]]
+    assert headers[:2] == ["client_id", "name"]
+
+
+def test_groups_job_returns_its_result(client, upload, run_job):
+    upload(CLIENTS)
+    job = run_job(client.post("/groups", json=["name"]))
+    assert job["status"] == "done", job
+    assert job["result"]["groups"] == 1
+    assert job["result"]["pairs"] == 1
+    assert "write_groups" in job["result"]["stages"]
+
+
+def test_failed_job_reports_its_error(client, run_job):
+    job = run_job(client.post("/generate", files=[("files", ("broken.csv", b"client_id,name\n1,\xff\xfe\n"))]))
+    assert job["status"] == "failed"
+    assert job["error"]
+
+
+def test_unknown_job_is_not_found(client):
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_DSN"), reason="TEST_POSTGRES_DSN is not set")
+def test_resource_lock_holds_a_postgres_advisory_lock(client):
+    from fastapi_sqlalchemy import db
+    from jobs import resource_lock
+    from sqlalchemy import create_engine, text
+
+    # The session middleware is set up by the first request
+    client.get("/jobs/unknown")
+    other = create_engine(os.environ["TEST_POSTGRES_DSN"], isolation_level="AUTOCOMMIT")
+    try_lock = text("SELECT pg_try_advisory_lock(hashtext('fuzzy'));")
+    with other.connect() as connection:
+        with db(), resource_lock("fuzzy"):
+            # Another server process would wait here
+            assert connection.execute(try_lock).scalar() is False
+        assert connection.execute(try_lock).scalar() is True
+        connection.execute(text("SELECT pg_advisory_unlock(hashtext('fuzzy'));"))
+    other.dispose()
@@ -0,0 +1,69 @@
+import io
+import json
+from collections import Counter
+from itertools import product
+
+
+def paired_clients(groups):
+    """CSV where consecutive clients pair up under qgram blocking, the first group has three members."""
+    prefixes = ["".join(letters) for letters in product("bcdfg", repeat=3)][:groups]
+    names = [f"{prefix}{suffix}" for prefix in prefixes for suffix in ("ax", "ay")] + [f"{prefixes[0]}az"]
+    return "client_id,name\n" + "".join(f"{client_id},{name}\n" for client_id, name in enumerate(names, 1))
+
+
+def test_pages_walk_every_group_once(client, upload, run_job):
+    upload(paired_clients(25))
+    run_job(client.post("/groups?blocking=qgram", json=["name"]))
+    groups, after = [], 0
+    while after is not None:
+        page = client.get(f"/groups?limit=10&after={after}").json()
+        groups += page["groups"]
+        after = page["next_after"]
+    assert len(groups) == 25
+    assert [group["group_id"] for group in groups] == sorted({group["group_id"] for group in groups})
+    assert sum(group["size"] for group in groups) == 51
+    assert all(group["size"] == len(group["records"]) for group in groups)
+
+    streamed = [json.loads(line) for line in client.get("/groups/stream").text.splitlines()]
+    assert streamed == groups
+
+
+def test_min_size_filters_pages_and_stream(client, upload, run_job):
+    upload(paired_clients(5))
+    run_job(client.post("/groups?blocking=qgram", json=["name"]))
+    page = client.get("/groups?min_size=3").json()
+    assert [group["size"] for group in page["groups"]] == [3]
+    assert page["next_after"] is None
+    lines = client.get("/groups/stream?min_size=3").text.splitlines()
+    assert [json.loads(line)["records"] for line in lines] == [page["groups"][0]["records"]]
+
+
+def read_parquet(content):
+    import pyarrow.parquet
+
+    return pyarrow.parquet.read_table(io.BytesIO(content)).to_pylist()
+
+
+def test_export_carries_group_ids_and_loads_back(client, upload, run_job):
+    upload(paired_clients(3))
+    run_job(client.post("/groups?blocking=qgram", json=["name"]))
+    response = client.get("/export")
+    assert response.status_code == 200
+    rows = read_parquet(response.content)
+    assert [list(row) for row in rows[:1]] == [["client_id", "name", "group_id"]]
+    assert len(rows) == 7
+    groups = {group["group_id"]: group["size"] for group in client.get("/groups").json()["groups"]}
+    assert Counter(row["group_id"] for row in rows) == groups
+
+    # Parquet uploads take the same path as CSV ones
+    job = run_job(client.post("/generate", files=[("files", ("fuzzy.parquet", response.content))]))
+    assert job["status"] == "done", job
+    assert job["result"]["rows"] == 7
+
+
+def test_export_of_golden_records(client, upload, run_job):
+    upload(paired_clients(3))
+    run_job(client.post("/groups?blocking=qgram", json=["name"]))
+    run_job(client.post("/golden", json=["name"]))
+    rows = read_parquet(client.get("/export?source=golden").content)
+    assert sorted(row["size"] for row in rows) == [2, 2, 3]
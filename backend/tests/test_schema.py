@@ -0,0 +1,95 @@
+import io
+
+import pytest
+from schema import ColumnProfile, csv_header, csv_profiles, value_kind
+
+
+@pytest.mark.parametrize(
+    "value, kind",
+    [
+        ("true", "boolean"),
+        ("FALSE", "boolean"),
+        ("42", "integer"),
+        ("-7", "integer"),
+        ("0", "integer"),
+        ("007", "text"),
+        ("3.14", "float"),
+        ("1e5", "float"),
+        ("1980-02-29", "date"),
+        ("1981-02-29", "text"),
+        ("2024-05-01 12:30:00", "timestamp"),
+        ("2024-05-01T12:30:00+03:00", "timestamptz"),
+        ("Иванов", "text"),
+    ],
+)
+def test_value_kind(value, kind):
+    assert value_kind(value) == kind
+
+
+def profile(*values):
+    result = ColumnProfile()
+    for value in values:
+        result.observe(value)
+    return result
+
+
+def test_blank_values_fit_every_type():
+    assert profile("", "1", "").data_type() == "INTEGER"
+    assert profile("").data_type() == "TEXT"
+
+
+def test_integer_bound_picks_the_type():
+    assert profile("1", str(2**31 - 1)).data_type() == "INTEGER"
+    assert profile("1", str(-(2**31))).data_type() == "BIGINT"
+    assert profile(str(2**63)).data_type() == "NUMERIC"
+
+
+def test_merge_widens_kind_and_keeps_counts():
+    merged = profile("1", "2").merge(profile("2.5", str(2**40)))
+    assert merged.kind == "float"
+    assert merged.bound == 2**40
+    assert merged.filled == 4
+    assert merged.values == {"1", "2", "2.5", str(2**40)}
+
+
+def test_merge_is_symmetric():
+    first, second = ("2024-01-01", "1"), ("x", "2024-01-02")
+    assert profile(*first).merge(profile(*second)).data_type() == profile(*second).merge(profile(*first)).data_type()
+
+
+def test_merge_with_unseen_column_keeps_kind():
+    assert profile("1").merge(ColumnProfile()).data_type() == "INTEGER"
+    assert ColumnProfile().merge(profile("1980-01-01")).data_type() == ColumnProfile.of_type("date").data_type()
+
+
+def test_of_type_reads_existing_columns():
+    assert ColumnProfile.of_type("character varying(20)").kind == "text"
+    assert ColumnProfile.of_type("bigint").merge(profile("1")).data_type() == "BIGINT"
+
+
+def csv_file(*lines):
+    return io.BytesIO(("\n".join(lines) + "\n").encode())
+
+
+def test_profiles_sample_across_the_file():
+    file = csv_file("id,code", *(f"{row},{row if row < 5_000 else 'x'}" for row in range(10_000)))
+    profiles = csv_profiles(file, rows=100)
+    assert profiles["id"].data_type() == "INTEGER"
+    assert profiles["code"].data_type() == "TEXT"
+    assert profiles["id"].filled == 100
+    assert file.tell() == 0
+
+
+def test_profiles_of_multiline_values_read_the_head():
+    note = '"' + "\n".join(["x,y"] * 50) + '"'
+    file = csv_file("\ufeffid,note", *(f"{row},{note}" for row in range(200)))
+    profiles = csv_profiles(file, rows=100)
+    assert list(profiles) == ["id", "note"]
+    assert profiles["id"].data_type() == "INTEGER"
+    assert profiles["id"].filled == 100
+
+
+def test_profiles_of_every_row():
+    file = csv_file("id", *map(str, range(20_000)))
+    assert csv_profiles(file, rows=None)["id"].filled == 20_000
+    assert csv_header(file) == ["id"]
@@ -0,0 +1,64 @@
+import os
+from datetime import date, timedelta
+
+import pytest
+from engines import normalize
+from pydantic import ValidationError
+from scoring import ScoringRules, day_number, day_number_sql
+
+VALUES = [
+    "19800101",
+    "19800229",
+    "19800301",
+    "20000228",
+    "20000301",
+    "19001231",
+    "19990230",
+    "198001021230",
+    "1980.01.02",
+    "1980/01/02",
+    "02.01.1980",
+    "02/01/1980",
+    "02011980",
+    "19991301",
+    "2024011",
+    "abcdefgh",
+    "",
+]
+
+
+def test_day_number_counts_days():
+    start = date(1899, 12, 25)
+    for offset in range(0, 45_000, 7):
+        day = start + timedelta(days=offset)
+        assert day_number(day.strftime("%Y%m%d")) - day_number(start.strftime("%Y%m%d")) == offset
+
+
+def test_day_number_tolerates_impossible_dates():
+    assert day_number("19990230") == day_number("19990302")
+    assert day_number("1999") is None
+    assert day_number("19991301") is None
+
+
+@pytest.mark.parametrize("value", ["1980-01-02", "1980.01.02", "1980/01/02", "02.01.1980", "02/01/1980", "02-01-1980"])
+def test_day_number_reads_common_layouts(value):
+    assert day_number(normalize(value)) == day_number("19800102")
+
+
+def test_rules_reject_unreachable_threshold():
+    columns = [{"column": "name", "weight": 1}, {"column": "birth", "comparator": "date", "weight": 0.5}]
+    assert ScoringRules(columns=columns, threshold=1.5).column_names() == ["name", "birth"]
+    with pytest.raises(ValidationError):
+        ScoringRules(columns=columns, threshold=2)
+
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_DSN"), reason="TEST_POSTGRES_DSN is not set")
+def test_day_number_sql_matches_day_number():
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(os.environ["TEST_POSTGRES_DSN"])
+    with engine.connect() as connection:
+        for value in VALUES:
+            computed = connection.execute(text(f"SELECT {day_number_sql(':value')};"), {"value": value}).scalar()
+            assert computed == day_number(value), value
+    engine.dispose()
@@ -0,0 +1,12 @@
+from utils import most_frequent
+
+
+def test_most_frequent_skips_blanks():
+    assert most_frequent(["", None, "  ", "a", "b", "a"]) == "a"
+    assert most_frequent([None, "", " "]) is None
+    assert most_frequent([]) is None
+
+
+def test_most_frequent_ties_go_to_smallest():
+    assert most_frequent(["b", "a", "b", "a", "c"]) == "a"
+    assert most_frequent([3, 1, 2, 3, 1]) == 1
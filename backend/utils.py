@@ -1,440 +1,876 @@
+import json
 import logging
-from io import BytesIO
-
-import pandas
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
+from operator import itemgetter
+
+from blocking import (
+    DEFAULT_WINDOW,
+    BlockingStrategy,
+    MatchingEngine,
+    candidate_pairs_sql,
+    levenshtein_within_sql,
+    normalized_sql,
+)
+from cache import TTLCache
+from clustering import (
+    UnionFind,
+    assignments_view,
+    copy_run,
+    merge_group_ids,
+    publish_run,
+    published_run,
+    start_run,
+    write_run,
+)
+from database import (
+    copy_rows,
+    create_extensions,
+    execute_sql,
+    is_postgres,
+    quote,
+    row_estimate,
+    sample_sql,
+    session_settings,
+    stream_rows,
+    table_exists,
+)
+from derived import derived_indexes, drop_stale_derived, grouped_source_sql, persist_derived, records_sql
+from schema import SAMPLE_ROWS, ColumnProfile, column_types, copy_csv, csv_header, csv_profiles, fit_table, merge_profiles
+from scoring import score_condition_sql
 from settings import get_settings
-from custom_logger import log
+from snapshots import bump_content_version, content_version, find_snapshot, params_key, save_snapshot, snapshot_table
 from fastapi import HTTPException
 from fastapi_sqlalchemy import db
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import OperationalError
+from ingest import (
+    FileFormat,
+    IngestMode,
+    arrow_column_types,
+    arrow_reader,
+    copy_batches,
+    create_table,
+    detect_format,
+    finish_batch,
+    open_arrow,
+    prepare_table,
+    start_batch,
+    unreadable_file_errors,
+)
+from jobs import report_progress
+from metrics import StageMetrics
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError, OperationalError
 
 TABLE_NAME = "fuzzy"
-logger = log(name="backend", level=logging.DEBUG, log_folder_path="logs")
-
-
-def create_virtual_table(csvs: list[bytes]):
+PROGRESS_EVERY = 100_000
+GROUP_PAGE_SIZE = 100
+GOLDEN_TABLE = "golden_table"
+SAMPLE_TABLE = "temp_estimate_sample"
+# Reference columns the estimate warns about, shares of the sampled and of the filled rows
+MOSTLY_EMPTY_RATIO = 0.5
+LOW_CARDINALITY_RATIO = 0.01
+settings = get_settings()
+headers_cache = TTLCache(settings.HEADERS_CACHE_TTL)
+logger = logging.getLogger("backend")
+
+
+def create_virtual_table(paths: list[str], mode=IngestMode.REPLACE):
     # engine = create_engine("sqlite+pysqlite:///database.sqlite", echo=True)
     # print("Engine created")
 
     # conn = engine.connect()
     # print("Engine connection established")
-    try:
-        db.session.execute(
-            text(f"CREATE EXTENSION IF NOT EXISTS fuzzystrmatch SCHEMA public;")
-        )
-        db.session.execute(
-            text(f"ALTER TABLE fuzzy ADD COLUMN IF NOT EXISTS group_id INTEGER;")
-        )
-    except OperationalError as e:
-        logger.critical(e)
-        raise HTTPException(status_code=422)
-
-    for index, csv in enumerate(csvs):
-        logger.debug(f"Processing file #{index + 1}...")
-        dataframe = pandas.read_csv(
-            BytesIO(bytearray(csv)), low_memory=False, encoding="utf-8"
-        )
-        if_exists = "replace" if index == 0 else "append"
+    # COPY of a large upload outlasts DB_STATEMENT_TIMEOUT_MS, it runs under the settings of the other long jobs
+    with grouping_session():
         try:
-            dataframe.to_sql(
-                TABLE_NAME, db.session.connection(), if_exists=if_exists, index=False
-            )
+            # Created at startup too, the database may have been recreated since
+            create_extensions(db.session.connection())
         except OperationalError as e:
             logger.critical(e)
             raise HTTPException(status_code=422)
 
-        logger.debug(f"File #{index + 1} processed")
+        # Types come from a sample of all files together, so every file of the upload fits them
+        profiles = {}
+        try:
+            for path in paths:
+                with open(path, "rb") as file:
+                    file_format = detect_format(file)
+                if file_format == FileFormat.CSV:
+                    with open(path, "rb") as file:
+                        merge_profiles(profiles, csv_profiles(file, max(1, SAMPLE_ROWS // len(paths))))
+                else:
+                    with open_arrow(path) as file:
+                        schema, _ = arrow_reader(file, file_format)
+                        arrow_types = arrow_column_types(schema)
+                    merge_profiles(
+                        profiles, {column: ColumnProfile.of_type(type_) for column, type_ in arrow_types.items()}
+                    )
+            if mode == IngestMode.REPLACE or not table_exists(TABLE_NAME):
+                create_table(TABLE_NAME, *column_types(TABLE_NAME, profiles))
+                invalidate_headers(TABLE_NAME)
+            else:
+                fit_table(TABLE_NAME, profiles)
+            prepare_table(TABLE_NAME)
+            batch_id = start_batch(TABLE_NAME)
+            bump_content_version(TABLE_NAME)
+        except (DBAPIError, *unreadable_file_errors()) as e:
+            logger.critical(e)
+            raise HTTPException(status_code=422)
+
+        total_rows = 0
+        for index, path in enumerate(paths):
+            logger.debug(f"Processing file #{index + 1}...")
+            try:
+                with open(path, "rb") as file:
+                    file_format = detect_format(file)
+                with open(path, "rb") if file_format == FileFormat.CSV else open_arrow(path) as file:
+                    if file_format == FileFormat.CSV:
+                        header = csv_header(file)
+                        rows = copy_csv(TABLE_NAME, [quote(column) for column in header], file)
+                    else:
+                        schema, batches = arrow_reader(file, file_format)
+                        rows = copy_batches(TABLE_NAME, [quote(field.name) for field in schema], batches)
+            except (DBAPIError, *unreadable_file_errors()) as e:
+                logger.critical(e)
+                raise HTTPException(status_code=422)
+
+            total_rows += rows
+            report_progress(files_done=index + 1, rows_ingested=total_rows)
+            logger.debug(f"File #{index + 1} processed as {file_format.value}, {rows} rows")
+
+        try:
+            finish_batch(TABLE_NAME, batch_id, total_rows)
+        except OperationalError as e:
+            logger.critical(e)
+            raise HTTPException(status_code=422)
+        finally:
+            invalidate_headers(TABLE_NAME)
 
     logger.info("Изменения сохранены")
+    return {"rows": total_rows, "batch_id": batch_id}
 
 
-def get_table_headers():
+def get_table_headers(table=TABLE_NAME, connection=None, schema=None):
+    """Columns of table in order with null ratio and distinct estimate, cached for HEADERS_CACHE_TTL.
+
+    Reads pg_catalog on Postgres, schema defaults to the current one of the
+    connection. Statistics come from pg_stats and are None before ANALYZE.
+    """
+    # Keyed by database too, a read replica may lag behind the primary
+    database = str((connection.engine if connection is not None else db.session.get_bind()).url)
+    cached = headers_cache.get((database, schema, table))
+    if cached is not None:
+        return cached
+    connection = connection or db.session.connection()
     try:
-        result = db.session.execute(
-            text(
-                f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name='{TABLE_NAME}';"
+        if connection.dialect.name != "postgresql":
+            inspector = inspect(connection)
+            # Empty before the first upload, like the pg_catalog query
+            columns = inspector.get_columns(table, schema=schema) if inspector.has_table(table, schema=schema) else []
+            headers = [
+                {
+                    "column_name": column["name"],
+                    "data_type": str(column["type"]).lower(),
+                    "null_ratio": None,
+                    "distinct_estimate": None,
+                }
+                for column in columns
+            ]
+        else:
+            result = connection.execute(
+                text(
+                    """
+                    SELECT
+                        a.attname AS column_name,
+                        format_type(a.atttypid, NULL) AS data_type,
+                        s.null_frac AS null_ratio,
+                        CASE
+                            WHEN s.n_distinct < 0 THEN ROUND(-s.n_distinct * GREATEST(c.reltuples, 0))
+                            ELSE s.n_distinct
+                        END AS distinct_estimate
+                    FROM
+                        pg_attribute a
+                    JOIN
+                        pg_class c
+                    ON
+                        c.oid = a.attrelid
+                    JOIN
+                        pg_namespace n
+                    ON
+                        n.oid = c.relnamespace
+                    LEFT JOIN
+                        pg_stats s
+                    ON
+                        s.schemaname = n.nspname
+                        AND s.tablename = c.relname
+                        AND s.attname = a.attname
+                    WHERE
+                        c.relname = :table
+                        AND n.nspname = COALESCE(:schema, current_schema())
+                        AND a.attnum > 0
+                        AND NOT a.attisdropped
+                        AND a.attgenerated = ''
+                    ORDER BY
+                        a.attnum;
+                    """
+                ),
+                {"table": table, "schema": schema},
             )
-        )
+            headers = [dict(row) for row in result.mappings()]
     except OperationalError as e:
         logger.critical(e)
         raise HTTPException(status_code=422)
 
-    return list(result.mappings().fetchall())
+    return headers_cache.set((database, schema, table), headers)
 
 
-def fuzzy_group(columns):
-    try:
-        cores = 8
-        set_cores_sql = f"SET max_parallel_workers_per_gather TO {cores};"
+def invalidate_headers(table):
+    headers_cache.invalidate(lambda key: key[2] == table)
 
-        normalized_columns = [
-            f"LOWER(REPLACE(REPLACE(COALESCE({col}, ''), ' ', ''), '-', '')) AS normalized_{col}" for col in columns
-        ]
-        levenshtein_conditions = [
-            f"(LENGTH(n1.normalized_{col}) - LENGTH(n2.normalized_{col}) <= 2 AND levenshtein(n1.normalized_{col}, n2.normalized_{col}) <= 2)" for col in columns
-        ]
-        substring_conditions = [
-            f"(n1.normalized_{col} LIKE '%' || n2.normalized_{col} || '%' OR n2.normalized_{col} LIKE '%' || n1.normalized_{col} || '%')" for col in columns
-        ]
-        index_name = f"idx_fuzzy_{'_'.join(columns)}"  # Generate a unique index name based on columns
-        create_index_sql = f"CREATE INDEX IF NOT EXISTS {index_name} ON fuzzy({', '.join(columns)});"
-
-        sql_query = f"""
-            -- Step 1: Add dynamic index for faster JOIN and filtering
-            {set_cores_sql}
-
-            {create_index_sql}
-
-            -- Step 2: Temporary table for normalized data
-            CREATE TEMP TABLE temp_normalized_records AS
-            SELECT
-                client_id,
-                {', '.join(columns)},
-                {', '.join(normalized_columns)} -- Pre-normalized columns
-            FROM
-                fuzzy;
-
-            -- Step 3: Calculate representative names
-            CREATE TEMP TABLE temp_representative_names AS
-            SELECT DISTINCT ON ({', '.join([f'n1.{col}' for col in columns])})
-                n1.client_id AS client_id,
-                n2.client_id AS representative_client_id
-            FROM
-                temp_normalized_records n1
-            JOIN
-                temp_normalized_records n2
-            ON
-                n1.client_id <> n2.client_id -- Avoid self-joins
-                AND (
-                    { ' OR '.join(levenshtein_conditions) } -- Levenshtein conditions
-                    OR
-                    { ' OR '.join(substring_conditions) }  -- Substring matching
+
+def record_columns(connection=None):
+    """Data columns returned with group members, bookkeeping and generated columns left out."""
+    return [
+        header["column_name"]
+        for header in get_table_headers(connection=connection)
+        if header["column_name"] not in ("group_id", "batch_id")
+    ]
+
+
+def check_columns(columns, rules=None):
+    """Data columns named by a request, 422 for any the table does not have. Names go into SQL quoted."""
+    available = [column for column in record_columns() if column != "client_id"]
+    columns = columns or available
+    named = set(columns) | set(rules.column_names() if rules else ())
+    unknown = named - set(available)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown columns: {', '.join(sorted(unknown))}")
+    return columns
+
+
+def get_group_page(after=0, limit=GROUP_PAGE_SIZE, min_size=2, connection=None):
+    """Groups with group_id > after in group_id order, keyset pagination over idx_fuzzy_groups_group_id."""
+    connection = connection or db.session.connection()
+    columns = record_columns(connection)
+    if not columns:
+        # Nothing was uploaded yet
+        return {"groups": [], "next_after": None}
+    assignments = assignments_view(TABLE_NAME)
+    try:
+        rows = connection.execute(
+            text(
+                f"""
+                WITH page AS (
+                    SELECT
+                        group_id,
+                        COUNT(*) AS size
+                    FROM
+                        {assignments}
+                    WHERE
+                        group_id > :after
+                    GROUP BY
+                        group_id
+                    HAVING
+                        COUNT(*) >= :min_size
+                    ORDER BY
+                        group_id
+                    LIMIT :limit
                 )
-            ORDER BY
-                {', '.join([f'n1.{col}' for col in columns])},
-                n2.client_id;
-
-            -- Step 4: Group clients by similarity
-            CREATE TEMP TABLE temp_similarity_groups AS
-            SELECT
-                r.representative_client_id,
-                ARRAY_AGG(n1.client_id) AS group_ids,
-                ARRAY_AGG({ ' || \' \' || '.join([f"COALESCE(n1.{col}, '')" for col in columns]) }) AS group_values
-            FROM
-                temp_normalized_records n1
-            JOIN
-                temp_representative_names r
-            ON
-                n1.client_id = r.client_id
-            GROUP BY
-                r.representative_client_id;
-
-            -- Step 5: Assign group IDs and update original table
-            WITH AssignGroupIDs AS (
                 SELECT
-                    unnest(group_ids) AS client_id,
-                    ROW_NUMBER() OVER () AS group_id
+                    page.group_id,
+                    page.size,
+                    {', '.join(f'f.{quote(column)}' for column in columns)}
                 FROM
-                    temp_similarity_groups
-            )
-            UPDATE
-                fuzzy f
-            SET
-                group_id = g.group_id
-            FROM
-                AssignGroupIDs g
-            WHERE
-                f.client_id = g.client_id;
-            """
-        # Это неоптимизированный запрос
-        # normalized_columns = []
-        # levenshtein_conditions = []
-        # substring_conditions = []
-
-        # for col in reference_columns:
-        #     normalized_columns.append(f"LOWER(REPLACE(REPLACE(COALESCE({col}, ''), ' ', ''), '-', '')) AS normalized_{col}")
-        #     levenshtein_conditions.append(f"(n1.{col} IS NOT NULL AND n2.{col} IS NOT NULL AND levenshtein(LOWER(n1.{col}), LOWER(n2.{col})) <= 2)")
-        #     substring_conditions.append(f"(n1.{col} IS NOT NULL AND n2.{col} IS NOT NULL AND LOWER(n1.{col}) LIKE '%' || LOWER(n2.{col}) || '%')")
-        #     substring_conditions.append(f"(n1.{col} IS NOT NULL AND n2.{col} IS NOT NULL AND LOWER(n2.{col}) LIKE '%' || LOWER(n1.{col}) || '%')")
-
-
-        # normalized_columns_sql = ", ".join(normalized_columns)
-        # levenshtein_sql = " OR ".join(levenshtein_conditions)
-        # substring_sql = " OR ".join(substring_conditions)
-
-        # sql_query = f"""
-        #     -- Create index on client_id for faster JOIN operations
-        #     CREATE INDEX IF NOT EXISTS idx_fuzzy_client_id ON fuzzy(client_id);
-
-        #     WITH NormalizedRecords AS (
-        #         SELECT 
-        #             client_id,
-        #             {', '.join(reference_columns)},
-        #             {normalized_columns_sql}  -- Dynamically generated normalized columns with NULL handling
-        #         FROM 
-        #             fuzzy
-        #     ),
-        #     RepresentativeNames AS (
-        #         SELECT DISTINCT ON ({', '.join(reference_columns)})
-        #             {', '.join(["n1."+col for col in reference_columns])},
-        #             n2.client_id AS representative_client_id
-        #         FROM 
-        #             NormalizedRecords AS n1  -- Declare n1 explicitly
-        #         JOIN 
-        #             NormalizedRecords AS n2  -- Declare n2 explicitly
-        #         ON n1.client_id <> n2.client_id AND  -- Prevent self-joining
-        #         (
-        #             ({levenshtein_sql}) OR 
-        #             ({substring_sql})
-        #         )
-        #         ORDER BY 
-        #             {', '.join(reference_columns)}, 
-        #             {levenshtein_sql}
-        #     ),
-        #     SimilarityGroups AS (
-        #         SELECT 
-        #             {', '.join(["n1."+col for col in reference_columns])},
-        #             r.representative_client_id AS representative_client_id,
-        #             ARRAY_AGG(n1.client_id) AS group_ids,
-        #             ARRAY_AGG({ " || ' ' || ".join([f"COALESCE(n1.{col}, '')" for col in reference_columns]) }) AS group_values
-        #         FROM 
-        #             NormalizedRecords AS n1  -- Declare n1 explicitly
-        #         JOIN 
-        #             RepresentativeNames AS r 
-        #         ON n1.client_id = r.representative_client_id
-        #         GROUP BY 
-        #             {', '.join(["n1."+col for col in reference_columns])}, r.representative_client_id
-        #     ),
-        #     AssignGroupIDs AS (
-        #         SELECT 
-        #             unnest(group_ids) AS client_id,
-        #             ROW_NUMBER() OVER () AS group_id
-        #         FROM 
-        #             SimilarityGroups
-        #     )
-        #     UPDATE 
-        #         fuzzy AS f
-        #     SET 
-        #         group_id = g.group_id
-        #     FROM 
-        #         AssignGroupIDs AS g
-        #     WHERE 
-        #         f.client_id = g.client_id;
-        #     """
-        # db.session.execute(text(sql_query))
-        # Вот эта срань сделает группировку по ФИО и ДР
-        # db.session.execute(
-        #     text(
-        #         f"""
-        #             WITH NormalizedRecords AS (
-        #                 SELECT
-        #                     client_id,
-        #                     client_fio_full,
-        #                     client_bday,
-        #                     LOWER(REPLACE(REPLACE(client_fio_full, ' ', ''), '-', '')) AS normalized_name,
-        #                     LOWER(SPLIT_PART(client_fio_full, ' ', 1)) AS first_part,
-        #                     LOWER(SPLIT_PART(client_fio_full, ' ', 2)) AS middle_part,
-        #                     LOWER(SPLIT_PART(client_fio_full, ' ', -1)) AS last_part
-        #                 FROM
-        #                     fuzzy
-        #             ),
-        #             RepresentativeNames AS (
-        #                 SELECT DISTINCT ON (n1.client_bday, n1.normalized_name)
-        #                     n1.client_bday,
-        #                     n1.normalized_name,
-        #                     n2.client_fio_full AS representative_name
-        #                 FROM
-        #                     NormalizedRecords n1
-        #                 JOIN
-        #                     NormalizedRecords n2
-        #                     ON n1.client_bday = n2.client_bday
-        #                     AND (
-        #                         levenshtein(n1.normalized_name, n2.normalized_name) <= 2 OR
-        #                         LOWER(n1.client_fio_full) LIKE '%' || LOWER(n2.client_fio_full) || '%' OR
-        #                         LOWER(n2.client_fio_full) LIKE '%' || LOWER(n1.client_fio_full) || '%' OR
-        #                         (
-        #                             n1.first_part = n2.first_part AND
-        #                             (n1.last_part = n2.last_part OR n1.middle_part = n2.middle_part)
-        #                         )
-        #                     )
-        #                 ORDER BY
-        #                     n1.client_bday, n1.normalized_name, levenshtein(n1.normalized_name, n2.normalized_name)
-        #             ),
-        #             SimilarityGroups AS (
-        #                 SELECT
-        #                     n1.client_bday,
-        #                     r.representative_name,
-        #                     ARRAY_AGG(n1.client_id) AS group_ids,
-        #                     ARRAY_AGG(n1.client_fio_full) AS group_names
-        #                 FROM
-        #                     NormalizedRecords n1
-        #                 JOIN
-        #                     RepresentativeNames r
-        #                     ON n1.client_bday = r.client_bday AND n1.normalized_name = r.normalized_name
-        #                 GROUP BY
-        #                     n1.client_bday, r.representative_name
-        #             ),
-        #             AssignGroupIDs AS (
-        #                 SELECT
-        #                     unnest(group_ids) AS client_id,
-        #                     ROW_NUMBER() OVER () AS group_id
-        #                 FROM
-        #                     SimilarityGroups
-        #             )
-        #             UPDATE
-        #                 fuzzy f
-        #             SET
-        #                 group_id = g.group_id
-        #             FROM
-        #                 AssignGroupIDs g
-        #             WHERE
-        #                 f.client_id = g.client_id;
-        #     """
-        #     )
-        # )
-
-        # Вот эта срань выдаст список словариков
-        # result = db.session.execute(
-        #     text(
-        #         f'''WITH NormalizedRecords AS (
-        #             SELECT
-        #                 client_id,
-        #                 client_fio_full,
-        #                 client_bday,
-        #                 LOWER(REPLACE(REPLACE(client_fio_full, ' ', ''), '-', '')) AS normalized_name,
-        #                 LOWER(SPLIT_PART(client_fio_full, ' ', 1)) AS first_part,
-        #                 LOWER(SPLIT_PART(client_fio_full, ' ', 2)) AS middle_part,
-        #                 LOWER(SPLIT_PART(client_fio_full, ' ', -1)) AS last_part
-        #             FROM
-        #                 fuzzy
-        #         ),
-        #         RepresentativeNames AS (
-        #             SELECT DISTINCT ON (n1.client_bday, n1.normalized_name)
-        #                 n1.client_bday,
-        #                 n1.normalized_name,
-        #                 n2.client_fio_full AS representative_name
-        #             FROM
-        #                 NormalizedRecords n1
-        #             JOIN
-        #                 NormalizedRecords n2
-        #                 ON n1.client_bday = n2.client_bday
-        #                 AND (
-        #                     levenshtein(n1.normalized_name, n2.normalized_name) <= 2 OR
-        #                     LOWER(n1.client_fio_full) LIKE '%' || LOWER(n2.client_fio_full) || '%' OR
-        #                     LOWER(n2.client_fio_full) LIKE '%' || LOWER(n1.client_fio_full) || '%' OR
-        #                     (
-        #                         n1.first_part = n2.first_part AND
-        #                         (n1.last_part = n2.last_part OR n1.middle_part = n2.middle_part)
-        #                     )
-        #                 )
-        #             ORDER BY
-        #                 n1.client_bday, n1.normalized_name, levenshtein(n1.normalized_name, n2.normalized_name)
-        #         ),
-        #         SimilarityGroups AS (
-        #             SELECT
-        #                 n1.client_bday,
-        #                 r.representative_name,
-        #                 ARRAY_AGG(n1.client_id) AS group_ids,
-        #                 ARRAY_AGG(n1.client_fio_full) AS group_names
-        #             FROM
-        #                 NormalizedRecords n1
-        #             JOIN
-        #                 RepresentativeNames r
-        #                 ON n1.client_bday = r.client_bday AND n1.normalized_name = r.normalized_name
-        #             GROUP BY
-        #                 n1.client_bday, r.representative_name
-        #         )
-        #         SELECT
-        #             JSON_AGG(
-        #                 JSON_BUILD_OBJECT(
-        #                     'client_fio_full', representative_name,
-        #                     'date_birth', client_bday,
-        #                     'group_size', array_length(group_ids, 1),
-        #                     'group_ids', group_ids,
-        #                     'group_names', group_names,
-        #                     'properties', (
-        #                         SELECT JSON_AGG(
-        #                             JSON_BUILD_OBJECT(
-        #                                 'id', client_id,
-        #                                 'client_fio_full', client_fio_full,
-        #                                 'properties', (
-        #                                     SELECT json_object_agg(key, value)
-        #                                     FROM (
-        #                                         SELECT
-        #                                             key,
-        #                                             value
-        #                                         FROM jsonb_each(to_jsonb(u.*))
-        #                                         WHERE
-        #                                             key NOT IN ('id', 'client_fio_full', 'client_bday') AND
-        #                                             (
-        #                                                 (value IS NOT NULL AND value::text != '') OR
-        #                                                 jsonb_typeof(value) = 'number' OR
-        #                                                 jsonb_typeof(value) = 'boolean'
-        #                                             )
-        #                                     ) AS extra_properties
-        #                                 )
-        #                             )
-        #                         )
-        #                         FROM fuzzy u
-        #                         WHERE u.client_id = ANY(group_ids)
-        #                     )
-        #                 )
-        #             ) AS grouped_users
-        #         FROM
-        #             SimilarityGroups;
-        #         '''
-        #     )
-        # )
+                    page
+                JOIN
+                    {assignments} a
+                ON
+                    a.group_id = page.group_id
+                JOIN
+                    {TABLE_NAME} f
+                ON
+                    f.client_id = a.client_id
+                ORDER BY
+                    page.group_id,
+                    f.client_id;
+                """
+            ),
+            {"after": after, "limit": limit, "min_size": min_size},
+        ).all()
     except OperationalError as e:
         logger.critical(e)
         raise HTTPException(status_code=422)
-    print(sql_query)
-    return sql_query
-
 
-def create_golden_table(reference_columns):
+    groups = []
+    for group_id, members in groupby(rows, key=itemgetter(0)):
+        records = [dict(zip(columns, row[2:])) for row in members]
+        groups.append({"group_id": group_id, "size": len(records), "records": records})
+    return {"groups": groups, "next_after": groups[-1]["group_id"] if len(groups) == limit else None}
+
+
+def stream_groups(engine, columns, min_size=2):
+    """Yield every group as a line of JSON, rows come through a server-side cursor.
+
+    Runs outside of the request session, the response body is iterated after the
+    endpoint returns, so it holds a connection of its own until the last line.
+    """
+    if not columns:
+        return
+    assignments = assignments_view(TABLE_NAME)
+    query = f"""
+        SELECT
+            a.group_id,
+            {', '.join(f'f.{quote(column)}' for column in columns)}
+        FROM
+            {TABLE_NAME} f
+        JOIN
+            {assignments} a
+        ON
+            a.client_id = f.client_id
+        JOIN (
+            SELECT group_id FROM {assignments} GROUP BY group_id HAVING COUNT(*) >= {int(min_size)}
+        ) g
+        ON
+            g.group_id = a.group_id
+        ORDER BY
+            a.group_id,
+            f.client_id
+        """
+    with engine.connect() as connection:
+        for group_id, members in groupby(stream_rows(query, connection=connection), key=itemgetter(0)):
+            records = [dict(zip(columns, row[1:])) for row in members]
+            group = {"group_id": group_id, "size": len(records), "records": records}
+            yield json.dumps(group, ensure_ascii=False, default=str) + "\n"
+
+
+def grouped_records_sql(columns):
+    """Subquery with columns of TABLE_NAME and the published group_id of every row, NULL when ungrouped."""
+    return f"""(
+        SELECT
+            {', '.join(f'f.{quote(column)}' for column in columns)},
+            a.group_id
+        FROM
+            {TABLE_NAME} f
+        LEFT JOIN
+            {assignments_view(TABLE_NAME)} a
+        ON
+            a.client_id = f.client_id
+    ) grouped"""
+
+
+def cluster_pairs(rows, incremental, report=False):
+    """Union matched (client_id_1, group_id_1, client_id_2, group_id_2) rows into components.
+
+    Incremental runs treat every existing group as a single node, so new rows
+    join their groups and bridge groups that have to be merged.
+    """
+    components = UnionFind()
+    pairs = 0
+    for client_id_1, group_id_1, client_id_2, group_id_2 in rows:
+        if incremental:
+            components.union(
+                ("group", group_id_1) if group_id_1 is not None else ("client", client_id_1),
+                ("group", group_id_2) if group_id_2 is not None else ("client", client_id_2),
+            )
+        else:
+            components.union(client_id_1, client_id_2)
+        pairs += 1
+        if report and pairs % PROGRESS_EVERY == 0:
+            report_progress(pairs_matched=pairs)
+    return components, pairs
+
+
+def grouping_workers():
+    # Every partition holds a pooled connection while the job session keeps its own
+    return max(min(settings.GROUPING_WORKERS, settings.DB_POOL_SIZE - 1), 1)
+
+
+def grouping_session():
+    """Settings of the heavy queries of ingest, grouping and golden records, see DB_GROUPING_* settings.
+
+    Partition connections enter it too, so their trigram % operator uses the same threshold.
+    """
+    return session_settings(
+        work_mem=settings.DB_GROUPING_WORK_MEM,
+        statement_timeout=settings.DB_GROUPING_STATEMENT_TIMEOUT_MS,
+        max_parallel_workers_per_gather=settings.AVAILABLE_CORES,
+        **{"pg_trgm.similarity_threshold": settings.TRIGRAM_SIMILARITY_THRESHOLD},
+    )
+
+
+def score_partition(query, incremental):
+    with db(), grouping_session():
+        return cluster_pairs(stream_rows(query), incremental)
+
+
+def cluster_partitions(matched_pairs_sql, records, incremental):
+    """Score hash partitions of the candidate pairs on separate connections and merge their components."""
+    workers = grouping_workers()
+    pairs_table = f"{TABLE_NAME}_work_candidate_pairs"
+    # Temp tables are private to the session, partitions read an unlogged copy of the pairs
+    db.session.execute(
+        text(
+            f"""
+            DROP TABLE IF EXISTS {pairs_table};
+            CREATE UNLOGGED TABLE {pairs_table} AS
+            SELECT *, ROW_NUMBER() OVER () % {workers} AS partition FROM temp_candidate_pairs;
+
+            ANALYZE {pairs_table};
+            """
+        )
+    )
     try:
-        result = db.session.execute(
-                text(
-                    f'''CREATE TABLE IF NOT EXISTS GOLDEN_TABLE (LIKE {TABLE_NAME} INCLUDING ALL);'''))
-    except OperationalError as e:
-        logger.critical(e)
-        raise HTTPException(status_code=422)
+        components, pairs = UnionFind(), 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="partition") as executor:
+            futures = [
+                executor.submit(
+                    score_partition,
+                    matched_pairs_sql(pairs_table, records, f"AND p.partition = {partition}"),
+                    incremental,
+                )
+                for partition in range(workers)
+            ]
+            for future in as_completed(futures):
+                partition_components, partition_pairs = future.result()
+                components.merge(partition_components)
+                pairs += partition_pairs
+                report_progress(pairs_matched=pairs)
+    finally:
+        db.session.execute(text(f"DROP TABLE IF EXISTS {pairs_table};"))
+    logger.debug(f"Scored {workers} partitions in parallel")
+    return components, pairs
+
+
+def fuzzy_group(
+    columns,
+    blocking=BlockingStrategy.DMETAPHONE,
+    window=DEFAULT_WINDOW,
+    incremental=False,
+    parallel=False,
+    engine=MatchingEngine.SQL,
+    explain=False,
+    rules=None,
+):
+    metrics = StageMetrics("groups", explain)
+    columns = check_columns(columns, rules)
+    with grouping_session():
+        try:
+            prepare_table(TABLE_NAME)
+            grouped_batch = 0
+            if incremental:
+                grouped_batch = db.session.execute(
+                    text(f"SELECT COALESCE(MAX(batch_id), 0) FROM {TABLE_NAME}_batches WHERE grouped_at IS NOT NULL;")
+                ).scalar()
+                # Nothing was grouped before, so everything is new and a full run is cheaper
+                incremental = grouped_batch > 0 and published_run(TABLE_NAME) is not None
+
+            # fuzzystrmatch and pg_trgm only exist on Postgres, elsewhere match in process
+            in_memory = engine == MatchingEngine.MEMORY or not is_postgres()
+
+            # Full runs with the same parameters over the same content give the same groups
+            version = content_version(TABLE_NAME)
+            key = params_key(
+                columns=columns,
+                blocking=blocking,
+                window=window,
+                in_memory=in_memory,
+                rules=rules.model_dump(mode="json") if rules else None,
+                similarity_threshold=settings.TRIGRAM_SIMILARITY_THRESHOLD,
+            )
+            cacheable = not incremental and not explain and settings.GROUP_CACHE_SIZE > 0
+            if cacheable:
+                cached = find_snapshot(TABLE_NAME, key, version)
+                if cached is not None:
+                    with metrics.stage("restore"):
+                        run_id, _ = start_run(TABLE_NAME, key, version, resume=False)
+                        copy_run(TABLE_NAME, run_id, snapshot_table(TABLE_NAME, key))
+                        publish_run(TABLE_NAME, run_id)
+                        mark_grouped()
+                    logger.debug(f"Groups restored from snapshot {key[:16]}")
+                    return {**cached, "cached": True, "stages": metrics.stages}
+
+            if in_memory:
+                components, pairs, candidates = memory_group(
+                    columns, blocking, window, grouped_batch, incremental, metrics, rules
+                )
+            else:
+                components, pairs, candidates = sql_group(
+                    columns, blocking, window, grouped_batch, incremental, parallel, metrics, rules
+                )
+            report_progress(pairs_matched=pairs)
+            metrics.count_pairs(candidates, pairs)
+            logger.debug(f"{pairs} matched pairs, {len(components)} clustered nodes")
+
+            # Step 5: Write the assignments next to the table and publish them
+            with metrics.stage("write_groups") as stage:
+                if incremental:
+                    stage["rows"] = merge_group_ids(TABLE_NAME, components)["assigned"]
+                else:
+                    run_id, written = start_run(TABLE_NAME, key, version)
+                    if written:
+                        logger.info(f"Resuming run {run_id} after {written} written assignments")
+                    stage["rows"] = write_run(TABLE_NAME, run_id, components.groups(), written) - written
+                    publish_run(TABLE_NAME, run_id)
+            mark_grouped()
+
+            result = {
+                "candidate_pairs": candidates,
+                "pairs": pairs,
+                "incremental": incremental,
+                "nodes": len(components),
+                "groups": components.components,
+            }
+            if cacheable:
+                with metrics.stage("snapshot"):
+                    save_snapshot(TABLE_NAME, key, version, result, assignments_view(TABLE_NAME))
+        except OperationalError as e:
+            logger.critical(e)
+            raise HTTPException(status_code=422)
 
-def frequence_analisys_column(reference_column):
-    try: #тут не дм инфра логс, просто тестилось на нем хддд
-        result = db.session.execute(
-            text(
-                f'''DO $$
-DECLARE
-    column_record RECORD;  
-    most_frequent_value TEXT; 
-BEGIN
-    FOR column_record IN
-        SELECT COLUMN_NAME 
-        FROM INFORMATION_SCHEMA.COLUMNS 
-        WHERE TABLE_SCHEMA = 'DM_INFRA_LOGS' AND TABLE_NAME = 'incident_hint'
-    LOOP
-        EXECUTE format('
-            SELECT %I 
-            FROM "DM_INFRA_LOGS".incident_hint 
-            GROUP BY %I 
-            HAVING COUNT(*) = (
-                SELECT COUNT(*) 
-                FROM "DM_INFRA_LOGS".incident_hint 
-                GROUP BY %I 
-                ORDER BY COUNT(*) DESC 
-                LIMIT 1
-            )', column_record.column_name, column_record.column_name, column_record.column_name)
-        INTO most_frequent_value;
-
-        RAISE NOTICE column_record.column_name, most_frequent_value;
-    END LOOP;
-END $$;'''))
-    except OperationalError as e:
-        logger.critical(e)
-        raise HTTPException(status_code=422)
+    return {**result, "cached": False, "stages": metrics.stages}
+
+
+def mark_grouped():
+    db.session.execute(
+        text(f"UPDATE {TABLE_NAME}_batches SET grouped_at = CURRENT_TIMESTAMP WHERE grouped_at IS NULL;")
+    )
+
+
+def load_matcher(columns, blocking, window, grouped_batch, metrics, rules=None, sample="", groups=None):
+    # NumPy is only imported once a run needs the in-memory engine
+    from engines import InMemoryMatcher
 
-    return result.mappings().all()[:100]
+    matcher = InMemoryMatcher(columns, blocking, window, rules)
+    group_id, source = grouped_source_sql(TABLE_NAME, sample, groups)
+    selected = ", ".join(f"{TABLE_NAME}.{quote(column)}" for column in columns)
+    with metrics.stage("load") as stage:
+        stage["rows"] = matcher.load(
+            stream_rows(
+                f"SELECT {TABLE_NAME}.client_id, {group_id}, COALESCE({TABLE_NAME}.batch_id, 0) > {grouped_batch}, "
+                f"{selected} FROM {source}"
+            )
+        )
+    return matcher
+
+
+def memory_group(columns, blocking, window, grouped_batch, incremental, metrics, rules=None):
+    groups = assignments_view(TABLE_NAME) if incremental else None
+    matcher = load_matcher(columns, blocking, window, grouped_batch, metrics, rules, groups=groups)
+    # Candidates are generated block by block and scored as each batch fills, so they share a stage
+    with metrics.stage("match") as stage:
+        components, pairs = cluster_pairs(matcher.matched_pairs(incremental), incremental, report=True)
+        stage["rows"] = pairs
+    return components, pairs, matcher.candidates
+
+
+def match_condition_sql(columns, blocking, rules=None):
+    """WHERE condition of a matching n1/n2 pair, any column close enough unless rules are given."""
+    if rules is not None:
+        return score_condition_sql(rules)
+    # Empty values never match, '' is within distance 2 of short values and LIKE any value
+    first = {col: normalized_sql(col, "n1") for col in columns}
+    second = {col: normalized_sql(col, "n2") for col in columns}
+    present = {col: f"{first[col]} <> '' AND {second[col]} <> ''" for col in columns}
+    levenshtein_conditions = [
+        f"({present[col]} AND {levenshtein_within_sql(first[col], second[col])})" for col in columns
+    ]
+    if blocking == BlockingStrategy.TRIGRAM:
+        # Trigram similarity replaces LIKE, trigram indexes are built with the candidates
+        substring_conditions = [
+            f"({present[col]} AND {first[col]} % {second[col]})" for col in columns
+        ]
+    else:
+        substring_conditions = [
+            f"({present[col]} AND ({first[col]} LIKE '%' || {second[col]} || '%' OR {second[col]} LIKE '%' || {first[col]} || '%'))" for col in columns
+        ]
+    return f"""(
+                { ' OR '.join(levenshtein_conditions) } -- Levenshtein conditions
+                OR
+                { ' OR '.join(substring_conditions) }  -- Substring matching
+            )"""
+
+
+def sql_group(columns, blocking, window, grouped_batch, incremental, parallel, metrics, rules=None, source=None):
+    """Group TABLE_NAME, or the records already normalized into source like the estimate sample."""
+    match_condition = match_condition_sql(columns, blocking, rules)
+
+    # Step 1: Normalized values and block keys persisted on the table, with their indexes
+    if source is None:
+        with metrics.stage("derived") as stage:
+            persisted = persist_derived(TABLE_NAME, columns, blocking)
+            dropped = drop_stale_derived(TABLE_NAME, persisted)
+            stage["rows"] = len(persisted)
+        if dropped:
+            logger.info(f"Dropped stale derived columns and indexes: {', '.join(dropped)}")
+        groups = assignments_view(TABLE_NAME) if incremental else None
+        records = records_sql(TABLE_NAME, columns, blocking, grouped_batch, persisted, groups=groups)
+    else:
+        records = source
+
+    # Step 3: Score candidate pairs, matched ones are streamed into the clustering stage
+    def matched_pairs_sql(pairs_table, records, partition_filter=""):
+        return f"""
+        SELECT
+            p.client_id_1,
+            n1.group_id,
+            p.client_id_2,
+            n2.group_id
+        FROM
+            {pairs_table} p
+        JOIN
+            {records} n1
+        ON
+            n1.client_id = p.client_id_1
+        JOIN
+            {records} n2
+        ON
+            n2.client_id = p.client_id_2
+        WHERE
+            {match_condition}
+            {partition_filter}
+        """
+
+    # Step 2: Candidate pairs sharing a block
+    with metrics.stage("candidates") as stage:
+        metrics.execute(
+            candidate_pairs_sql(columns, blocking, window, source=records, incremental=incremental), stage
+        )
+        candidates = db.session.execute(text("SELECT COUNT(*) FROM temp_candidate_pairs;")).scalar()
+        stage["rows"] = candidates
+    report_progress(candidate_pairs=candidates)
+
+    # Temp tables are never auto-analyzed, without statistics the scoring join degrades to a nested loop
+    with metrics.stage("analyze"):
+        db.session.execute(text("ANALYZE temp_candidate_pairs;"))
+
+    # Step 4: Connected components of the match graph, scoring is streamed into the clustering
+    with metrics.stage("score") as stage:
+        if metrics.explain:
+            # Runs the scoring once more, plans are only captured on request
+            stage["plans"] = [metrics.plan(matched_pairs_sql("temp_candidate_pairs", records))]
+        if parallel:
+            components, pairs = cluster_partitions(matched_pairs_sql, records, incremental)
+        else:
+            components, pairs = cluster_pairs(
+                stream_rows(matched_pairs_sql("temp_candidate_pairs", records)),
+                incremental,
+                report=True,
+            )
+        stage["rows"] = pairs
+    return components, pairs, candidates
+
+
+def estimate_groups(
+    columns,
+    blocking=BlockingStrategy.DMETAPHONE,
+    window=DEFAULT_WINDOW,
+    engine=MatchingEngine.SQL,
+    rules=None,
+    sample_rows=None,
+    seed=None,
+):
+    """Dry run of fuzzy_group on a random sample, extrapolated to the whole table.
+
+    Group ids are left untouched. Pair counts and their time grow with the square of
+    the table size under key blocking, linearly under the window based strategies.
+    """
+    metrics = StageMetrics("estimate")
+    columns = check_columns(columns, rules)
+    total = 0
+    with grouping_session():
+        try:
+            total = row_estimate(TABLE_NAME)
+            percent = min(100 * (sample_rows or settings.ESTIMATE_SAMPLE_ROWS) / max(total, 1), 100)
+            sample = sample_sql(percent, seed)
+            if engine == MatchingEngine.MEMORY or not is_postgres():
+                matcher = load_matcher(columns, blocking, window, 0, metrics, rules, sample)
+                with metrics.stage("match") as stage:
+                    components, pairs = cluster_pairs(matcher.matched_pairs(), False)
+                    stage["rows"] = pairs
+                sampled, candidates = len(matcher.client_ids), matcher.candidates
+                blocks = matcher.block_sizes()
+                filled = {col: [value for value in data.values if value] for col, data in zip(columns, matcher.data)}
+                profile = {col: (len(values), len(set(values))) for col, values in filled.items()}
+            else:
+                sampled, profile = sample_records(columns, blocking, sample, metrics)
+                components, pairs, candidates = sql_group(
+                    columns, blocking, window, 0, False, False, metrics, rules, source=SAMPLE_TABLE
+                )
+                blocks = sample_block_sizes(columns, blocking)
+                db.session.execute(text(f"DROP TABLE IF EXISTS {SAMPLE_TABLE};"))
+        except OperationalError as e:
+            logger.critical(e)
+            raise HTTPException(status_code=422)
+
+    largest_cluster = max((len(members) for members in components.clusters()), default=0)
+    return extrapolate(
+        total, sampled, blocking, candidates, pairs, largest_cluster, blocks, profile, metrics.stages
+    )
+
+
+def sample_records(columns, blocking, sample, metrics):
+    """Normalized records of the sample in SAMPLE_TABLE, with the indexes of a real run.
+
+    Returns the sampled row count and (non-empty, distinct) value counts per column.
+    """
+    with metrics.stage("sample") as stage:
+        execute_sql(
+            f"""
+            DROP TABLE IF EXISTS {SAMPLE_TABLE};
+            CREATE TEMP TABLE {SAMPLE_TABLE} AS
+            SELECT * FROM {records_sql(TABLE_NAME, columns, blocking, 0, sample=sample)} records;
+            """
+        )
+        for statement in derived_indexes(SAMPLE_TABLE, columns, blocking).values():
+            execute_sql(statement)
+        db.session.execute(text(f"ANALYZE {SAMPLE_TABLE};"))
+        counts = [
+            f"COUNT(*) FILTER (WHERE {normalized_sql(col)} <> ''), COUNT(DISTINCT NULLIF({normalized_sql(col)}, ''))"
+            for col in columns
+        ]
+        sampled, *values = execute_sql(f"SELECT COUNT(*), {', '.join(counts)} FROM {SAMPLE_TABLE};").one()
+        stage["rows"] = sampled
+    return sampled, {col: tuple(values[2 * i : 2 * i + 2]) for i, col in enumerate(columns)}
+
+
+def sample_block_sizes(columns, blocking):
+    if blocking in (BlockingStrategy.SORTED_NEIGHBOURHOOD, BlockingStrategy.TRIGRAM):
+        return {}
+    sizes = {col: [] for col in columns}
+    # Block keys are prefixed with the position of their column, see candidate_pairs_sql
+    for block_key, size in db.session.execute(text("SELECT block_key, COUNT(*) FROM temp_blocks GROUP BY block_key;")):
+        sizes[columns[int(block_key.split(":", 1)[0])]].append(size)
+    return sizes
+
+
+def extrapolate(total, sampled, blocking, candidates, pairs, largest_cluster, blocks, profile, stages):
+    scale = total / sampled if sampled else 0
+    windowed = blocking in (BlockingStrategy.SORTED_NEIGHBOURHOOD, BlockingStrategy.TRIGRAM)
+    pair_scale = scale if windowed else scale**2
+    # Loading and normalizing the rows grows with them, every other stage with the pairs
+    seconds = sum(
+        stage["seconds"] * (scale if name in ("load", "sample") else pair_scale) for name, stage in stages.items()
+    )
+    estimate = {
+        "rows": total,
+        "sample_rows": sampled,
+        "candidate_pairs": round(candidates * pair_scale),
+        "pairs": round(pairs * pair_scale),
+        "largest_cluster": min(round(largest_cluster * scale), total),
+        "seconds": round(seconds, 1),
+        "blocks": {
+            col: {"mean": round(sum(sizes) / len(sizes) * scale), "largest": round(max(sizes) * scale)}
+            for col, sizes in blocks.items()
+            if sizes
+        },
+        "columns": {
+            col: {
+                "empty_ratio": round(1 - filled / sampled, 4) if sampled else None,
+                "distinct_ratio": round(distinct / filled, 4) if filled else None,
+            }
+            for col, (filled, distinct) in profile.items()
+        },
+    }
+
+    warnings = []
+    if not sampled:
+        warnings.append("The sample is empty, nothing to extrapolate")
+    for col, block in estimate["blocks"].items():
+        if block["largest"] > settings.MAX_BLOCK_SIZE:
+            warnings.append(f"Largest {col} block would hold about {block['largest']} rows, over {settings.MAX_BLOCK_SIZE}")
+    if estimate["largest_cluster"] > settings.MAX_CLUSTER_SIZE:
+        warnings.append(
+            f"Largest group would hold about {estimate['largest_cluster']} rows, over {settings.MAX_CLUSTER_SIZE}"
+        )
+    for col, column in estimate["columns"].items():
+        if column["empty_ratio"] is not None and column["empty_ratio"] > MOSTLY_EMPTY_RATIO:
+            warnings.append(f"{col} is empty in {column['empty_ratio']:.0%} of the sampled rows")
+        if column["distinct_ratio"] is not None and column["distinct_ratio"] < LOW_CARDINALITY_RATIO:
+            warnings.append(f"{col} has few distinct values, {column['distinct_ratio']:.2%} of the filled ones")
+    for warning in warnings:
+        logger.warning(warning)
+
+    return {
+        **estimate,
+        "warnings": warnings,
+        "sample": {
+            "candidate_pairs": candidates,
+            "pairs": pairs,
+            "largest_cluster": largest_cluster,
+        },
+        "stages": stages,
+    }
+
+
+def most_frequent(values):
+    """Most frequent non-empty value, ties go to the smallest like mode() over sorted input."""
+    counts = Counter(value for value in values if value is not None and str(value).strip() != "")
+    if not counts:
+        return None
+    return min(counts.items(), key=lambda item: (-item[1], item[0]))[0]
+
+
+def golden_rows(rows):
+    """(group_id, size, *most frequent values) from (group_id, *values) rows in group order."""
+    for group_id, members in groupby(rows, key=itemgetter(0)):
+        members = list(members)
+        values = list(zip(*members))[1:]
+        yield (group_id, len(members), *map(most_frequent, values))
+
+
+def build_golden_records(columns=None):
+    """Materialize GOLDEN_TABLE with one row per group and the most frequent value of every column.
+
+    On Postgres a single GROUP BY scan computes mode() of every column at once,
+    elsewhere the rows are streamed in group order and counted in process.
+    """
+    columns = check_columns(columns)
+    quoted = [quote(column) for column in columns]
+
+    with grouping_session():
+        try:
+            db.session.execute(text(f"DROP TABLE IF EXISTS {GOLDEN_TABLE};"))
+            invalidate_headers(GOLDEN_TABLE)
+            if is_postgres():
+                modes = [
+                    f"mode() WITHIN GROUP (ORDER BY f.{column}) FILTER (WHERE TRIM(f.{column}::text) <> '') AS {column}"
+                    for column in quoted
+                ]
+                execute_sql(
+                    f"""
+                    CREATE TABLE {GOLDEN_TABLE} AS
+                    SELECT
+                        a.group_id,
+                        COUNT(*) AS size,
+                        {', '.join(modes)}
+                    FROM
+                        {TABLE_NAME} f
+                    JOIN
+                        {assignments_view(TABLE_NAME)} a
+                    ON
+                        a.client_id = f.client_id
+                    GROUP BY
+                        a.group_id;
+                    """
+                )
+            else:
+                members = f"{TABLE_NAME} f JOIN {assignments_view(TABLE_NAME)} a ON a.client_id = f.client_id"
+                selected = ", ".join(f"f.{column}" for column in quoted)
+                execute_sql(
+                    # Without the cast SQLite gives size no declared type, and exports read it as text
+                    f"CREATE TABLE {GOLDEN_TABLE} AS "
+                    f"SELECT a.group_id, CAST(COUNT(*) AS INTEGER) AS size, {selected} FROM {members} LIMIT 0;"
+                )
+                rows = stream_rows(f"SELECT a.group_id, {selected} FROM {members} ORDER BY a.group_id")
+                copy_rows(GOLDEN_TABLE, ["group_id", "size", *quoted], golden_rows(rows))
+            db.session.execute(text(f"CREATE UNIQUE INDEX idx_{GOLDEN_TABLE}_group_id ON {GOLDEN_TABLE}(group_id);"))
+            invalidate_headers(GOLDEN_TABLE)
+            groups = db.session.execute(text(f"SELECT COUNT(*) FROM {GOLDEN_TABLE};")).scalar()
+        except OperationalError as e:
+            logger.critical(e)
+            raise HTTPException(status_code=422)
 
+    report_progress(golden_records=groups)
+    logger.info(f"{groups} golden records written to {GOLDEN_TABLE}")
+    return {"table": GOLDEN_TABLE, "groups": groups, "columns": columns}
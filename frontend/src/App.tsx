@@ -3,9 +3,31 @@ import axios from 'axios';
 import { FilePicker } from './components/FilePicker';
 
 import styles from './App.module.css';
-import { Button, Card, Checkbox, Flex } from '@gravity-ui/uikit';
+import { Button, Card, Checkbox, Flex, Text } from '@gravity-ui/uikit';
 import { useForm } from 'react-hook-form';
 
+type Job = { status: 'pending' | 'running' | 'done' | 'failed'; result: unknown; error: string | null };
+
+const waitForJob = async (jobId: string): Promise<Job> => {
+	for (;;) {
+		const { data } = await axios.get<Job>(`http://localhost:8000/jobs/${jobId}`);
+		if (data.status === 'failed') {
+			throw new Error(data.error ?? 'Job failed');
+		}
+		if (data.status === 'done') {
+			return data;
+		}
+		await new Promise(resolve => setTimeout(resolve, 1000));
+	}
+};
+
+const errorMessage = (error: unknown): string => {
+	if (axios.isAxiosError<{ detail?: unknown }>(error) && error.response?.data?.detail) {
+		return String(error.response.data.detail);
+	}
+	return error instanceof Error ? error.message : String(error);
+};
+
 export const App: React.FC = () => {
 	// const [groups, setGroups] = useState({});
 	const [files, setFiles] = useState<File[]>([]);
@@ -15,13 +37,23 @@ export const App: React.FC = () => {
 		defaultValues: { columns: [] },
 	});
 	const [groups, setGroups] = useState({});
+	const [error, setError] = useState<string | null>(null);
 
 	const generateDatabase = useCallback(async () => {
+		setError(null);
 		const formData = new FormData();
 		for (const file of files) {
 			formData.set('files', file);
 		}
-		await axios.post('http://localhost:8000/generate', formData);
+		try {
+			const {
+				data: { job_id },
+			} = await axios.post<{ job_id: string }>('http://localhost:8000/generate', formData);
+			await waitForJob(job_id);
+		} catch (e) {
+			setError(errorMessage(e));
+			return;
+		}
 
 		const {
 			data: { headers },
@@ -66,6 +98,8 @@ export const App: React.FC = () => {
 				Загрузить
 			</Button>
 
+			{error && <Text color="danger">{error}</Text>}
+
 			<pre>{JSON.stringify(groups, null, 2)}</pre>
 		</div>
 	);